@@ -1,13 +1,21 @@
 #!/bin/bash
-r=$(lsof -i :8080 | grep -oP '\s+\K\d+\s+' |  head -n 1)
-read -p "Do you wish to kill $r (ENTER & y -> kill | anything else -> no) ?" -r input
+# Usage: autokill.sh [port ...], defaults to 8080. With a VecPeersimEnv pass every port in use, e.g. $(seq 8080 8083)
+ports=${@:-8080}
+for port in $ports; do
+  r=$(lsof -i :$port | grep -oP '\s+\K\d+\s+' |  head -n 1)
+  if [[ -z "$r" ]]; then
+    echo "Nothing running on $port"
+    continue
+  fi
+  read -p "Do you wish to kill $r on port $port (ENTER & y -> kill | anything else -> no) ?" -r input
 
-if [[ "$input" == "y" || "$input" == "Y"|| "$input" == "" ]]; then
-  echo "Killing $r"
-  kill $r
-else
-  echo "Nothing was killed"
-fi
+  if [[ "$input" == "y" || "$input" == "Y"|| "$input" == "" ]]; then
+    echo "Killing $r"
+    kill $r
+  else
+    echo "Nothing was killed"
+  fi
+done
 
 
 # Certainly, let me explain each element of the regular expression pattern `\s+\K\d+\s+`:
@@ -11,7 +11,7 @@ from abc import abstractmethod
 import peersim_gym.envs.PeersimEnv as pg
 
 from src.Utils import utils
-from src.Utils.DatasetGen import SarsaDataCollector
+from src.Utils.DatasetGen import DATASET_SUFFIX, SarsaDataCollector
 from src.Utils.MetricHelper import MetricHelper as mh
 
 
@@ -30,7 +30,8 @@ class ControlAlgorithm:
         self.file_name = file_name
         self.plot_name = plot_name
         if self.collect_data:
-            self.data_collector = SarsaDataCollector(agents=agents)
+            # Streamed to <file_name>_sarsa as the simulation runs, see SarsaDataCollector.load_dataset.
+            self.data_collector = SarsaDataCollector(agents=agents, directory=self.file_name + DATASET_SUFFIX)
 
     @property
     @abstractmethod
@@ -88,7 +89,7 @@ class ControlAlgorithm:
         self.mh.plot_simulation_data(num_episodes=num_episodes, title=self.control_type + self.plot_name, print_instead=print_instead)
         self.mh.clean_plt_resources()
         if self.collect_data:
-            print("Saving Data to CSV" + self.file_name + '.csv')
-            self.data_collector.save_to_csv(self.file_name + '.csv')
+            print("Saving Data to " + self.file_name + DATASET_SUFFIX)
+            self.data_collector.save()
         env.close()
 
@@ -3,6 +3,7 @@ This file has a set uf utilities to help interactively draw plots over the resul
 '''
 import csv
 import json
+import multiprocessing
 import os
 
 import matplotlib.pyplot as plt
@@ -13,6 +14,8 @@ import re
 import matplotlib.pyplot as plt
 from matplotlib.ticker import StrMethodFormatter
 
+from src.Utils.ResultsLoader import ResultSummary, load_summary, window_means, running_means
+
 
 def read_cvs(filename):
     # Open the CSV file
@@ -29,7 +32,15 @@ def process_string_array_entry(array):
     return re.sub(',+', ',', re.sub(' +', ',', array.replace('\n', ' ')).replace('[,', '[').replace(',]', ']'))
 
 
-def plot_lines(x_values, y_values, y_labels, plot_title, x_axis_label, y_axis_label, convert_to_float=False, plot_dots=False, force_int=False, prefix_plot_png="", force_y_axisticks=None, force_xaxisticks=None):
+def as_summary(data):
+    """
+    :param data: ResultSummary, or the rows of a results file without the header.
+    :return: ResultSummary
+    """
+    return data if isinstance(data, ResultSummary) else ResultSummary.from_rows(data)
+
+
+def plot_lines(x_values, y_values, y_labels, plot_title, x_axis_label, y_axis_label, convert_to_float=False, plot_dots=False, force_int=False, prefix_plot_png="", force_y_axisticks=None, force_xaxisticks=None, show=True):
     # Convert the y values to float arrays
     if convert_to_float:
         for idx in range(len(y_values)):
@@ -65,7 +76,8 @@ def plot_lines(x_values, y_values, y_labels, plot_title, x_axis_label, y_axis_la
     plt.tight_layout()
     plt.legend(fontsize=fontsize_legend)
     plt.savefig(f'./Plots/Output/{plot_title + prefix_plot_png}.pdf', bbox_inches='tight', )
-    plt.show()
+    if show:
+        plt.show()
 
 
 def plot_lines_fill_between(x_values, y_values, y_labels, plot_title, x_axis_label, y_axis_label,
@@ -101,14 +113,11 @@ def plot_all_complete_percentage_in_dir(dir, cores, lambdas):
     }
     for file in csv_files:
         path = os.path.join(dir, file)
-        data_results = read_cvs(path)
-        data = data_results[1:]
-        x = range(len(data))
-        total_tasks = [np.sum(ast.literal_eval(process_string_array_entry(row[5]))) for row in data]
-        finished_tasks = [np.sum(ast.literal_eval(process_string_array_entry(row[4]))) for row in data]
-
-        percentage_finished_tasks = np.average(
-            [finished / total for finished, total in zip(finished_tasks, total_tasks)])
+        summary = load_summary(path)
+        total_tasks = summary.stat(5, 'sum')
+        finished_tasks = summary.stat(4, 'sum')
+
+        percentage_finished_tasks = np.average(finished_tasks / total_tasks)
         info = file.replace(".csv", "").replace("_result_metrics", "").replace("least_queue_", "").split("_")
         c = info[0].replace("c", "")
         oc = info[1].replace("oc", "")
@@ -163,20 +172,12 @@ def plot_all_complete_percentage_in_dir(dir, cores, lambdas):
 
 def plot_rewards(ddqn):
     # Read the data from the CSV file
-    ddqn_result = read_cvs(ddqn)
-    # Extract the headers and the data
-    headers = ddqn_result[0]
-    ddqn_data = ddqn_result[1:]
-    agent_list = [header for header in headers if 'reward' in header]
-    agent_rewards = {agent: [] for agent in agent_list}
-    # Separate the data and pre-process it
-
-    for i in range(len(ddqn_data)):
-        for data, header in zip(ddqn_data[i], headers):
-            if 'reward' in header:
-                agent_rewards[header].append(np.mean(ast.literal_eval(process_string_array_entry(data))))
+    ddqn_summary = load_summary(ddqn)
+    agent_list = [header for header in ddqn_summary.columns if 'reward' in header]
+    # Mean reward of each agent in each episode
+    agent_rewards = {agent: ddqn_summary.stat(agent, 'mean') for agent in agent_list}
     # Generate X axis
-    x = range(len(ddqn_data))
+    x = range(len(ddqn_summary))
     # Add all the dataon the same plot to a matrix
     y_labels = agent_list
     rewards_matrix = [agent_rewards[agent] for agent in agent_list]
@@ -186,145 +187,25 @@ def plot_rewards(ddqn):
 
 
 def plot_results(least_queues, random, always_local, ddqn):
-    # Read the data from the CSV file
-    least_queues_result = read_cvs(least_queues)
-    random_result = read_cvs(random)
-    always_local_result = read_cvs(always_local)
-    ddqn_result = read_cvs(ddqn)
-
-    # Extract the headers and the data
-    headers = least_queues_result[0]
-    least_queues_data = least_queues_result[1:]
-    random_data = random_result[1:]
-    always_local_data = always_local_result[1:]
-    ddqn_data = ddqn_result[1:]
-
-    least_queues_occupancy = []
-    random_occupancy = []
-    always_local_occupancy = []
-    ddqn_occupancy = []
-
-    least_queues_response_time = []
-    random_response_time = []
-    always_local_response_time = []
-    ddqn_response_time = []
-
-    least_queues_overloaded = []
-    random_overloaded = []
-    always_local_overloaded = []
-    ddqn_overloaded = []
-
-    least_queues_dropped_Tasks = []
-    random_dropped_Tasks = []
-    always_local_dropped_Tasks = []
-    ddqn_dropped_Tasks = []
-
-    least_queues_finished_Tasks = []
-    random_finished_Tasks = []
-    always_local_finished_Tasks = []
-    ddqn_finished_Tasks = []
-
-    least_queues_total_Tasks = []
-    random_total_Tasks = []
-    always_local_total_Tasks = []
-    ddqn_total_Tasks = []
-
-    least_queues_percentage_dropped_tasks = []
-    random_percentage_dropped_tasks = []
-    always_local_percentage_dropped_tasks = []
-    ddqn_percentage_dropped_tasks = []
-
-    least_queues_percentage_finished_tasks = []
-    random_percentage_finished_tasks = []
-    always_local_percentage_finished_tasks = []
-    ddqn_percentage_finished_tasks = []
-
-    # Separate the data and pre-process it
-    for i in range(len(least_queues_data)):
-        try:
-            # Pre-process the into three arrays, occupancy, overloads and response time for each type of agent
-            least_queues_overloaded.append(
-                np.mean(ast.literal_eval(process_string_array_entry(least_queues_data[i][0]))))
-            random_overloaded.append(np.mean(ast.literal_eval(process_string_array_entry(random_data[i][0]))))
-            always_local_overloaded.append(
-                np.mean(ast.literal_eval(process_string_array_entry(always_local_data[i][0]))))
-            ddqn_overloaded.append(np.mean(ast.literal_eval(process_string_array_entry(ddqn_data[i][0]))))
-
-            least_queues_occupancy.append(
-                np.mean(ast.literal_eval(process_string_array_entry(least_queues_data[i][1]))))
-            random_occupancy.append(np.mean(ast.literal_eval(process_string_array_entry(random_data[i][1]))))
-            always_local_occupancy.append(
-                np.mean(ast.literal_eval(process_string_array_entry(always_local_data[i][1]))))
-            ddqn_occupancy.append(np.mean(ast.literal_eval(process_string_array_entry(ddqn_data[i][1]))))
-
-            least_queues_response_time.append(
-                np.mean(ast.literal_eval(process_string_array_entry(least_queues_data[i][2]))))
-            random_response_time.append(np.mean(ast.literal_eval(process_string_array_entry(random_data[i][2]))))
-            always_local_response_time.append(
-                np.mean(ast.literal_eval(process_string_array_entry(always_local_data[i][2]))))
-            ddqn_response_time.append(np.mean(ast.literal_eval(process_string_array_entry(ddqn_data[i][2]))))
-
-            least_queues_dropped_Tasks.append(
-                np.sum(ast.literal_eval(process_string_array_entry(least_queues_data[i][3]))))
-            random_dropped_Tasks.append(np.sum(ast.literal_eval(process_string_array_entry(random_data[i][3]))))
-            always_local_dropped_Tasks.append(
-                np.sum(ast.literal_eval(process_string_array_entry(always_local_data[i][3]))))
-            ddqn_dropped_Tasks.append(np.sum(ast.literal_eval(process_string_array_entry(ddqn_data[i][3]))))
-
-            least_queues_finished_Tasks.append(
-                np.sum(ast.literal_eval(process_string_array_entry(least_queues_data[i][4]))))
-            random_finished_Tasks.append(np.sum(ast.literal_eval(process_string_array_entry(random_data[i][4]))))
-            always_local_finished_Tasks.append(
-                np.sum(ast.literal_eval(process_string_array_entry(always_local_data[i][4]))))
-            ddqn_finished_Tasks.append(np.sum(ast.literal_eval(process_string_array_entry(ddqn_data[i][4]))))
-
-            least_queues_total_Tasks.append(
-                np.sum(ast.literal_eval(process_string_array_entry(least_queues_data[i][5]))))
-            random_total_Tasks.append(np.sum(ast.literal_eval(process_string_array_entry(random_data[i][5]))))
-            always_local_total_Tasks.append(
-                np.sum(ast.literal_eval(process_string_array_entry(always_local_data[i][5]))))
-            ddqn_total_Tasks.append(np.sum(ast.literal_eval(process_string_array_entry(ddqn_data[i][5]))))
-
-            # Compute the percentage of tasks dropped and completed
-            least_queues_percentage_dropped_tasks.append(least_queues_dropped_Tasks[i] / least_queues_total_Tasks[i])
-            random_percentage_dropped_tasks.append(random_dropped_Tasks[i] / random_total_Tasks[i])
-            always_local_percentage_dropped_tasks.append(always_local_dropped_Tasks[i] / always_local_total_Tasks[i])
-            ddqn_percentage_dropped_tasks.append(ddqn_dropped_Tasks[i] / ddqn_total_Tasks[i])
-
-            least_queues_percentage_finished_tasks.append(least_queues_finished_Tasks[i] / least_queues_total_Tasks[i])
-            random_percentage_finished_tasks.append(random_finished_Tasks[i] / random_total_Tasks[i])
-            always_local_percentage_finished_tasks.append(always_local_finished_Tasks[i] / always_local_total_Tasks[i])
-            ddqn_percentage_finished_tasks.append(ddqn_finished_Tasks[i] / ddqn_total_Tasks[i])
-
-
-        except Exception as e:
-            print(f"Error on line {i}")
-            print(f'Least Queues: {least_queues_data[i]}')
-            print(f'Random Data : {random_data[i]}')
-            print(f'Alwasy local: {always_local_data[i]}')
-            print(f'DDQN: {ddqn_data[i]}')
-            input('Failed here, continue?')
-
-        # ddqn_data[i] = list(map(ast.literal_eval, ddqn_data[i]))
+    # Read the data from the CSV files, in the order of the labels
+    summaries = [load_summary(least_queues), load_summary(random), load_summary(always_local), load_summary(ddqn)]
+    episodes = min(len(summary) for summary in summaries)
+
+    # Per episode: the mean over the nodes of overloads, occupancy and response time, and the totals of the tasks.
+    overloaded_matrix = [summary.stat(0, 'mean')[:episodes] for summary in summaries]
+    occupancy_matrix = [summary.stat(1, 'mean')[:episodes] for summary in summaries]
+    response_time_matrix = [summary.stat(2, 'mean')[:episodes] for summary in summaries]
+    dropped_tasks_matrix = [summary.stat(3, 'sum')[:episodes] for summary in summaries]
+    finished_tasks_matrix = [summary.stat(4, 'sum')[:episodes] for summary in summaries]
+    total_tasks_matrix = [summary.stat(5, 'sum')[:episodes] for summary in summaries]
+
+    # Compute the percentage of tasks dropped and completed
+    percentage_dropped_tasks_matrix = [dropped / total for dropped, total in zip(dropped_tasks_matrix, total_tasks_matrix)]
+    percentage_finished_tasks_matrix = [finished / total for finished, total in zip(finished_tasks_matrix, total_tasks_matrix)]
+
     # Generate X axis
-    x = range(len(least_queues_data))
-    # Add all the dataon the same plot to a matrix
+    x = range(episodes)
     y_labels = ['Least Queue', 'Random Offloading', 'Local Processing', 'DDQN']
-    occupancy_matrix = [least_queues_occupancy, random_occupancy, always_local_occupancy, ddqn_occupancy]
-    response_time_matrix = [least_queues_response_time, random_response_time, always_local_response_time,
-                            ddqn_response_time]
-    overloaded_matrix = [least_queues_overloaded, random_overloaded, always_local_overloaded, ddqn_overloaded]
-
-    dropped_tasks_matrix = [least_queues_dropped_Tasks, random_dropped_Tasks, always_local_dropped_Tasks,
-                            ddqn_dropped_Tasks]
-    finished_tasks_matrix = [least_queues_finished_Tasks, random_finished_Tasks, always_local_finished_Tasks,
-                             ddqn_finished_Tasks]
-    total_tasks_matrix = [least_queues_total_Tasks, random_total_Tasks, always_local_total_Tasks, ddqn_total_Tasks]
-
-    percentage_dropped_tasks_matrix = [least_queues_percentage_dropped_tasks, random_percentage_dropped_tasks,
-                                       always_local_percentage_dropped_tasks, ddqn_percentage_dropped_tasks]
-    percentage_finished_tasks_matrix = [least_queues_percentage_finished_tasks, random_percentage_finished_tasks,
-                                        always_local_percentage_finished_tasks, ddqn_percentage_finished_tasks]
 
     # Convert the data to numpy arrays
     plot_lines(x_values=x, y_values=occupancy_matrix, y_labels=y_labels, plot_title='Occupancy',
@@ -355,17 +236,10 @@ def plot_pe_10_episodes(
         ddqn='./OutputData/DDQN_result_ether_metrics'
 ):
     # Read the data from the CSV file
-    least_queues_result = read_cvs(least_queues)
-    random_result = read_cvs(random)
-    always_local_result = read_cvs(always_local)
-    ddqn_result = read_cvs(ddqn)
-
-    # Extract the headers and the data
-    headers = least_queues_result[0]
-    least_queues_data = least_queues_result[1:]
-    random_data = random_result[1:]
-    always_local_data = always_local_result[1:]
-    ddqn_data = ddqn_result[1:]
+    least_queues_data = load_summary(least_queues)
+    random_data = load_summary(random)
+    always_local_data = load_summary(always_local)
+    ddqn_data = load_summary(ddqn)
 
     least_queues_occupancy, least_queues_overloaded, least_queues_response_time, least_queues_dropped, least_queues_finished, least_queues_total = process_for_each_10(
         least_queues_data)
@@ -407,95 +281,34 @@ def plot_pe_10_episodes(
                x_axis_label='Episodes', y_axis_label='Total Tasks', convert_to_float=True)
 
 
+def episode_metrics(array):
+    """
+    :param array: ResultSummary, or the rows of a results file without the header.
+    :return: per episode, (mean, std) over the nodes of the overloads, occupancy and response time, as (episodes, 2)
+    arrays, and the totals of dropped, finished and total tasks.
+    """
+    summary = as_summary(array)
+    per_node = [np.stack([summary.stat(idx, 'mean'), summary.stat(idx, 'std')], axis=1) for idx in (0, 1, 2)]
+    totals = [summary.stat(idx, 'sum') for idx in (3, 4, 5)]
+    return per_node + totals
+
+
 def process_for_each_10(array):
-    # Separate the data and pre-process it
-
-    overloaded_l = []
-    occupancy_l = []
-    response_time_l = []
-    dropped_l = []
-    finished_l = []
-    total_l = []
-
-    j = 0
-    acc_overloaded = []
-    acc_occupancy = []
-    acc_response_time = []
-    acc_dropped = []
-    acc_finished = []
-    acc_total = []
-    for i in range(len(array)):
-        next = j % 10
-        overloaded = ast.literal_eval(process_string_array_entry(array[i][0]))
-        occupancy = ast.literal_eval(process_string_array_entry(array[i][1]))
-        response_time = ast.literal_eval(process_string_array_entry(array[i][2]))
-        dropped = ast.literal_eval(process_string_array_entry(array[i][3]))
-        finished = ast.literal_eval(process_string_array_entry(array[i][4]))
-        total = ast.literal_eval(process_string_array_entry(array[i][5]))
-
-        acc_overloaded.append(np.array([np.mean(overloaded), np.std(overloaded)]))
-        acc_occupancy.append(np.array([np.mean(occupancy), np.std(occupancy)]))
-        acc_response_time.append(np.array([np.mean(response_time), np.std(response_time)]))
-        acc_dropped.append(np.sum(dropped))
-        acc_finished.append(np.sum(finished))
-        acc_total.append(np.sum(total))
-        j += 1
-        if next != 0:
-            j = 0
-            acc_overloaded = []
-            acc_occupancy = []
-            acc_response_time = []
-            acc_dropped = []
-            acc_finished = []
-            acc_total = []
-        else:
-            i += 1
-            overloaded_l.append(np.mean(acc_overloaded, axis=0))
-            occupancy_l.append(np.mean(acc_occupancy, axis=0))
-            response_time_l.append(np.mean(acc_response_time, axis=0))
-            dropped_l.append(np.mean(acc_dropped))
-            finished_l.append(np.mean(acc_finished))
-            total_l.append(np.mean(acc_total))
-    return overloaded_l, occupancy_l, response_time_l, dropped_l, finished_l, total_l
+    """
+    Averages the episode metrics (see episode_metrics) over windows of 10 episodes.
+    :param array: ResultSummary, or the rows of a results file without the header.
+    :return: overloaded, occupancy, response_time, dropped, finished, total, one entry per window.
+    """
+    return tuple(list(window_means(metric, 10)) for metric in episode_metrics(array))
 
 
 def get_average_episode_data(array):
-    overloaded_l = []
-    occupancy_l = []
-    response_time_l = []
-    dropped_l = []
-    finished_l = []
-    total_l = []
-
-    acc_overloaded = []
-    acc_occupancy = []
-    acc_response_time = []
-    acc_dropped = []
-    acc_finished = []
-    acc_total = []
-    for i in range(len(array)):
-        overloaded = ast.literal_eval(process_string_array_entry(array[i][0]))
-        occupancy = ast.literal_eval(process_string_array_entry(array[i][1]))
-        response_time = ast.literal_eval(process_string_array_entry(array[i][2]))
-        dropped = ast.literal_eval(process_string_array_entry(array[i][3]))
-        finished = ast.literal_eval(process_string_array_entry(array[i][4]))
-        total = ast.literal_eval(process_string_array_entry(array[i][5]))
-
-        acc_overloaded.append(np.array([np.mean(overloaded), np.std(overloaded)]))
-        acc_occupancy.append(np.array([np.mean(occupancy), np.std(occupancy)]))
-        acc_response_time.append(np.array([np.mean(response_time), np.std(response_time)]))
-        acc_dropped.append(np.sum(dropped))
-        acc_finished.append(np.sum(finished))
-        acc_total.append(np.sum(total))
-
-        overloaded_l.append(np.mean(acc_overloaded, axis=0))
-        occupancy_l.append(np.mean(acc_occupancy, axis=0))
-        response_time_l.append(np.mean(acc_response_time, axis=0))
-        dropped_l.append(np.mean(acc_dropped))
-        finished_l.append(np.mean(acc_finished))
-        total_l.append(np.mean(acc_total))
-
-    return overloaded_l, occupancy_l, response_time_l, dropped_l, finished_l, total_l
+    """
+    Average of the episode metrics (see episode_metrics) up to each episode.
+    :param array: ResultSummary, or the rows of a results file without the header.
+    :return: overloaded, occupancy, response_time, dropped, finished, total, one entry per episode.
+    """
+    return tuple(list(running_means(metric)) for metric in episode_metrics(array))
 
 
 def plot_average_state_space_exploration(least_queues_base, random_base, always_local_base, ddqn_base, a2c_base, prefix_format,
@@ -504,6 +317,7 @@ def plot_average_state_space_exploration(least_queues_base, random_base, always_
     Make chart of the evolution of the average test across all the episodes. Therefore, gathering the average of the averages
     might be interesting. Aka a plot with an entry with 4 lines (DDQN, LQ, AL, RN) with axis x lambda, axis y whatever
     data is being measured.
+    To build the figures without showing them, pass state_space_exploration_specs to render_figures.
     :param least_queues_base:
     :param random_base:
     :param always_local_base:
@@ -512,145 +326,177 @@ def plot_average_state_space_exploration(least_queues_base, random_base, always_
     :param x_values:
     :return:
     """
-    least_queues_avg_for_x = {
-        'occupancy': [],
-        'overloaded': [],
-        'response_time': [],
-        'dropped': [],
-        'finished': [],
-        'total': []
-    }
-    random_avg_for_x = {
-        'occupancy': [],
-        'overloaded': [],
-        'response_time': [],
-        'dropped': [],
-        'finished': [],
-        'total': []
-    }
+    specs = state_space_exploration_specs(least_queues_base, random_base, always_local_base, ddqn_base, a2c_base,
+                                          prefix_format, x_values, x_label=x_label, plot_dots=plot_dots,
+                                          prefix_plot_png=prefix_plot_png, force_int=force_int)
+    summaries = load_figure_inputs(specs)
+    for spec in specs:
+        render_figure(spec, summaries, show=True)
+
+
+# Batch rendering of the figures. A figure is described by a spec (a dict that can be stored as JSON):
+# - kind: "sweep" (one point per x value, the average over the episodes of each file), "episodes" (one point per
+#   episode) or "times" (read from a JSON file, see plot_times).
+# - series: label -> list of files, one per x value, for "sweep". label -> file for "episodes".
+# - metric: one of FIGURE_METRICS.
+# - title, x_label, y_label, x_values, and plot_lines' options (plot_dots, force_int, prefix_plot_png, ...).
+FIGURE_METRICS = ['overloaded', 'occupancy', 'response_time', 'dropped', 'finished', 'total']
+FIGURE_OUTPUT_DIR = './Plots/Output/'
+FIGURE_STAMPS = '.figure_inputs.json'
+PLOT_OPTIONS = ['plot_dots', 'force_int', 'prefix_plot_png', 'force_y_axisticks', 'force_xaxisticks']
+_figure_summaries = {}
+
+
+def state_space_exploration_specs(least_queues_base, random_base, always_local_base, ddqn_base, a2c_base, prefix_format,
+                                  x_values, x_label="", plot_dots=False, prefix_plot_png="", force_int=False):
+    """
+    :return: the specs of the figures of plot_average_state_space_exploration.
+    """
+    bases = {'Least Queues': least_queues_base, 'Random': random_base, 'Always Local': always_local_base,
+             'DDQN': ddqn_base, 'A2C': a2c_base}
+    series = {label: [base + prefix_format % str(x_value) for x_value in x_values] for label, base in bases.items()}
+    common = {'kind': 'sweep', 'series': series, 'x_values': list(x_values), 'x_label': x_label,
+              'plot_dots': plot_dots, 'force_int': force_int, 'prefix_plot_png': prefix_plot_png}
+    return [
+        dict(common, metric='occupancy', title='Occupancy', y_label='Occupancy'),
+        dict(common, metric='overloaded', title='Overloaded', y_label='Overloaded',
+             force_y_axisticks=[0, 50, 100, 150, 200, 250], force_xaxisticks=[0.2, 0.4, 0.6, 0.8]),
+        dict(common, metric='response_time', title='Response Time', y_label='Response Time',
+             force_y_axisticks=[20, 25, 30]),
+        dict(common, metric='dropped', title='Dropped', y_label='Dropped', force_xaxisticks=[0.2, 0.4, 0.6, 0.8]),
+        dict(common, metric='finished', title='Finished', y_label='Finished'),
+        dict(common, metric='total', title='Total', y_label='Total'),
+    ]
+
+
+def figure_inputs(spec):
+    """
+    :param spec:
+    :return: the files the figure is made from.
+    """
+    if spec['kind'] == 'sweep':
+        return [path for paths in spec['series'].values() for path in paths]
+    elif spec['kind'] == 'episodes':
+        return list(spec['series'].values())
+    elif spec['kind'] == 'times':
+        return [spec['json_file']]
+    raise ValueError(f"Unknown figure kind {spec['kind']}")
 
-    always_local_avg_for_x = {
-        'occupancy': [],
-        'overloaded': [],
-        'response_time': [],
-        'dropped': [],
-        'finished': [],
-        'total': []
-    }
 
-    ddqn_avg_for_x = {
-        'occupancy': [],
-        'overloaded': [],
-        'response_time': [],
-        'dropped': [],
-        'finished': [],
-        'total': []
+def figure_output(spec):
+    # Where plot_lines saves it.
+    return os.path.join(FIGURE_OUTPUT_DIR, f"{spec['title']}{spec.get('prefix_plot_png', '')}.pdf")
 
-    }
 
-    A2C_avg_for_x = {
-        'occupancy': [],
-        'overloaded': [],
-        'response_time': [],
-        'dropped': [],
-        'finished': [],
-        'total': []
+def figure_stamp(spec):
+    """
+    :return: string that changes when the spec or any of its input files does.
+    """
+    inputs = []
+    for path in figure_inputs(spec):
+        info = os.stat(path)
+        inputs.append([path, info.st_mtime_ns, info.st_size])
+    return json.dumps({'spec': spec, 'inputs': inputs}, sort_keys=True)
+
+
+def load_figure_inputs(specs):
+    """
+    :return: dict path -> ResultSummary of every results file used by the specs, each loaded once.
+    """
+    paths = {path for spec in specs if spec['kind'] != 'times' for path in figure_inputs(spec)}
+    return {path: load_summary(path) for path in sorted(paths)}
+
+
+def figure_values(spec, summaries):
+    """
+    :return: the x values and one list of y values per series.
+    """
+    if spec['kind'] == 'times':
+        with open(spec['json_file'], 'r') as f:
+            data = json.load(f)
+        return spec['x_values'], [data[key] for key in spec['series'].values()]
+    metric = FIGURE_METRICS.index(spec['metric'])
+    if spec['kind'] == 'sweep':
+        # Average over the episodes of each file, as plot_average_state_space_exploration always did.
+        return spec['x_values'], [[np.mean(get_average_episode_data(summaries[path])[metric]) for path in paths]
+                                  for paths in spec['series'].values()]
+    per_episode = [episode_metrics(summaries[path])[metric] for path in spec['series'].values()]
+    per_episode = [values[:, 0] if values.ndim > 1 else values for values in per_episode]
+    episodes = min(len(values) for values in per_episode)
+    return list(range(episodes)), [values[:episodes] for values in per_episode]
+
+
+def render_figure(spec, summaries, show=False):
+    """
+    Draws and saves the figure of a spec with plot_lines.
+    :param spec:
+    :param summaries: dict path -> ResultSummary with the inputs, see load_figure_inputs.
+    :param show: show the figure (interactive backends).
+    :return: the file written.
+    """
+    x_values, y_values = figure_values(spec, summaries)
+    options = {option: spec[option] for option in PLOT_OPTIONS if option in spec}
+    plot_lines(x_values, y_values, list(spec['series'].keys()), spec['title'], spec.get('x_label', ''),
+               spec.get('y_label', ''), convert_to_float=True, show=show, **options)
+    plt.close('all')
+    return figure_output(spec)
+
+
+def _init_figure_worker(summaries):
+    global _figure_summaries
+    plt.switch_backend('Agg')
+    _figure_summaries = summaries
+
+
+def _render_figure_in_worker(spec):
+    return render_figure(spec, _figure_summaries)
+
+
+def render_figures(specs, workers=None, force=False):
+    """
+    Renders a batch of figures with the Agg backend in a process pool. The results files are loaded once, before the
+    pool starts, and shared with the workers. Figures whose spec and inputs did not change since they were last
+    rendered are skipped, the stamps are kept in FIGURE_OUTPUT_DIR/FIGURE_STAMPS.
+    :param specs: list of figure specs.
+    :param workers: processes, defaults to one per core. 1 renders in this process.
+    :param force: render even the figures that are up to date.
+    :return: the files written.
+    """
+    stamps_path = os.path.join(FIGURE_OUTPUT_DIR, FIGURE_STAMPS)
+    stamps = {}
+    if os.path.exists(stamps_path):
+        with open(stamps_path, 'r') as f:
+            stamps = json.load(f)
+    todo = []
+    for spec in specs:
+        output, stamp = figure_output(spec), figure_stamp(spec)
+        if force or stamps.get(output) != stamp or not os.path.exists(output):
+            todo.append((spec, output, stamp))
+    print(f"Rendering {len(todo)} of {len(specs)} figures")
+    if not todo:
+        return []
+
+    summaries = load_figure_inputs([spec for spec, _, _ in todo])
+    workers = workers if workers is not None else os.cpu_count()
+    if workers <= 1 or len(todo) == 1:
+        backend = plt.get_backend()
+        _init_figure_worker(summaries)
+        written = [_render_figure_in_worker(spec) for spec, _, _ in todo]
+        plt.switch_backend(backend)
+    else:
+        # Forked workers share the loaded summaries with this process instead of reading the files again.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with context.Pool(min(workers, len(todo)), initializer=_init_figure_worker, initargs=(summaries,)) as pool:
+            written = pool.map(_render_figure_in_worker, [spec for spec, _, _ in todo])
+
+    for _, output, stamp in todo:
+        stamps[output] = stamp
+    os.makedirs(FIGURE_OUTPUT_DIR, exist_ok=True)
+    with open(stamps_path, 'w') as f:
+        json.dump(stamps, f)
+    return written
 
-    }
-    for x_value in x_values:
-        least_queues_result = read_cvs(least_queues_base + prefix_format % str(x_value))
-        random_result = read_cvs(random_base + prefix_format %  str(x_value))
-        always_local_result = read_cvs(always_local_base + prefix_format %  str(x_value))
-        ddqn_result = read_cvs(ddqn_base + prefix_format %  str(x_value))
-        a2c_result = read_cvs(a2c_base + prefix_format %  str(x_value))
-        # Extract the headers and the data
-        headers = least_queues_result[0]
-        least_queues_data = least_queues_result[1:]
-        random_data = random_result[1:]
-        always_local_data = always_local_result[1:]
-        ddqn_data = ddqn_result[1:]
-        A2C_data = a2c_result[1:]
-
-        least_queues_overloaded,  least_queues_occupancy, least_queues_response_time, least_queues_dropped, least_queues_finished, least_queues_total = get_average_episode_data(
-            least_queues_data)
-        # add the average of each to the dictionary:
-        least_queues_avg_for_x['occupancy'].append(np.mean(least_queues_occupancy))
-        least_queues_avg_for_x['overloaded'].append(np.mean(least_queues_overloaded))
-        least_queues_avg_for_x['response_time'].append(np.mean(least_queues_response_time))
-        least_queues_avg_for_x['dropped'].append(np.mean(least_queues_dropped))
-        least_queues_avg_for_x['finished'].append(np.mean(least_queues_finished))
-        least_queues_avg_for_x['total'].append(np.mean(least_queues_total))
-
-        random_overloaded, random_occupancy, random_response_time, random_dropped, random_finished, random_total = get_average_episode_data(
-            random_data)
-        # add the average of each to the dictionary:
-        random_avg_for_x['occupancy'].append(np.mean(random_occupancy))
-        random_avg_for_x['overloaded'].append(np.mean(random_overloaded))
-        random_avg_for_x['response_time'].append(np.mean(random_response_time))
-        random_avg_for_x['dropped'].append(np.mean(random_dropped))
-        random_avg_for_x['finished'].append(np.mean(random_finished))
-        random_avg_for_x['total'].append(np.mean(random_total))
-
-        always_local_overloaded, always_local_occupancy, always_local_response_time, always_local_dropped, always_local_finished, always_local_total = get_average_episode_data(
-            always_local_data)
-        # add the average of each to the dictionary:
-        always_local_avg_for_x['occupancy'].append(np.mean(always_local_occupancy))
-        always_local_avg_for_x['overloaded'].append(np.mean(always_local_overloaded))
-        always_local_avg_for_x['response_time'].append(np.mean(always_local_response_time))
-        always_local_avg_for_x['dropped'].append(np.mean(always_local_dropped))
-        always_local_avg_for_x['finished'].append(np.mean(always_local_finished))
-        always_local_avg_for_x['total'].append(np.mean(always_local_total))
-
-        ddqn_overloaded, ddqn_occupancy, ddqn_response_time, ddqn_dropped, ddqn_finished, ddqn_total = get_average_episode_data(
-            ddqn_data)
-        # add the average of each to the dictionary:
-        ddqn_avg_for_x['occupancy'].append(np.mean(ddqn_occupancy))
-        ddqn_avg_for_x['overloaded'].append(np.mean(ddqn_overloaded))
-        ddqn_avg_for_x['response_time'].append(np.mean(ddqn_response_time))
-        ddqn_avg_for_x['dropped'].append(np.mean(ddqn_dropped))
-        ddqn_avg_for_x['finished'].append(np.mean(ddqn_finished))
-        ddqn_avg_for_x['total'].append(np.mean(ddqn_total))
-
-        A2C_overloaded, A2C_occupancy, A2C_response_time, A2C_dropped, A2C_finished, A2C_total = get_average_episode_data(
-            A2C_data)
-
-        A2C_avg_for_x['occupancy'].append(np.mean(A2C_occupancy))
-        A2C_avg_for_x['overloaded'].append(np.mean(A2C_overloaded))
-        A2C_avg_for_x['response_time'].append(np.mean(A2C_response_time))
-        A2C_avg_for_x['dropped'].append(np.mean(A2C_dropped))
-        A2C_avg_for_x['finished'].append(np.mean(A2C_finished))
-        A2C_avg_for_x['total'].append(np.mean(A2C_total))
-
-    # plot the averages
-    plot_lines(x_values,
-               [least_queues_avg_for_x['occupancy'], random_avg_for_x['occupancy'], always_local_avg_for_x['occupancy'],
-                ddqn_avg_for_x['occupancy'], A2C_avg_for_x['occupancy']], ['Least Queues', 'Random', 'Always Local', 'DDQN', 'A2C'], 'Occupancy', x_label,
-               'Occupancy', convert_to_float=True, plot_dots=plot_dots,  force_int=force_int, prefix_plot_png=prefix_plot_png )
-
-    plot_lines(x_values, [least_queues_avg_for_x['overloaded'], random_avg_for_x['overloaded'],
-                          always_local_avg_for_x['overloaded'], ddqn_avg_for_x['overloaded'], A2C_avg_for_x['overloaded']],
-               ['Least Queues', 'Random', 'Always Local', 'DDQN', 'A2C'], 'Overloaded',  x_label,'Overloaded',
-               convert_to_float=True, plot_dots=plot_dots,  force_int=force_int, prefix_plot_png=prefix_plot_png,
-               force_y_axisticks=[0, 50, 100, 150, 200, 250], force_xaxisticks=[0.2,0.4,0.6,0.8])
-
-    plot_lines(x_values, [least_queues_avg_for_x['response_time'], random_avg_for_x['response_time'],
-                          always_local_avg_for_x['response_time'], ddqn_avg_for_x['response_time'], A2C_avg_for_x['response_time']],
-               ['Least Queues', 'Random', 'Always Local', 'DDQN', 'A2C'], 'Response Time',  x_label, 'Response Time',
-               convert_to_float=True, plot_dots=plot_dots,  force_int=force_int, prefix_plot_png=prefix_plot_png, force_y_axisticks=[20, 25, 30])
-
-
-    plot_lines(x_values,
-               [least_queues_avg_for_x['dropped'], random_avg_for_x['dropped'], always_local_avg_for_x['dropped'],
-                ddqn_avg_for_x['dropped'], A2C_avg_for_x['dropped']], ['Least Queues', 'Random', 'Always Local', 'DDQN', 'A2C'], 'Dropped',  x_label,
-               'Dropped', convert_to_float=True, plot_dots=plot_dots,  force_int=force_int, prefix_plot_png=prefix_plot_png, force_xaxisticks=[0.2,0.4,0.6,0.8])
-    plot_lines(x_values,
-               [least_queues_avg_for_x['finished'], random_avg_for_x['finished'], always_local_avg_for_x['finished'],
-                ddqn_avg_for_x['finished'], A2C_avg_for_x['finished']], ['Least Queues', 'Random', 'Always Local', 'DDQN', 'A2C'], 'Finished',  x_label,
-               'Finished', convert_to_float=True, plot_dots=plot_dots,  force_int=force_int, prefix_plot_png=prefix_plot_png)
-
-    plot_lines(x_values, [least_queues_avg_for_x['total'], random_avg_for_x['total'], always_local_avg_for_x['total'],
-                          ddqn_avg_for_x['total'], A2C_avg_for_x['total']], ['Least Queues', 'Random', 'Always Local', 'DDQN', 'A2C'], 'Total',
-               x_label, 'Total', convert_to_float=True, plot_dots=plot_dots,  force_int=force_int, prefix_plot_png=prefix_plot_png)
 
 def plot_per_episode(
         least_queues='./OutputData/least_queue_ether_result_metrics',
@@ -659,17 +505,10 @@ def plot_per_episode(
         ddqn='./OutputData/DDQN_result_ether_metrics'
 ):
     # Read the data from the CSV file
-    least_queues_result = read_cvs(least_queues)
-    random_result = read_cvs(random)
-    always_local_result = read_cvs(always_local)
-    ddqn_result = read_cvs(ddqn)
-
-    # Extract the headers and the data
-    headers = least_queues_result[0]
-    least_queues_data = least_queues_result[1:]
-    random_data = random_result[1:]
-    always_local_data = always_local_result[1:]
-    ddqn_data = ddqn_result[1:]
+    least_queues_data = load_summary(least_queues)
+    random_data = load_summary(random)
+    always_local_data = load_summary(always_local)
+    ddqn_data = load_summary(ddqn)
 
     least_queues_occupancy, least_queues_overloaded, least_queues_response_time, least_queues_dropped, least_queues_finished, least_queues_total = get_average_episode_data(
         least_queues_data)
@@ -695,21 +534,18 @@ def plot_per_episode(
     total_tasks_matrix = [least_queues_total, random_total, always_local_total, ddqn_total]
 
 
+def times_spec(json_file, x_label, x_values, plot_dots, prefix_plot_png):
+    """
+    :return: the spec of the figure of plot_times.
+    """
+    return {'kind': 'times', 'json_file': json_file, 'title': 'Duration', 'x_label': x_label, 'y_label': 'seconds',
+            'x_values': list(x_values), 'plot_dots': plot_dots, 'force_int': True, 'prefix_plot_png': prefix_plot_png,
+            'series': {'Least Queues': 'least_queue', 'Random': 'random', 'Always Local': 'always_local',
+                       'DDQN': 'DDQN', 'A2C': 'A2C'}}
+
+
 def plot_times(json_file, x_label, x_values, plot_dots, prefix_plot_png):
-    data = None
-    with open(json_file, 'r') as f:
-        data = json.load(f)
-    least_queues_avg_for_x = data['least_queue']
-    random_avg_for_x = data['random']
-    always_local_avg_for_x = data['always_local']
-    ddqn_avg_for_x = data['DDQN']
-    A2C_avg_for_x = data['A2C']
-    plot_lines(x_values,
-               [least_queues_avg_for_x, random_avg_for_x, always_local_avg_for_x,
-                ddqn_avg_for_x, A2C_avg_for_x],
-               ['Least Queues', 'Random', 'Always Local', 'DDQN', 'A2C'], 'Duration', x_label,
-               'seconds', convert_to_float=True, plot_dots=plot_dots, force_int=True,
-               prefix_plot_png=prefix_plot_png)
+    render_figure(times_spec(json_file, x_label, x_values, plot_dots, prefix_plot_png), {}, show=True)
 
 
 if __name__ == '__main__':
@@ -722,15 +558,16 @@ if __name__ == '__main__':
     # plot_per_episode(least_queues='./OutputData/least_queue_ether_result_metrics', random='./OutputData/random_ether_result_metrics', always_local='./OutputData/always_local_ether_result_metrics', ddqn='./OutputData/DDQN_result_ether_metrics')
     # plot_rewards(ddqn='./OutputData/DDQN_result_ether_train_rewards')
     # plot_pe_10_episodes(least_queues='./OutputData/least_queue_ether_result_metrics', random='./OutputData/random_ether_result_metrics', always_local='./OutputData/always_local_ether_result_metrics', ddqn='./OutputData/DDQN_result_ether_metrics')
-    plot_average_state_space_exploration(least_queues_base='./OutputData/LambdaExploration/least_queue_ether',
-                                            random_base='./OutputData/LambdaExploration/random_ether',
-                                            always_local_base='./OutputData/LambdaExploration/always_local_ether',
-                                            ddqn_base='./OutputData/LambdaExploration/DDQN_result_ether',
-                                            a2c_base='./OutputData/LambdaExploration/A2C_ether',
-                                            prefix_format='_%s_result_metrics',
-                                            x_label="Lambda",
-                                            x_values=[ 0.01, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
-                                            plot_dots=True, prefix_plot_png="_le_2")
+    # Saves the figures without showing them, only the ones whose results changed since the last run.
+    render_figures(state_space_exploration_specs(least_queues_base='./OutputData/LambdaExploration/least_queue_ether',
+                                                 random_base='./OutputData/LambdaExploration/random_ether',
+                                                 always_local_base='./OutputData/LambdaExploration/always_local_ether',
+                                                 ddqn_base='./OutputData/LambdaExploration/DDQN_result_ether',
+                                                 a2c_base='./OutputData/LambdaExploration/A2C_ether',
+                                                 prefix_format='_%s_result_metrics',
+                                                 x_label="Lambda",
+                                                 x_values=[ 0.01, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+                                                 plot_dots=True, prefix_plot_png="_le_2"))
     # plot_average_state_space_exploration(least_queues_base='./OutputData/clusters/least_queue_ether_no_clusters',
     #                                         random_base='./OutputData/clusters/random_ether_no_clusters',
     #                                         always_local_base='./OutputData/clusters/always_local_ether_no_clusters',
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch as T
+
+
+class FlatAggregator:
+    """
+    Weighted FedAvg over flat parameter vectors. Each update (a state_dict) is copied into one row of a preallocated
+    (n_updates, n_params) matrix, and the aggregate is a single weighted reduction over the rows, instead of a python
+    loop over every key of every update.
+
+    The layout (order, shapes and dtypes of the keys) is taken from a reference state_dict, normally the global model.
+    Every entry is aggregated in float32, integer buffers (e.g. BatchNorm's num_batches_tracked) are rounded back when
+    written.
+
+    Based on:
+    - https://arxiv.org/abs/1602.05629 | Communication-Efficient Learning of Deep Networks from Decentralized Data
+    - https://arxiv.org/abs/1903.03934 | Asynchronous Federated Optimization (staleness weights)
+    """
+
+    def __init__(self, reference_state_dict, device=None):
+        """
+        :param reference_state_dict: state_dict with the layout every update follows.
+        :param device: where the aggregation happens, defaults to the device of the reference.
+        """
+        self.keys = list(reference_state_dict.keys())
+        self.shapes = [reference_state_dict[key].shape for key in self.keys]
+        self.dtypes = [reference_state_dict[key].dtype for key in self.keys]
+        self.numels = [reference_state_dict[key].numel() for key in self.keys]
+        self.offsets = np.concatenate(([0], np.cumsum(self.numels))).tolist()
+        self.n_params = self.offsets[-1]
+        self.device = device if device is not None else next(iter(reference_state_dict.values())).device
+        self.stacked = None
+
+    def flatten(self, state_dict, out=None):
+        """
+        :param state_dict:
+        :param out: optional 1-D tensor with n_params entries to write into.
+        :return: the flat vector.
+        """
+        if out is None:
+            out = T.empty(self.n_params, dtype=T.float, device=self.device)
+        # One concatenation per update, written in place.
+        T.cat([state_dict[key].reshape(-1).to(device=self.device, dtype=T.float) for key in self.keys], out=out)
+        return out
+
+    def stack(self, updates):
+        """
+        Copies the updates into the rows of one matrix. The storage is reused between rounds and only grows.
+        :param updates: list of state_dicts or flat vectors.
+        :return: tensor with shape (n_updates, n_params)
+        """
+        n_updates = len(updates)
+        if self.stacked is None or self.stacked.shape[0] < n_updates:
+            self.stacked = T.empty((n_updates, self.n_params), dtype=T.float, device=self.device)
+        stacked = self.stacked[:n_updates]
+        with T.no_grad():
+            for row, update in enumerate(updates):
+                if isinstance(update, T.Tensor):
+                    stacked[row].copy_(update)
+                else:
+                    self.flatten(update, out=stacked[row])
+        return stacked
+
+    def unflatten(self, flat):
+        """
+        :param flat: 1-D tensor with n_params entries.
+        :return: OrderedDict with the layout of the reference.
+        """
+        state_dict = OrderedDict()
+        for key, shape, dtype, start, end in zip(self.keys, self.shapes, self.dtypes, self.offsets[:-1], self.offsets[1:]):
+            value = flat[start:end].reshape(shape)
+            state_dict[key] = value.round().to(dtype) if not dtype.is_floating_point else value.to(dtype)
+        return state_dict
+
+    def aggregate(self, updates, weights=None):
+        """
+        :param updates: list of state_dicts or flat vectors.
+        :param weights: one non-negative weight per update, normalized here. Uniform when None.
+        :return: the flat weighted mean.
+        """
+        stacked = self.stack(updates)
+        if weights is None:
+            return stacked.mean(dim=0)
+        weights = T.as_tensor(np.asarray(weights, dtype=np.float32), device=self.device)
+        return weights @ stacked / weights.sum()
+
+    def write(self, model, flat):
+        """
+        Writes a flat vector straight into the parameters and buffers of a model, without building a state_dict.
+        :param model: nn.Module with the layout of the reference.
+        :param flat:
+        """
+        state_dict = model.state_dict(keep_vars=True)
+        with T.no_grad():
+            for key, shape, dtype, start, end in zip(self.keys, self.shapes, self.dtypes, self.offsets[:-1], self.offsets[1:]):
+                value = flat[start:end].reshape(shape)
+                state_dict[key].copy_(value.round() if not dtype.is_floating_point else value)
+
+
+class UpdateBuffer:
+    """
+    Buffered asynchronous aggregation (FedBuff). The updates arriving at the global model are kept, as the change each
+    one makes to the global version it was trained from, until there are buffer_size of them. Only then they are
+    merged into the global model:
+        global += server_lr * sum(s(staleness_i) * delta_i) / buffer_size,    s(t) = 1 / (1 + t)^alpha
+    The sum is divided by the number of updates and not by the sum of the weights, so a buffer of stale updates moves
+    the global model less.
+
+    Based on:
+    - https://arxiv.org/abs/2106.06639 | Federated Learning with Buffered Asynchronous Aggregation
+    - https://arxiv.org/abs/1903.03934 | Asynchronous Federated Optimization (staleness weights)
+    """
+
+    def __init__(self, aggregator, buffer_size=4, server_lr=1.0, staleness_alpha=0.5):
+        """
+        :param aggregator: FlatAggregator with the layout of the models.
+        :param buffer_size: updates merged at once.
+        :param server_lr: step size of the global model.
+        :param staleness_alpha:
+        """
+        self.aggregator = aggregator
+        self.buffer_size = max(1, buffer_size)
+        self.server_lr = server_lr
+        self.staleness_alpha = staleness_alpha
+        self.agents = []
+        self.deltas = []
+        self.staleness = []
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def add(self, agent, delta, staleness=0):
+        """
+        :param agent: who sent the update.
+        :param delta: flat change of the agent's model since the global version it started from.
+        :param staleness: how many global versions were published since that version.
+        """
+        self.agents.append(agent)
+        self.deltas.append(delta)
+        self.staleness.append(max(staleness, 0))
+
+    def ready(self):
+        return len(self.deltas) >= self.buffer_size
+
+    def merge(self, global_flat):
+        """
+        Applies the buffered updates and empties the buffer.
+        :param global_flat: the flat weights of the current global model.
+        :return: the new flat weights and the agents whose updates were merged.
+        """
+        weights = (1 + np.asarray(self.staleness, dtype=np.float32)) ** -self.staleness_alpha
+        weights = T.as_tensor(weights, device=self.aggregator.device)
+        step = weights @ self.aggregator.stack(self.deltas) / len(self.deltas)
+        merged = global_flat + self.server_lr * step
+        agents = self.agents
+        self.agents, self.deltas, self.staleness = [], [], []
+        return merged, agents
+
+
+def aggregation_weights(agents, mode="uniform", sample_counts=None, staleness=None, staleness_alpha=0.5):
+    """
+    Weights of each update in the aggregation.
+    :param agents: the agents that sent the updates, in order.
+    :param mode: "uniform", "samples" (proportional to the samples the agent trained on since the last aggregation) or
+    "staleness" (1 / (1 + staleness)^alpha, staleness being how many global versions the agent is behind).
+    :param sample_counts: dict agent -> samples, for "samples".
+    :param staleness: dict agent -> versions behind, for "staleness".
+    :param staleness_alpha:
+    :return: array with one weight per agent, or None for uniform.
+    """
+    if mode == "uniform":
+        return None
+    elif mode == "samples":
+        counts = np.array([sample_counts.get(agent, 0) for agent in agents], dtype=np.float32)
+        # Agents that sent an update without new samples still count, so the weights never sum to zero.
+        return np.maximum(counts, 1)
+    elif mode == "staleness":
+        behind = np.array([max(staleness.get(agent, 0), 0) for agent in agents], dtype=np.float32)
+        return (1 + behind) ** -staleness_alpha
+    else:
+        raise ValueError(f"Unknown aggregation weights {mode}")
@@ -0,0 +1,146 @@
+import math
+from collections import deque
+
+import numpy as np
+
+
+class CohortSelector:
+    """
+    Base selector, every agent takes part in every round. The selectors pick which agents train (and exchange models)
+    in the next round, so the cost of a round follows the size of the cohort and not the size of the fleet.
+    """
+
+    def __init__(self, fraction=1.0, min_agents=1, seed=None):
+        """
+        :param fraction: fraction of the agents picked each round.
+        :param min_agents: the cohort never gets smaller than this.
+        :param seed:
+        """
+        self.fraction = fraction
+        self.min_agents = min_agents
+        self.rng = np.random.default_rng(seed)
+
+    def cohort_size(self, n_agents):
+        return min(n_agents, max(self.min_agents, int(math.ceil(self.fraction * n_agents))))
+
+    def select(self, agents, env=None, losses=None, global_id=None):
+        """
+        :param agents: the agents that can take part.
+        :param env: the environment, for the selectors that look at the topology.
+        :param losses: dict agent -> last local loss.
+        :param global_id: the agent holding the global model.
+        :return: the cohort, in the order of agents.
+        """
+        return list(agents)
+
+    def keep_order(self, agents, picked):
+        # The trainers index the states by position in the cohort, the original order keeps that stable.
+        picked = set(picked)
+        return [agent for agent in agents if agent in picked]
+
+
+class UniformSelector(CohortSelector):
+    """
+    Uniform sampling without replacement of a fraction of the agents.
+
+    Based on:
+    - https://arxiv.org/abs/1602.05629 | Communication-Efficient Learning of Deep Networks from Decentralized Data
+    """
+
+    def select(self, agents, env=None, losses=None, global_id=None):
+        agents = list(agents)
+        picked = self.rng.choice(len(agents), size=self.cohort_size(len(agents)), replace=False)
+        return self.keep_order(agents, [agents[idx] for idx in picked])
+
+
+class PowerOfChoiceSelector(CohortSelector):
+    """
+    Power-of-choice: samples d candidates and keeps the ones with the highest local loss, which speeds up convergence
+    over uniform sampling. The losses are the last ones each agent reported, agents that never trained come first.
+    Actor-critic losses can be negative, so the candidates are ranked by the magnitude of the loss.
+
+    Based on:
+    - https://arxiv.org/abs/2010.01243 | Client Selection in Federated Learning: Convergence Analysis and
+     Power-of-Choice Selection Strategies
+    """
+
+    def __init__(self, fraction=1.0, min_agents=1, seed=None, candidates_factor=2):
+        """
+        :param candidates_factor: d = candidates_factor * cohort size candidates are sampled.
+        """
+        super().__init__(fraction, min_agents, seed)
+        self.candidates_factor = candidates_factor
+
+    def select(self, agents, env=None, losses=None, global_id=None):
+        agents = list(agents)
+        losses = losses if losses is not None else {}
+        size = self.cohort_size(len(agents))
+        n_candidates = min(len(agents), max(size, int(self.candidates_factor * size)))
+        candidates = [agents[idx] for idx in self.rng.choice(len(agents), size=n_candidates, replace=False)]
+        candidates.sort(key=lambda agent: abs(losses[agent]) if losses.get(agent) is not None else math.inf, reverse=True)
+        return self.keep_order(agents, candidates[:size])
+
+
+class LatencyAwareSelector(CohortSelector):
+    """
+    Picks the agents that can exchange models with the global model cheaply. Agents whose updates can't reach the
+    global model (none of their controller neighbours is the global) are left out, the others are sampled with
+    probability 1 / (1 + hops), hops being the length of the shortest path to the global in env.neighbourMatrix.
+    """
+
+    def select(self, agents, env=None, losses=None, global_id=None):
+        agents = list(agents)
+        if env is None or global_id is None:
+            return agents
+        global_node = int(global_id.split('_')[1])
+        hops = self.hops_to(env.neighbourMatrix, global_node)
+        available = [agent for agent in agents if self.reaches(env, int(agent.split('_')[1]), global_node)]
+        if not available:
+            return agents
+        size = min(len(available), self.cohort_size(len(agents)))
+        weights = np.array([1 / (1 + hops.get(int(agent.split('_')[1]), len(hops))) for agent in available])
+        picked = self.rng.choice(len(available), size=size, replace=False, p=weights / weights.sum())
+        return self.keep_order(agents, [available[idx] for idx in picked])
+
+    def reaches(self, env, node, global_node):
+        # Same check as the global-up pairings in FLAgent.generate_pairings.
+        if node == global_node:
+            return True
+        neighbourhood = env.neighbourMatrix[node]
+        return any(global_node == neighbourhood[idx] for idx in env.whichControllersMatrix[node])
+
+    def hops_to(self, neighbour_matrix, target):
+        """
+        :return: dict node -> hops to target, breadth first over the neighbourhoods.
+        """
+        hops = {target: 0}
+        queue = deque([target])
+        while queue:
+            node = queue.popleft()
+            for neighbour in neighbour_matrix[node]:
+                neighbour = int(neighbour)
+                if neighbour not in hops:
+                    hops[neighbour] = hops[node] + 1
+                    queue.append(neighbour)
+        return hops
+
+
+def make_cohort_selector(name, fraction=1.0, min_agents=1, seed=None, candidates_factor=2):
+    """
+    :param name: "all", "uniform", "power_of_choice" or "latency".
+    :param fraction:
+    :param min_agents:
+    :param seed:
+    :param candidates_factor: for power_of_choice.
+    :return: CohortSelector
+    """
+    if name is None or name == "all":
+        return CohortSelector(fraction, min_agents, seed)
+    elif name == "uniform":
+        return UniformSelector(fraction, min_agents, seed)
+    elif name == "power_of_choice":
+        return PowerOfChoiceSelector(fraction, min_agents, seed, candidates_factor)
+    elif name == "latency":
+        return LatencyAwareSelector(fraction, min_agents, seed)
+    else:
+        raise ValueError(f"Unknown cohort selection {name}")
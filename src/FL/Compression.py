@@ -0,0 +1,162 @@
+import math
+
+import torch as T
+
+
+class CompressedTensor:
+    """
+    Payload of a compressed flat vector. Keeps what would go through the network and knows how to rebuild the
+    vector.
+    """
+    __slots__ = ('kind', 'numel', 'data', 'scales', 'indices')
+
+    def __init__(self, kind, numel, data, scales=None, indices=None):
+        self.kind = kind
+        self.numel = numel
+        self.data = data
+        self.scales = scales
+        self.indices = indices
+
+    def decompress(self):
+        if self.kind == "fp16":
+            return self.data.float()
+        if self.kind == "int8":
+            chunk = self.data.numel() // self.scales.numel()
+            return (self.data.float().reshape(-1, chunk) * self.scales.unsqueeze(1)).reshape(-1)[:self.numel]
+        if self.kind == "topk":
+            values = self.data.decompress() if isinstance(self.data, CompressedTensor) else self.data.float()
+            out = T.zeros(self.numel, dtype=T.float, device=values.device)
+            out[self.indices.long()] = values
+            return out
+        raise ValueError(f"Unknown payload {self.kind}")
+
+    def nbytes(self):
+        size = self.data.nbytes() if isinstance(self.data, CompressedTensor) else self.data.numel() * self.data.element_size()
+        for extra in (self.scales, self.indices):
+            if extra is not None:
+                size += extra.numel() * extra.element_size()
+        return size
+
+
+class Compressor:
+    """
+    Base compressor, sends the vector as it is. The compressors work on flat float32 vectors, the deltas of UpdateCodec.
+    """
+    # Whether the compressor can be used on full weights and not only on deltas.
+    applies_to_full = True
+
+    def compress(self, x, key=None):
+        """
+        :param x: flat vector.
+        :param key: who is sending, for the compressors that keep state per sender.
+        :return: CompressedTensor or the vector itself.
+        """
+        return x
+
+    def reset(self, key=None):
+        pass
+
+
+class Float16Compressor(Compressor):
+    def compress(self, x, key=None):
+        return CompressedTensor("fp16", x.numel(), x.half())
+
+
+class Int8Compressor(Compressor):
+    """
+    Symmetric int8 quantization, with one float32 scale per chunk of the vector so a few large entries don't wash out
+    the rest.
+    """
+
+    def __init__(self, chunk_size=256):
+        self.chunk_size = chunk_size
+
+    def compress(self, x, key=None):
+        numel = x.numel()
+        n_chunks = math.ceil(numel / self.chunk_size)
+        padded = T.zeros(n_chunks * self.chunk_size, dtype=T.float, device=x.device)
+        padded[:numel] = x
+        chunks = padded.reshape(n_chunks, self.chunk_size)
+        scales = chunks.abs().amax(dim=1).clamp_min(1e-12) / 127
+        data = T.round(chunks / scales.unsqueeze(1)).clamp_(-127, 127).to(T.int8).reshape(-1)
+        return CompressedTensor("int8", numel, data, scales=scales)
+
+
+class TopKCompressor(Compressor):
+    """
+    Top-k sparsification with error feedback. Only the k entries with the largest magnitude are sent, what was left out
+    is kept in a residual per sender and added to its next update, so nothing is lost, only delayed.
+
+    Based on:
+    - https://arxiv.org/abs/1809.07599 | Sparsified SGD with Memory
+    - https://arxiv.org/abs/1901.09847 | Error Feedback Fixes SignSGD and other Gradient Compression Schemes
+    """
+    # Sparsifying the full weights would zero most of the model.
+    applies_to_full = False
+
+    def __init__(self, ratio=0.01, error_feedback=True, value_compressor=None):
+        """
+        :param ratio: fraction of the entries sent.
+        :param error_feedback:
+        :param value_compressor: optional compressor for the values kept, e.g. Int8Compressor.
+        """
+        self.ratio = ratio
+        self.error_feedback = error_feedback
+        self.value_compressor = value_compressor
+        self.residuals = {}
+
+    def compress(self, x, key=None):
+        residual = self.residuals.get(key) if self.error_feedback else None
+        if residual is not None:
+            x = x + residual
+        k = max(1, int(x.numel() * self.ratio))
+        indices = T.topk(x.abs(), k, sorted=False).indices
+        values = x[indices]
+        data = values if self.value_compressor is None else self.value_compressor.compress(values)
+        payload = CompressedTensor("topk", x.numel(), data, indices=indices.to(T.int32))
+        if self.error_feedback:
+            sent = payload.decompress()
+            self.residuals[key] = x - sent
+        return payload
+
+    def reset(self, key=None):
+        if key is None:
+            self.residuals = {}
+        else:
+            self.residuals.pop(key, None)
+
+
+def make_compressor(name, topk_ratio=0.01, int8_chunk_size=256):
+    """
+    :param name: "none", "fp16", "int8", "topk" or "topk_int8" (top-k with the values quantized).
+    :param topk_ratio:
+    :param int8_chunk_size:
+    :return: Compressor
+    """
+    if name is None or name == "none":
+        return Compressor()
+    elif name == "fp16":
+        return Float16Compressor()
+    elif name == "int8":
+        return Int8Compressor(int8_chunk_size)
+    elif name == "topk":
+        return TopKCompressor(topk_ratio)
+    elif name == "topk_int8":
+        return TopKCompressor(topk_ratio, value_compressor=Int8Compressor(int8_chunk_size))
+    else:
+        raise ValueError(f"Unknown compressor {name}")
+
+
+def payload_nbytes(update):
+    """
+    Size estimate of what is sent through env.post_updates.
+    :param update: DeltaUpdate, CompressedTensor, tensor or state_dict.
+    :return: bytes
+    """
+    if hasattr(update, 'nbytes') and callable(update.nbytes):
+        return update.nbytes()
+    if isinstance(update, T.Tensor):
+        return update.numel() * update.element_size()
+    if isinstance(update, dict):
+        return sum(payload_nbytes(value) for value in update.values())
+    return 0
@@ -1,4 +1,7 @@
+import math
+import os
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch.optim
@@ -10,10 +13,19 @@ from src.Utils import utils as fl
 from abc import ABC, abstractmethod
 from src.Utils import utils
 from src.Utils.printHelper import bcolors
+from src.FL.Aggregator import FlatAggregator, aggregation_weights
+from src.FL.UpdateCodec import UpdateCodec, DeltaUpdate
+from src.FL.Compression import make_compressor, payload_nbytes
+from src.FL.CohortSelection import make_cohort_selector
+from src.FL.Regularization import ProximalTerm, ScaffoldControl
+from src.FL.ModelPool import AgentModelPool
+from src.Utils.EtherTopologyReader import get_link_info
 
-import copy
 
 class FLAgent(ABC):
+    # Weight of the FedProx proximal term when args has no 'mu', the trainers override it with their own default.
+    DEFAULT_MU = 0.01
+
     def __init__(self, args):
         self.data_collector = None
         self.round_size = args.get('round_size', 1000)
@@ -30,6 +42,56 @@ class FLAgent(ABC):
         self.no_rounds = args.get('no_rounds', 10)
         self.agents = args.get('agents')
         self.global_id = args.get('global_id', "worker_0")
+        # How the updates are weighted when aggregated: "uniform", "samples" or "staleness", see aggregation_weights.
+        self.aggregation_weights = args.get('aggregation_weights', "uniform")
+        self.staleness_alpha = args.get('staleness_alpha', 0.5)
+        self.sample_counts = {}  # Samples each agent trained on since its last update was aggregated.
+        self.aggregator = None
+        # The updates are sent as deltas against the global version each agent acknowledged, see UpdateCodec.
+        self.codec = None
+        self.acked_versions = {}
+        # Compression of the updates: "none", "fp16", "int8", "topk" or "topk_int8", see Compression.make_compressor.
+        self.upload_compression = args.get('upload_compression', "none")
+        self.download_compression = args.get('download_compression', "none")
+        self.topk_ratio = args.get('topk_ratio', 0.01)
+        self.comm_bytes = 0  # Estimated bytes posted to the environment.
+        # Local training of the cohort runs in a thread pool, torch releases the GIL in its ops. 1 disables it.
+        self.train_workers = args.get('train_workers', os.cpu_count())
+        self.train_pool = None
+        # Steps after which each receiver got its updates the last time it waited, to predict the next arrivals.
+        self.arrival_ticks = {}
+        # Ether topology file the environment was built from, see EtherTopologyReader. The arrival of each update is
+        # predicted from the expected rtt and the min bandwidth of its path, with ms_per_step simulated milliseconds
+        # per env step.
+        self.link_info = get_link_info(args['topology_file']) if args.get('topology_file') else {}
+        self.ms_per_step = args.get('ms_per_step', 1.0)
+        # Which agents take part in each round: "all", "uniform", "power_of_choice" or "latency", see CohortSelection.
+        self.cohort_selector = make_cohort_selector(args.get('cohort_selection', "all"),
+                                                    fraction=args.get('cohort_fraction', 1.0),
+                                                    min_agents=args.get('cohort_min_agents', 1),
+                                                    seed=args.get('cohort_seed'),
+                                                    candidates_factor=args.get('cohort_candidates_factor', 2))
+        self.agent_losses = {}  # Last local loss of each agent, for the power of choice selection.
+        # Hierarchical aggregation: dict agent (or node index) -> its cluster head, see EtherTopologyReader.get_cluster_heads.
+        # The agents aggregate with their head every round, and only the heads exchange with the global model every
+        # global_sync_rounds rounds. Empty keeps the flat aggregation. Only used by the sync trainers.
+        self.cluster_heads = {self.agent_name(node): self.agent_name(head)
+                              for node, head in (args.get('cluster_heads') or {}).items()}
+        self.global_sync_rounds = args.get('global_sync_rounds', 1)
+        self.cluster_models = {}  # head -> flat weights of the cluster model.
+        self.cluster_versions = {}  # head -> global version its cluster model started from.
+        self.cluster_weights = {}  # head -> aggregation weight of the cluster since the last global sync.
+        self.cluster_rounds = 0
+        self.cluster_update_cache = {}
+        # Weight of the FedProx proximal term, used by the FedProx trainers and by align_algorithm "FedProx". Only read
+        # here, the default of each trainer is its DEFAULT_MU.
+        self.mu = args.get('mu', self.DEFAULT_MU)
+        self.proximal = None
+        self.scaffold = None  # SCAFFOLD control variates, for align_algorithm "FedScaffold".
+        # Agent models are built when first used, and the idle ones are packed (in memory, or memory-mapped in
+        # model_offload_dir) once the materialized models go over model_memory_budget bytes. See ModelPool.
+        self.model_memory_budget = args.get('model_memory_budget')
+        self.model_offload_dir = args.get('model_offload_dir')
         if self.collect_data:
             print("Saving Data to CSV" + self.file_name + '.csv')
             self.data_collector.save_to_csv(self.file_name + '.csv')
@@ -47,34 +109,193 @@ class FLAgent(ABC):
     def train_loop(self, env: PeersimEnv, num_episodes, print_instead=False, controllers=None, global_id="worker_0",steps_per_synch=500):
         pass
 
-    @abstractmethod
+    @staticmethod
+    def agent_name(node):
+        return node if isinstance(node, str) else f"worker_{node}"
+
     def get_update_from_agent(self, agent):
-        pass
-    def get_update_from_global(self,):
-        pass
+        """
+        :param agent:
+        :return: DeltaUpdate with the agent's weights, relative to the last global version it received.
+        """
+        return self.get_codec().encode_model(self.models[agent], self.acked_versions.get(agent), key=agent)
+
+    def get_update_from_global(self, agent=None):
+        """
+        :param agent: the receiver.
+        :return: DeltaUpdate with the latest global model, relative to the global version the receiver holds. Receivers
+        holding the same version get the same object.
+        """
+        return self.get_codec().encode_global(self.acked_versions.get(agent))
     @abstractmethod
     def set_agent_model(self, agent, model):
         pass
 
 
 
-    def fed_avg_align(self, updates_for_agent, base_model=None):
+    def fed_avg_align(self, updates_for_agent, base_model=None, weights=None):
+        """
+        Averages the updates and returns the result as a state_dict.
+        :param updates_for_agent: list with the updates of each agent, only the first update of each is used.
+        :param base_model: state_dict with the layout of the updates, defaults to the first update.
+        :param weights: one weight per agent, uniform when None.
+        :return:
+        """
         print(f"{bcolors.WARNING}Integrating updates...{bcolors.ENDC}")
-        averaged_weights = OrderedDict() if base_model is None else copy.deepcopy(base_model)
-        no_ups = len(updates_for_agent)
-        # Code from: https://github.com/Chelsiehi/FedAvg-Algorithm/blob/main/run.md
-        for idx, u in enumerate(updates_for_agent):
-            update = u[0]
-            for key in update.keys():
-                if idx == 0:
-                    averaged_weights[key] = 1 / no_ups * update[key]  # TODO: Use coefficients for each agent instead of this... This is just dumb...
-                else:
-                    averaged_weights[key] += 1 / no_ups * update[key]  # TODO: Equally as dumb as the above line...
-        if no_ups == 0:
+        updates = [u[0] for u in updates_for_agent]
+        if len(updates) == 0:
             return OrderedDict()
-        return averaged_weights
+        aggregator = self.get_aggregator(updates[0] if base_model is None else base_model)
+        return aggregator.unflatten(aggregator.aggregate([self.decode_update(u) for u in updates], weights))
+
+    def fed_avg_into(self, model, local_solutions):
+        """
+        Averages the updates and writes the result straight into the parameters of model (normally the global model).
+        The updates are weighted according to self.aggregation_weights.
+        :param model:
+        :param local_solutions: dict agent -> list of updates, only the first update of each agent is used.
+        :return: False if there was nothing to aggregate.
+        """
+        print(f"{bcolors.WARNING}Integrating updates...{bcolors.ENDC}")
+        agents = list(local_solutions.keys())
+        if len(agents) == 0:
+            return False
+        aggregator = self.get_aggregator(model.state_dict())
+        weights = aggregation_weights(agents, self.aggregation_weights, sample_counts=self.sample_counts,
+                                      staleness=self.get_staleness(), staleness_alpha=self.staleness_alpha)
+        aggregated = aggregator.aggregate([self.decode_update(local_solutions[agent][0]) for agent in agents], weights)
+        aggregator.write(model, aggregated)
+        if model is getattr(self, 'global_model', None):
+            self.publish_global(aggregated)
+        for agent in agents:
+            self.sample_counts[agent] = 0
+        return True
+
+    def get_aggregator(self, reference_state_dict):
+        # All the models share the same architecture, so the layout is only computed once.
+        if self.aggregator is None:
+            self.aggregator = FlatAggregator(reference_state_dict)
+        return self.aggregator
+
+    def publish_global(self, flat):
+        """
+        Called whenever the global model changes: registers the new version in the codec and moves the FedProx anchor.
+        :param flat: the flat weights just written into the global model.
+        """
+        if self.codec is None:
+            self.get_codec()  # Publishes the current global model.
+        else:
+            self.codec.publish(flat)
+        if self.proximal is not None:
+            self.proximal.snapshot(self.global_model)
+
+    def get_codec(self):
+        if self.codec is None:
+            aggregator = self.get_aggregator(self.global_model.state_dict())
+            # The global update is shared by many receivers, so error feedback can't be kept for it.
+            download_compressor = make_compressor(self.download_compression, topk_ratio=self.topk_ratio)
+            if hasattr(download_compressor, 'error_feedback'):
+                download_compressor.error_feedback = False
+            self.codec = UpdateCodec(aggregator,
+                                     upload_compressor=make_compressor(self.upload_compression, topk_ratio=self.topk_ratio),
+                                     download_compressor=download_compressor)
+            self.codec.publish(aggregator.flatten(self.global_model.state_dict()))
+        return self.codec
+
+    def decode_update(self, update):
+        """
+        :param update: DeltaUpdate, or a plain state_dict.
+        :return: the flat weights.
+        """
+        if isinstance(update, DeltaUpdate):
+            return update.decode()
+        return self.get_aggregator(update).flatten(update)
+
+    def update_delta(self, agent, update):
+        """
+        The change an update from an agent makes to the global version it was trained from.
+        :param agent: the sender.
+        :param update: DeltaUpdate, or a plain state_dict.
+        :return: the flat delta and how many global versions were published since its base version. (None, None) if the
+        agent never got the global model, its weights are not a change of any global version.
+        """
+        codec = self.get_codec()
+        base_version = getattr(update, 'base_version', None)
+        if base_version is not None:
+            return update.decode_delta(), codec.version - base_version
+        acked = self.acked_versions.get(agent)
+        if acked is None:
+            return None, None
+        # Full weights because the version of the agent is no longer kept, the delta is taken against the latest one.
+        return self.decode_update(update) - codec.versions[codec.version], codec.version - acked
+
+    def load_update(self, agent, update):
+        """
+        Loads an update received from the global model into the agent's model, and records the global version the
+        agent holds now.
+        :param agent:
+        :param update: DeltaUpdate, or a plain state_dict.
+        """
+        self.get_aggregator(self.models[agent].state_dict()).write(self.models[agent], self.decode_update(update))
+        if getattr(update, 'version', None) is not None:
+            self.acked_versions[agent] = update.version
+        if self.align_algorithm == "FedScaffold":
+            self.get_scaffold().start_round(agent, self.models[agent])
+
+    def map_agents(self, fn, agents):
+        """
+        Runs fn(agent) for every agent, in parallel when train_workers > 1. Each agent only touches its own model, so
+        the forward/backward passes of the agents can overlap.
+        :param fn:
+        :param agents:
+        :return: dict agent -> result
+        """
+        agents = list(agents)
+        if self.train_workers <= 1 or len(agents) <= 1:
+            return {agent: fn(agent) for agent in agents}
+        if self.train_pool is None:
+            self.train_pool = ThreadPoolExecutor(max_workers=self.train_workers)
+        return dict(zip(agents, self.train_pool.map(fn, agents)))
+
+    def post_updates(self, env, agents, updates, srcs, dsts):
+        """
+        Posts the updates to the environment, keeping track of the estimated size of what is sent.
+        """
+        self.comm_bytes += sum(payload_nbytes(update) for update in updates)
+        env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
+
+    def get_staleness(self):
+        """
+        :return: dict agent -> number of global versions the agent is behind. Only the async trainers track this.
+        """
+        return {}
+
+    def select_cohort(self, agent_list, env=None):
+        """
+        Picks the agents that train in the next round, according to the cohort selection in the args. Their models are
+        materialized and kept in memory for the round.
+        :param agent_list:
+        :param env:
+        :return: the cohort, in the order of agent_list.
+        """
+        cohort = self.cohort_selector.select(agent_list, env=env, losses=self.agent_losses, global_id=self.global_id)
+        if isinstance(self.models, AgentModelPool):
+            self.models.retain(cohort)
+        return cohort
 
-    def generate_pairings(self, cohort, controllers, type="all", neighbourhoodMatrix=None):
+    def make_model_pool(self, factory, agents):
+        """
+        :param factory: builds the model of an agent.
+        :param agents:
+        :return: AgentModelPool following model_memory_budget and model_offload_dir.
+        """
+        return AgentModelPool(factory, agents, memory_budget=self.model_memory_budget, offload_dir=self.model_offload_dir)
+
+    def count_samples(self, agent_list):
+        for agent in agent_list:
+            self.sample_counts[agent] = self.sample_counts.get(agent, 0) + 1
+
+    def generate_pairings(self, cohort, controllers, type="all", neighbourhoodMatrix=None, target_id=None, update_fn=None):
         """
         Generates pairings for the agents in the cohort, aka defines who sends what to whom.
         Currently there are two types of supported pairings:
@@ -87,6 +308,9 @@ class FLAgent(ABC):
         :param controllers: List of indexes of known controllers for each agent.
         :param type: the pairing mechanism to use.
         :param neighbourhoodMatrix: the neighbourhood matrix to help the pairing mechanism.
+        :param target_id: the agent that plays the part of the global model in global-up/global-down, defaults to
+        global_id. Used for the cluster heads of the hierarchical aggregation.
+        :param update_fn: optional function agent -> update, replaces get_update_from_agent/get_update_from_global.
         :return:
         """
         # Each agent sends their updates to all the others
@@ -116,9 +340,9 @@ class FLAgent(ABC):
                 dsts.append(neighbour_idx)
                 updates.append(update)
         elif type == "global-up":
-            global_id_network = int(self.global_id.split('_')[1])
+            global_id_network = int((target_id or self.global_id).split('_')[1])
             for agent in cohort:
-                update = self.get_update_from_agent(agent)
+                update = update_fn(agent) if update_fn is not None else self.get_update_from_agent(agent)
                 agent_id = int(agent.split('_')[1])
                 neighbours = controllers[agent_id]
                 neighbourhood = neighbourhoodMatrix[agent_id]
@@ -129,14 +353,15 @@ class FLAgent(ABC):
                         dsts.append(neighbour_idx)
                         updates.append(update)
         elif type == "global-down":
-            global_id_network = int(self.global_id.split('_')[1])
+            sender = target_id or self.global_id
+            global_id_network = int(sender.split('_')[1])
             for agent in cohort:
-                update = self.get_update_from_global()
+                update = update_fn(agent) if update_fn is not None else self.get_update_from_global(agent)
                 agent_id = int(agent.split('_')[1])
                 g_neighbourhood = controllers[global_id_network]
                 for neighbour_idx in g_neighbourhood:
                     if neighbour_idx == agent_id:
-                        agents.append(self.global_id)
+                        agents.append(sender)
                         srcs.append(global_id_network)
                         dsts.append(neighbour_idx)
                         updates.append(update)
@@ -145,14 +370,84 @@ class FLAgent(ABC):
 
     def align_weights(self, weights, base_model_state_dict=None):
         match self.align_algorithm:
-            case "FedAvg":
+            case "FedAvg" | "FedProx" | "FedScaffold":
+                # FedProx and SCAFFOLD change the local training, their aggregation of the weights is FedAvg's.
                 return self.fed_avg_align(weights, base_model_state_dict)
-            case "FedProx":
-                raise NotImplementedError("FedProx not implemented yet")
-                # return fl.fed_prox_align(weights)
+            case _:
+                raise NotImplementedError(f"{self.align_algorithm} not implemented")
+
+    def align_into(self, model, local_solutions):
+        """
+        Same as align_weights, but the result is written straight into model.
+        :param model:
+        :param local_solutions: dict agent -> list of updates.
+        :return: False if there was nothing to aggregate.
+        """
+        match self.align_algorithm:
+            case "FedAvg" | "FedProx":
+                # The FedProx anchor follows the global model, see publish_global.
+                return self.fed_avg_into(model, local_solutions)
             case "FedScaffold":
-                raise NotImplementedError("FedScaffold not implemented yet")
+                if not self.fed_avg_into(model, local_solutions):
+                    return False
+                self.update_control_variates(list(local_solutions.keys()))
+                return True
+            case _:
+                raise NotImplementedError(f"{self.align_algorithm} not implemented")
+
+    def get_proximal(self):
+        if self.proximal is None:
+            self.proximal = ProximalTerm(self.mu)
+            self.proximal.snapshot(self.global_model, device=getattr(self.global_model, 'device', None))
+        return self.proximal
+
+    def proximal_term(self, agent):
+        """
+        :param agent:
+        :return: FedProx proximal term of the agent's model against the latest global model.
+        """
+        return self.get_proximal()(self.models[agent])
+
+    def local_regularization(self, agent):
+        """
+        Extra loss term of the local training for the align_algorithm, added in learn() before backward().
+        :param agent:
+        :return: the proximal term for "FedProx", 0 otherwise.
+        """
+        return self.proximal_term(agent) if self.align_algorithm == "FedProx" else 0
+
+    def correct_gradients(self, agent):
+        """
+        SCAFFOLD gradient correction, called in learn() between backward() and the optimizer step. No-op for the other
+        align_algorithms.
+        :param agent:
+        """
+        if self.align_algorithm == "FedScaffold":
+            self.get_scaffold().correct(agent, self.models[agent])
 
+    def get_scaffold(self):
+        if self.scaffold is None:
+            self.scaffold = ScaffoldControl(self.global_model)
+        return self.scaffold
+
+    def update_control_variates(self, agents):
+        """
+        Updates the SCAFFOLD variates of the agents whose updates were aggregated, and the server variate. The agents
+        would send c_i+ - c_i with their weights and get c with the global model, so both are counted in comm_bytes.
+        :param agents:
+        """
+        if self.align_algorithm != "FedScaffold":
+            return
+        scaffold = self.get_scaffold()
+        deltas = []
+        for agent in agents:
+            if agent in self.models:
+                lr = self.models[agent].optimizer.param_groups[0]['lr']
+                delta = scaffold.end_round(agent, self.models[agent], lr)
+                if delta is not None:
+                    deltas.append(delta)
+        scaffold.update_server(deltas, len(self.models))
+        self.comm_bytes += 2 * len(deltas) * scaffold.server.nbytes
 
     def sync_upload_local_solutions(self, cohort, env, global_id):
         """
@@ -164,24 +459,16 @@ class FLAgent(ABC):
         :return:
         """
         agents, srcs, dsts, updates = self.generate_pairings(cohort, env.whichControllersMatrix, type="global-up", neighbourhoodMatrix=env.neighbourMatrix)
-        env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
+        predictions = self.predict_arrivals(env, [global_id], srcs, dsts, updates)
+        self.post_updates(env, agents, updates, srcs, dsts)
 
+        received, steps_comm, stopped = self.await_updates(env, {global_id: len(agents)}, predictions)
+        if stopped:
+            print("Simulation Stopped, dropping last round.")
+            return None, steps_comm
         local_solutions = {}
-        received_updates = []
-        steps_comm = 0
-        while len(received_updates) < len(cohort):
-            updates = env.get_updates(global_id)
-            for update in updates:
-                received_updates.append(update)
-                if update['agent'] in local_solutions:
-                    local_solutions[update['agent']].append(update['update'])
-                else:
-                    local_solutions[update['agent']] = [update['update']]
-            observations, rewards, terminations, truncations, info = env.step({})
-            steps_comm += 1
-            if utils.is_done(terminations):
-                print("Simulation Stopped, dropping last round.")
-                return None, steps_comm
+        for update in received[global_id]:
+            local_solutions.setdefault(update['agent'], []).append(update['update'])
         return local_solutions, steps_comm
 
     def sync_download_global_solution(self, cohort, env, global_id):
@@ -193,31 +480,311 @@ class FLAgent(ABC):
         :param global_id:
         :return:
         """
-        ticks_after_first_weight = 0
         agents, srcs, dsts, updates = self.generate_pairings(cohort, env.whichControllersMatrix, type="global-down", neighbourhoodMatrix=env.neighbourMatrix)
-        env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
+        predictions = self.predict_arrivals(env, cohort, srcs, dsts, updates)
+        self.post_updates(env, agents, updates, srcs, dsts)
 
-        synched_global = []
-        while len(synched_global) != len(cohort):
-            for agent in cohort:
-                # Pool the environment to see if the agents got the global update.
-                # Guarantee they all received updates.
-                global_models = env.get_updates(agent)
-                if len(global_models) > 0:
-                    for model in global_models:
-                        self.clear_agent_memory(agent)  # Clear stale entries when next iter. Could be using wrong action probs.
-                        self.models[agent].load_state_dict(model['update'])
-                        self.models[agent].optimizer = torch.optim.AdamW(self.models[agent].parameters(), self.models[agent].lr)
-                        synched_global.append(agent)
-                if len(synched_global) == len(cohort):
-                    break
-                observations, rewards, terminations, truncations, info = env.step({})
-                if utils.is_done(terminations):
-                    print("Simulation Stopped, dropping last round.")
-                    return False, ticks_after_first_weight
-            ticks_after_first_weight += 1
+        received, ticks_after_first_weight, stopped = self.await_updates(env, {agent: 1 for agent in cohort}, predictions)
+        if stopped:
+            print("Simulation Stopped, dropping last round.")
+            return False, ticks_after_first_weight
+        for agent in cohort:
+            for model in received[agent]:
+                self.receive_model(agent, model['update'])
         return True, ticks_after_first_weight
 
+    def receive_model(self, agent, update):
+        """
+        Replaces the model of an agent with the (global or cluster) model sent to it.
+        :param agent:
+        :param update:
+        """
+        self.clear_agent_memory(agent)  # Clear stale entries when next iter. Could be using wrong action probs.
+        self.load_update(agent, update)
+        self.models[agent].optimizer = torch.optim.AdamW(self.models[agent].parameters(), self.models[agent].lr)
+
+    def clusters_of(self, cohort):
+        """
+        :param cohort:
+        :return: dict cluster head -> agents of the cohort in its cluster. The agents without a head are in the cluster
+        of the global model.
+        """
+        clusters = {}
+        for agent in cohort:
+            clusters.setdefault(self.cluster_heads.get(agent, self.global_id), []).append(agent)
+        return clusters
+
+    def get_cluster_model(self, head):
+        # The clusters start from the global model.
+        if head not in self.cluster_models:
+            codec = self.get_codec()
+            self.cluster_models[head] = codec.versions[codec.version]
+            self.cluster_versions[head] = codec.version
+        return self.cluster_models[head]
+
+    def get_update_from_head(self, head, agent):
+        """
+        :param head:
+        :param agent: the receiver.
+        :return: DeltaUpdate with the cluster model of head, shared by the members holding the same global version.
+        """
+        codec = self.get_codec()
+        key = (head, self.acked_versions.get(agent))
+        if key not in self.cluster_update_cache:
+            self.cluster_update_cache[key] = codec.encode(self.get_cluster_model(head), self.acked_versions.get(agent),
+                                                          compressor=codec.download_compressor)
+        return self.cluster_update_cache[key]
+
+    def sync_download_cluster_solution(self, cohort, env):
+        """
+        Hierarchical version of sync_download_global_solution, each agent gets the model of its cluster from its
+        cluster head, which loads it directly.
+        :param cohort:
+        :param env:
+        :return: whether it completed, and the steps it took.
+        """
+        self.cluster_update_cache = {}
+        senders, srcs, dsts, updates, members_waiting = [], [], [], [], []
+        for head, members in self.clusters_of(cohort).items():
+            if head in members:
+                self.receive_model(head, self.get_update_from_head(head, head))
+            remote = [agent for agent in members if agent != head]
+            pairing = self.generate_pairings(remote, env.whichControllersMatrix, type="global-down",
+                                             neighbourhoodMatrix=env.neighbourMatrix, target_id=head,
+                                             update_fn=lambda agent: self.get_update_from_head(head, agent))
+            for collected, new in zip((senders, srcs, dsts, updates), pairing):
+                collected.extend(new)
+            members_waiting.extend(remote)
+        predictions = self.predict_arrivals(env, members_waiting, srcs, dsts, updates)
+        self.post_updates(env, senders, updates, srcs, dsts)
+
+        received, ticks, stopped = self.await_updates(env, {agent: 1 for agent in members_waiting}, predictions)
+        if stopped:
+            print("Simulation Stopped, dropping last round.")
+            return False, ticks
+        for agent in members_waiting:
+            for model in received[agent]:
+                self.receive_model(agent, model['update'])
+        return True, ticks
+
+    def sync_aggregate_clusters(self, cohort, env):
+        """
+        Hierarchical version of sync_upload_local_solutions + aggregation. The agents send their models to their
+        cluster heads, which aggregate them into the cluster model. Every global_sync_rounds rounds the heads then
+        exchange the cluster models with the global model (sync_clusters_with_global), so only the heads use the
+        long links.
+        :param cohort:
+        :param env:
+        :return: whether it completed, and the steps it took.
+        """
+        aggregator = self.get_aggregator(self.global_model.state_dict())
+        clusters = self.clusters_of(cohort)
+        senders, srcs, dsts, updates, expected = [], [], [], [], {}
+        for head, members in clusters.items():
+            remote = [agent for agent in members if agent != head]
+            pairing = self.generate_pairings(remote, env.whichControllersMatrix, type="global-up",
+                                             neighbourhoodMatrix=env.neighbourMatrix, target_id=head)
+            for collected, new in zip((senders, srcs, dsts, updates), pairing):
+                collected.extend(new)
+            expected[head] = len(pairing[0])
+        predictions = self.predict_arrivals(env, list(expected), srcs, dsts, updates)
+        self.post_updates(env, senders, updates, srcs, dsts)
+
+        received, steps_comm, stopped = self.await_updates(env, expected, predictions)
+        if stopped:
+            print("Simulation Stopped, dropping last round.")
+            return False, steps_comm
+        print(f"{bcolors.WARNING}Integrating updates in {len(clusters)} clusters...{bcolors.ENDC}")
+        for head, members in clusters.items():
+            local_solutions = {message['agent']: self.decode_update(message['update']) for message in received[head]}
+            if head in members:
+                local_solutions[head] = aggregator.flatten(self.models[head].state_dict())
+            if not local_solutions:
+                continue
+            agents = list(local_solutions.keys())
+            weights = aggregation_weights(agents, self.aggregation_weights, sample_counts=self.sample_counts,
+                                          staleness=self.get_staleness(), staleness_alpha=self.staleness_alpha)
+            self.get_cluster_model(head)
+            self.cluster_models[head] = aggregator.aggregate([local_solutions[agent] for agent in agents], weights)
+            # A cluster weighs what its agents would have weighed in a flat aggregation.
+            self.cluster_weights[head] = self.cluster_weights.get(head, 0) + (float(np.sum(weights)) if weights is not None else len(agents))
+            for agent in agents:
+                self.sample_counts[agent] = 0
+            self.update_control_variates(agents)
+
+        self.cluster_rounds += 1
+        if self.cluster_rounds % self.global_sync_rounds != 0:
+            return True, steps_comm
+        completed, steps_global = self.sync_clusters_with_global(env, list(self.cluster_models.keys()))
+        return completed, steps_comm + steps_global
+
+    def sync_clusters_with_global(self, env, heads):
+        """
+        Upper tier of the hierarchical aggregation. The heads send their cluster models to the global model, which
+        averages them (weighted by cluster_weights) and sends the new global model back to the heads.
+        :param env:
+        :param heads:
+        :return: whether it completed, and the steps it took.
+        """
+        codec = self.get_codec()
+        aggregator = self.get_aggregator(self.global_model.state_dict())
+        remote = [head for head in heads if head != self.global_id]
+        agents, srcs, dsts, updates = self.generate_pairings(
+            remote, env.whichControllersMatrix, type="global-up", neighbourhoodMatrix=env.neighbourMatrix,
+            update_fn=lambda head: codec.encode(self.cluster_models[head], self.cluster_versions.get(head),
+                                                compressor=codec.upload_compressor, key=('cluster', head)))
+        predictions = self.predict_arrivals(env, [self.global_id], srcs, dsts, updates)
+        self.post_updates(env, agents, updates, srcs, dsts)
+        received, steps_up, stopped = self.await_updates(env, {self.global_id: len(agents)}, predictions)
+        if stopped:
+            print("Simulation Stopped, dropping last round.")
+            return False, steps_up
+
+        cluster_solutions = {message['agent']: self.decode_update(message['update']) for message in received[self.global_id]}
+        if self.global_id in heads:
+            cluster_solutions[self.global_id] = self.cluster_models[self.global_id]
+        if not cluster_solutions:
+            return True, steps_up
+        print(f"{bcolors.WARNING}Integrating {len(cluster_solutions)} cluster models...{bcolors.ENDC}")
+        synced = list(cluster_solutions.keys())
+        aggregated = aggregator.aggregate([cluster_solutions[head] for head in synced],
+                                          [self.cluster_weights.get(head, 1) for head in synced])
+        aggregator.write(self.global_model, aggregated)
+        self.publish_global(aggregated)
+        self.cluster_weights = {}
+
+        # The heads that took part continue from the new global model.
+        synced_remote = [head for head in synced if head != self.global_id]
+        agents, srcs, dsts, updates = self.generate_pairings(
+            synced_remote, env.whichControllersMatrix, type="global-down", neighbourhoodMatrix=env.neighbourMatrix,
+            update_fn=lambda head: codec.encode_global(self.cluster_versions.get(head)))
+        predictions = self.predict_arrivals(env, synced_remote, srcs, dsts, updates)
+        self.post_updates(env, agents, updates, srcs, dsts)
+        received, steps_down, stopped = self.await_updates(env, {head: 1 for head in synced_remote}, predictions)
+        if stopped:
+            print("Simulation Stopped, dropping last round.")
+            return False, steps_up + steps_down
+        for head in synced_remote:
+            for model in received[head]:
+                self.cluster_models[head] = self.decode_update(model['update'])
+                self.cluster_versions[head] = model['update'].version
+        if self.global_id in synced:
+            self.cluster_models[self.global_id] = codec.versions[codec.version]
+            self.cluster_versions[self.global_id] = codec.version
+        return True, steps_up + steps_down
+
+    def predict_arrivals(self, env, receivers, srcs, dsts, updates):
+        """
+        Predicts after how many steps the updates about to be posted reach each receiver. Uses the estimate of the
+        environment when it has one (expected_deliveries), otherwise the paths of the topology (topology_deliveries).
+        Receivers with an update on a path that is not in the topology, or when there is no topology, fall back to the
+        arrivals seen the last time they waited. Receivers without a prediction are polled every step.
+        :param env:
+        :param receivers: the agents that will wait for the updates.
+        :param srcs:
+        :param dsts:
+        :param updates:
+        :return: dict receiver -> sorted list with the predicted steps until each arrival.
+        """
+        expected_deliveries = getattr(env, 'expected_deliveries', None)
+        if expected_deliveries is not None:
+            deliveries = expected_deliveries(srcs, dsts, updates)
+        elif self.link_info:
+            deliveries = self.topology_deliveries(env, srcs, dsts, updates)
+        else:
+            deliveries = [(receiver, None) for receiver in receivers]
+        predictions = {receiver: [] for receiver in receivers}
+        unknown = set()
+        for receiver, ticks in deliveries:
+            if receiver not in predictions:
+                continue
+            if ticks is None:
+                unknown.add(receiver)
+            else:
+                predictions[receiver].append(ticks)
+        for receiver in unknown:
+            predictions[receiver] = list(self.arrival_ticks.get(receiver, []))
+        return {receiver: sorted(ticks) for receiver, ticks in predictions.items()}
+
+    def topology_deliveries(self, env, srcs, dsts, updates):
+        """
+        Where and when the updates would arrive if posted now, from the topology: the expected rtt of the path plus the
+        time to push the payload through its narrowest link.
+        :param env:
+        :param srcs: node sending each update.
+        :param dsts: neighbour index, in the neighbourhood of src, of the receiver of each update.
+        :param updates:
+        :return: list with (receiving agent, steps until the arrival) for each update, None steps when the path is not
+        in the topology.
+        """
+        deliveries = []
+        for update, src, dst_idx in zip(updates, srcs, dsts):
+            receiver = env.neighbourMatrix[src][dst_idx]
+            link = self.link_info.get((src, receiver), self.link_info.get((receiver, src)))
+            if link is None:
+                deliveries.append((self.agent_name(receiver), None))
+                continue
+            expected_rtt, min_bandwidth = link
+            transfer_ms = payload_nbytes(update) * 8 / (min_bandwidth * 1e3)  # Mbit/s are 1e3 bits per ms
+            ticks = int(math.ceil((expected_rtt + transfer_ms) / self.ms_per_step))
+            deliveries.append((self.agent_name(receiver), max(ticks, 1)))
+        return deliveries
+
+    def advance_env(self, env, ticks):
+        """
+        Runs the simulation for some steps without actions. In one call when the environment supports it (advance),
+        otherwise one empty step at a time. Either way no updates are polled in between, await_updates only polls at
+        the predicted arrivals.
+        :param env:
+        :param ticks:
+        :return: the steps run and whether the simulation stopped.
+        """
+        if hasattr(env, 'advance'):
+            (_, _, terminations, _, _), ran = env.advance(ticks)
+            return ran, utils.is_done(terminations)
+        for tick in range(ticks):
+            observations, rewards, terminations, truncations, info = env.step({})
+            if utils.is_done(terminations):
+                return tick + 1, True
+        return ticks, False
+
+    def await_updates(self, env, expected, predictions=None):
+        """
+        Advances the simulation until every receiver got the updates it waits for. Instead of polling all the receivers
+        after every step, it jumps to the next predicted arrival and only polls the receivers that can have something
+        by then. A late update is polled for every step until it arrives.
+        :param env:
+        :param expected: dict receiver -> number of updates it waits for.
+        :param predictions: dict receiver -> sorted predicted steps until each arrival, see predict_arrivals.
+        :return: dict receiver -> list of the messages received, the steps taken and whether the simulation stopped.
+        """
+        predictions = predictions if predictions is not None else {}
+        received = {receiver: [] for receiver in expected}
+        observed = {receiver: [] for receiver in expected}
+        ticks = 0
+        pending = [receiver for receiver in expected if expected[receiver] > 0]
+        while pending:
+            # Predicted step of the next update of each receiver, 0 when unknown or already late.
+            etas = {}
+            for receiver in pending:
+                receiver_predictions = predictions.get(receiver, [])
+                n_received = len(received[receiver])
+                etas[receiver] = receiver_predictions[n_received] if n_received < len(receiver_predictions) else 0
+            ran, stopped = self.advance_env(env, max(min(etas.values()), ticks + 1) - ticks)
+            ticks += ran
+            if stopped:
+                return received, ticks, True
+            for receiver in pending:
+                if etas[receiver] <= ticks:
+                    messages = env.get_updates(receiver)
+                    received[receiver].extend(messages)
+                    observed[receiver].extend([ticks] * len(messages))
+            pending = [receiver for receiver in pending if len(received[receiver]) < expected[receiver]]
+        for receiver, ticks_seen in observed.items():
+            if ticks_seen:
+                self.arrival_ticks[receiver] = ticks_seen
+        return received, ticks, False
+
     @abstractmethod
     def async_download_global_solution(self, env, agent, global_id):
         # Used by agents to check if the global has sent any update.
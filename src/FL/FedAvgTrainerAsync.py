@@ -5,17 +5,19 @@ from peersim_gym.envs.PeersimEnv import PeersimEnv
 from torchsummary import summary
 
 import torch as T
+from src.FL.Aggregator import UpdateBuffer
 from src.FL.FLAgent import FLAgent
 from src.FL.Networks.DQN import DQN
+from src.MARL.Networks.GNN import GraphActorCritic
 from src.FL.Networks.PPO import PPO
 from src.MARL.Networks.A2C import ActorCritic
 from src.Utils import utils
+from src.Utils.RolloutBuffer import RolloutBuffer
 
 import peersim_gym.envs.PeersimEnv as pe
 from src.Utils.MetricHelper import MetricHelper as mh
 import peersim_gym.envs.PeersimEnv as pg
 from tqdm import tqdm
-from multiprocessing import Pool
 
 from src.Utils.printHelper import bcolors
 
@@ -32,6 +34,8 @@ class FedAvgTrainerAsync(FLAgent):
     - https://github.com/litian96/FedProx/blob/master/flearn/optimizer/pgd.py
     """
 
+    DEFAULT_MU = 0.5
+
     def __init__(self, args):
         super().__init__(args)
         self.steps_for_return = args.get('steps_for_return', 150)
@@ -41,22 +45,19 @@ class FedAvgTrainerAsync(FLAgent):
         self.possible_agents = args.get('agents')
         self.save_interval = args.get('save_interval', 50)
         self.action_shape = args.get('output_shape')
-        self.mu = args.get("mu", 0.5)
+        # Buffered aggregation (FedBuff): the global model merges the updates buffer_size at a time, down-weighted by
+        # their staleness. 0 averages whatever arrived at every step instead.
+        self.buffer_size = args.get('buffer_size', 4)
+        self.server_lr = args.get('server_lr', 1.0)
+        self.update_buffer = None
 
 
         self.amount_of_metrics = 50
         self.last_losses = np.zeros(self.amount_of_metrics)
         self.last_rewards = np.zeros(self.amount_of_metrics)
 
-        self.agent_states = {
-            agent: {
-                'state': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': []
-            } for agent in self.agents
-        }
+        # Rollout of each agent since its last update, written in place and rewound after every update.
+        self.agent_states = RolloutBuffer(agents=self.agents, capacity=self.steps_for_return)
 
     def train_loop(self,
                    env: PeersimEnv,
@@ -90,22 +91,24 @@ class FedAvgTrainerAsync(FLAgent):
 
             # Reset the state
             print(f"{bcolors.FAIL} Resetting environment... {bcolors.ENDC}")
-            states, _ = env.reset()
-            states = utils.flatten_state_list(states, agent_list)
+            observations, _ = env.reset()
 
             while not utils.is_done(dones):
                 print(f'{bcolors.OKCYAN}Step: {step} {bcolors.ENDC}')
 
                 # Cohort selection:
-                cohort = self.select_cohort(agent_list)  # keeping agen_list for now. Will reduce the total # of agents
+                cohort = self.select_cohort(agent_list, env)
+                states = utils.flatten_state_list(observations, cohort)
                 received_updates = {}  # await len of received_updates == len(cohort), if at least n steps. Drop the training for the agents that did not send updates.
 
                 for step in range(steps_per_return):
                     if utils.is_done(dones):
                         break
 
-                    self.async_add_new_solutions_to_global(self.global_id, env)
+                    self.async_add_new_solutions_to_global(env, self.global_id)
 
+                    # Step every agent of the cohort first, then train them together.
+                    step_results = []
                     for idx, agent in enumerate(cohort):
                         single_agent_list = [agent]
                         self.async_download_global_solution(env, agent, self.global_id)
@@ -114,33 +117,29 @@ class FedAvgTrainerAsync(FLAgent):
 
                         # self.mh.register_actions(actions)
                         print(f'{bcolors.OKCYAN}Step: {step} {bcolors.ENDC}')
-                        next_states, rewards, dones, _, info = env.step(actions)
-                        next_states = utils.flatten_state_list(states=next_states, agents=cohort)
+                        observations, rewards, dones, _, info = env.step(actions)
+                        next_states = utils.flatten_state_list(states=observations, agents=cohort)
 
-                        # select single_agent_list:
-                        # for idx, agent in enumerate(single_agent_list):
-                        total_reward_in_step = self.__store_agent_step_data(states, actions, rewards, next_states, dones,
+                        total_reward_in_step = self.__store_agent_step_data(states[idx:idx + 1], actions, rewards, next_states[idx:idx + 1], dones,
                                                                             single_agent_list)
                         score += total_reward_in_step
 
                         # Advance to next iter
                         states = next_states
-                        last_losses = {agent: 0 for agent in single_agent_list}
-
-                        if step % steps_per_return == 0 or self.check_all_done(dones):
-                            # Here we will learn the paths from all the agents
-                            print(f"{bcolors.WARNING}Training... {bcolors.ENDC}")
-                            for agent in single_agent_list:
-                                s, a, r, s_next, fin = self.__get_agent_step_data(agent)
-                                if s and a and r and s_next and fin:  # Check if fin is always not empty as well
-                                    last_loss = self.learn(s=s, a=a, r=r, s_next=s_next, k=step, fin=fin, agent=agent)
-                                    last_losses[agent] = last_loss if not last_loss is None else 0
-
-                        self.__clean_agent_step_data(single_agent_list)
-
-                        print(f'Action{actions}  -   Loss: {last_losses}  -    Rewards: {rewards}')
+                        step_results.append((agent, actions, rewards, info))
+
+                    last_losses = {agent: 0 for agent in cohort}
+                    if step == steps_per_return - 1 or self.check_all_done(dones):
+                        # Here we will learn the paths from all the agents, each agent only touches its own model.
+                        # Done at the end of the round, before the next cohort is picked.
+                        print(f"{bcolors.WARNING}Training... {bcolors.ENDC}")
+                        last_losses.update(self.map_agents(lambda ag: self.__learn_agent(ag, step), cohort))
+                        self.__clean_agent_step_data(cohort)
+
+                    for agent, actions, rewards, info in step_results:
+                        print(f'Action{actions}  -   Loss: {last_losses[agent]}  -    Rewards: {rewards}')
                         self.mh.update_metrics_after_step(rewards=rewards,
-                                                          losses=last_losses,
+                                                          losses={agent: last_losses[agent]},
                                                           overloaded_nodes=info[pg.STATE_G_OVERLOADED_NODES],
                                                           average_response_time=info[pg.STATE_G_AVERAGE_COMPLETION_TIMES],
                                                           occupancy=info[pg.STATE_G_OCCUPANCY],
@@ -148,7 +147,7 @@ class FedAvgTrainerAsync(FLAgent):
                                                           finished_tasks=info[pg.STATE_G_FINISHED_TASKS],
                                                           total_tasks=info[pg.STATE_G_TOTAL_TASKS],
                                                           consumed_energy=info[pg.STATE_G_CONSUMED_ENERGY],
-                                                          agents=single_agent_list)
+                                                          agents=[agent])
                         if step % self.steps_per_exchange == 0:
                             print(f"{bcolors.WARNING}Pulling Global for {agent}... {bcolors.ENDC}")
                             self.async_upload_local_solution(env, agent)
@@ -172,7 +171,6 @@ class FedAvgTrainerAsync(FLAgent):
     def generate_agents(self, env):
 
         max_neighbours = env.max_neighbours
-        self.models = {}
         self.global_model = self.initialize_model()(
             lr=self.learning_rate,
             input_dims=self.input_shape,
@@ -181,24 +179,25 @@ class FedAvgTrainerAsync(FLAgent):
             fc3_dims=128,
             n_actions=max_neighbours
         )
-        for agent in self.possible_agents:
-            # TODO Make sure this works for the other models. Might need an extra parameter passing mechanism. IE build model_args
-            #  as well and pass that.
-            self.models[agent] = self.initialize_model()(
-                lr=self.learning_rate,
-                input_dims=self.input_shape,
-                fc1_dims=512,
-                fc2_dims=256,
-                fc3_dims=128,
-                n_actions=max_neighbours
-            )
-
-            summary(self.models[agent], input_size=self.input_shape)
+        # TODO Make sure this works for the other models. Might need an extra parameter passing mechanism. IE build model_args
+        #  as well and pass that.
+        # The agent models share the architecture of the global one, and are only built when first used.
+        self.models = self.make_model_pool(lambda: self.initialize_model()(
+            lr=self.learning_rate,
+            input_dims=self.input_shape,
+            fc1_dims=512,
+            fc2_dims=256,
+            fc3_dims=128,
+            n_actions=max_neighbours
+        ), self.possible_agents)
+
+        summary(self.global_model, input_size=self.input_shape)
 
     def await_global_getting_local_solutions(self, cohort, env, global_id):
         agents, srcs, dsts, updates = self.generate_pairings(cohort, env.whichControllersMatrix, type="global-up", neighbourhoodMatrix=env.neighbourMatrix)  # TODO broken
-        env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
-        local_solutions = self.await_local_solutions_for_aligning(cohort, env, global_id)
+        predictions = self.predict_arrivals(env, [global_id], srcs, dsts, updates)
+        self.post_updates(env, agents, updates, srcs, dsts)
+        local_solutions = self.await_local_solutions_for_aligning(cohort, env, global_id, predictions)
         ticks_after_first_weight = 0
 
         synched_global = []
@@ -207,7 +206,7 @@ class FedAvgTrainerAsync(FLAgent):
             # Guarantee they all received updates.
             global_models = env.get_updates(global_id)
             if len(global_models) > 0:
-                self.models[agent].load_state_dict(global_models[0]['update'])
+                self.load_update(agent, global_models[0]['update'])
                 synched_global.append(agent)
             if len(synched_global) == len(cohort):
                 break
@@ -215,18 +214,11 @@ class FedAvgTrainerAsync(FLAgent):
             ticks_after_first_weight += 1
         return local_solutions
 
-    def await_local_solutions_for_aligning(self, cohort, env, global_id):
+    def await_local_solutions_for_aligning(self, cohort, env, global_id, predictions=None):
+        received, _, _ = self.await_updates(env, {global_id: len(cohort)}, predictions)
         local_solutions = {}
-        received_updates = []
-        while len(received_updates) < len(cohort):
-            updates = env.get_updates(global_id)
-            for update in updates:
-                received_updates.append(update)
-                if update['agent'] in local_solutions:
-                    local_solutions[update['agent']].append(update['update'])
-                else:
-                    local_solutions[update['agent']] = [update['update']]
-            env.step({})
+        for update in received[global_id]:
+            local_solutions.setdefault(update['agent'], []).append(update['update'])
         return local_solutions
 
 
@@ -236,10 +228,10 @@ class FedAvgTrainerAsync(FLAgent):
                                           dones=fin)  # States should be ordered.
         self.models[agent].optimizer.zero_grad()
         loss = self.models[agent].calculate_loss(fin)
-        # Adding the proximal term:
-        # proxTerm = self.proximalTerm(local_model=self.models[agent], global_model=self.global_model)
-        # loss += proxTerm
+        # Proximal term when aligning with FedProx.
+        loss = loss + self.local_regularization(agent)
         loss.backward()
+        self.correct_gradients(agent)
         T.nn.utils.clip_grad_value_(self.models[agent].parameters(), 10)
         self.models[agent].optimizer.step()
         self.models[agent].clear_memory()
@@ -253,38 +245,35 @@ class FedAvgTrainerAsync(FLAgent):
         return action
 
     def __store_agent_step_data(self, states, actions, rewards, next_states, dones, agent_list):
-        total_rwrd = 0
-        for idx, agent in enumerate(agent_list):
-            # Update history
-            agent_data = self.agent_states[agent]
-            agent_data['state'].append(states[idx])
-            agent_data['action'].append(actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD])
-            agent_data['reward'].append(rewards[agent])
-            agent_data['next_state'].append(next_states[idx])
-            agent_data['done'].append(dones[agent])
-            total_rwrd += rewards[agent]
-        return total_rwrd
+        self.agent_states.store(agent_list, states=states[:len(agent_list)],
+                                actions=[actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD] for agent in agent_list],
+                                rewards=[rewards[agent] for agent in agent_list],
+                                next_states=next_states[:len(agent_list)],
+                                dones=[dones[agent] for agent in agent_list])
+        self.count_samples(agent_list)
+        return sum(rewards[agent] for agent in agent_list)
+
+    def __learn_agent(self, agent, k):
+        """
+        Trains an agent on its rollout. Safe to run for several agents at the same time.
+        :param agent:
+        :param k: current step
+        :return: the loss, 0 if the agent had nothing to learn from.
+        """
+        if self.agent_states.count(agent) == 0:
+            return 0
+        s, a, r, s_next, fin = self.__get_agent_step_data(agent)
+        last_loss = self.learn(s=s, a=a, r=r, s_next=s_next, k=k, fin=fin, agent=agent)
+        self.agent_losses[agent] = last_loss
+        return last_loss if last_loss is not None else 0
 
     def __get_agent_step_data(self, agent):
-        agent_data = self.agent_states[agent]
-        return agent_data['state'], agent_data['action'], agent_data['reward'], agent_data['next_state'], agent_data['done']
+        agent_data = self.agent_states.get(agent)
+        return agent_data.get('state'), agent_data.get('action'), agent_data.get('reward'), \
+            agent_data.get('next_state'), agent_data.get('done')
 
     def __clean_agent_step_data(self, agents):
-        for agent in agents:
-            self.agent_states[agent] = {
-                'state': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': []
-            }
-
-    # def proximalTerm(self, local_model, global_model):
-    #     fed_prox_reg = 0.0
-    #     global_weight_collector = list(global_model.cuda().parameters())
-    #     for param_index, param in enumerate(local_model.parameters()):
-    #         fed_prox_reg += ((self.mu / 2) * T.norm((param - global_weight_collector[param_index])) ** 2)
-    #     return fed_prox_reg
+        self.agent_states.reset(agents)
 
     def tally_actions(self, actions):
         for worker, action in actions.items():
@@ -298,14 +287,6 @@ class FedAvgTrainerAsync(FLAgent):
         """
         return any([d for d in dones.values()])
 
-    def select_cohort(self, agent_list):
-        return agent_list
-
-    def get_update_from_agent(self, agent):
-        return self.models[agent].state_dict()
-
-    def get_update_from_global(self,):
-        return self.global_model.state_dict()
     def set_agent_model(self, agent, model):
         self.models[agent].load_state_dict(model)
 
@@ -321,6 +302,8 @@ class FedAvgTrainerAsync(FLAgent):
             return PPO
         elif self.control_type == "DQN":
             return DQN
+        elif self.control_type == "GNN":
+            return GraphActorCritic
         else:
             raise ValueError("Model not found")
 
@@ -336,25 +319,68 @@ class FedAvgTrainerAsync(FLAgent):
             self.models[agent].clear_memory()
             self.clear_agent_memory(agent)
         for update in updates:
-            self.models[agent].load_state_dict(update['update'])
+            self.load_update(agent, update['update'])
 
 
     def async_upload_local_solution(self, env, agent):
         agents, srcs, dsts, updates = self.generate_pairings([agent], env.whichControllersMatrix, type="global-up", neighbourhoodMatrix=env.neighbourMatrix)
-        env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
+        self.post_updates(env, agents, updates, srcs, dsts)
 
     def async_add_new_solutions_to_global(self, env, global_id):
         """
         To be used for the global behaviour. Read the available data and incorporate it into the global model.
         Then send the global  model to the agents who returned the updates.
+        With buffer_size > 0 the updates are buffered, and the global model is only updated (and sent) once the buffer
+        is full.
         :param env:
         :param global_id:
         :return:
         """
         updates = env.get_updates(global_id)
-        self.fed_avg_align([update['update'] for update in updates])
-        agents, srcs, dsts, updates = self.generate_pairings([update['agent'] for update in updates], env.whichControllersMatrix, type="global-down", neighbourhoodMatrix=env.neighbourMatrix)
-        env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
+        if self.buffer_size <= 0:
+            self.align_into(self.global_model, {update['agent']: [update['update']] for update in updates})
+            contributors = [update['agent'] for update in updates]
+        else:
+            contributors = self.buffer_updates(updates)
+        if not contributors:
+            return
+        agents, srcs, dsts, updates = self.generate_pairings(contributors, env.whichControllersMatrix, type="global-down", neighbourhoodMatrix=env.neighbourMatrix)
+        self.post_updates(env, agents, updates, srcs, dsts)
+
+    def buffer_updates(self, updates):
+        """
+        Adds the received updates to the buffer, and merges it into the global model when full.
+        :param updates: the messages received by the global model.
+        :return: the agents that get the global model: the ones whose updates were merged, and the ones that never had
+        it.
+        """
+        aggregator = self.get_aggregator(self.global_model.state_dict())
+        if self.update_buffer is None:
+            self.update_buffer = UpdateBuffer(aggregator, self.buffer_size, self.server_lr, self.staleness_alpha)
+        unsynced = []
+        for update in updates:
+            delta, staleness = self.update_delta(update['agent'], update['update'])
+            if delta is None:
+                # Not trained from a global version, merging it would pull the global towards a random init.
+                unsynced.append(update['agent'])
+            else:
+                self.update_buffer.add(update['agent'], delta, staleness)
+        if not self.update_buffer.ready():
+            return list(OrderedDict.fromkeys(unsynced))
+        print(f"{bcolors.WARNING}Merging {len(self.update_buffer)} buffered updates...{bcolors.ENDC}")
+        merged, contributors = self.update_buffer.merge(aggregator.flatten(self.global_model.state_dict()))
+        aggregator.write(self.global_model, merged)
+        self.publish_global(merged)
+        for agent in contributors:
+            self.sample_counts[agent] = 0
+        self.update_control_variates(contributors)
+        return list(OrderedDict.fromkeys(contributors + unsynced))
+
+    def get_staleness(self):
+        # Used by aggregation_weights "staleness" when the updates are not buffered (buffer_size 0). The global version
+        # an agent holds is the last one it acknowledged (see load_update), agents that never got it are left out.
+        version = self.get_codec().version
+        return {agent: version - acked for agent, acked in self.acked_versions.items() if agent != self.global_id}
 
     def clear_agent_memory(self, agent):
         self.__clean_agent_step_data([agent])
@@ -1,4 +1,3 @@
-import copy
 from collections import OrderedDict
 
 import numpy as np
@@ -10,13 +9,14 @@ from src.FL.FLAgent import FLAgent
 from src.FL.Networks.A2C import ActorCritic
 from src.FL.Networks.PPO import PPO
 from src.FL.Networks.DQN import DQN
+from src.MARL.Networks.GNN import GraphActorCritic
 from src.Utils import utils
+from src.Utils.RolloutBuffer import RolloutBuffer
 
 import peersim_gym.envs.PeersimEnv as pe
 from src.Utils.MetricHelper import MetricHelper as mh
 import peersim_gym.envs.PeersimEnv as pg
 from tqdm import tqdm
-from multiprocessing import Pool
 
 from src.Utils.printHelper import bcolors
 
@@ -44,15 +44,8 @@ class FedAvgTrainerSync(FLAgent):
         self.last_losses = np.zeros(self.amount_of_metrics)
         self.last_rewards = np.zeros(self.amount_of_metrics)
 
-        self.agent_states = {
-            agent: {
-                'state': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': []
-            } for agent in self.agents
-        }
+        # Rollout of each agent since its last update, written in place and rewound after every update.
+        self.agent_states = RolloutBuffer(agents=self.agents, capacity=self.steps_for_return)
 
     def train_loop(self,
                    env: PeersimEnv,
@@ -86,15 +79,18 @@ class FedAvgTrainerSync(FLAgent):
 
             # Reset the state
             print(f"{bcolors.FAIL} Resetting environment... {bcolors.ENDC}")
-            states, _ = env.reset()
-            states = utils.flatten_state_list(states, agent_list)
+            observations, _ = env.reset()
 
             while not utils.is_done(dones):
 
                 # Cohort selection:
-                cohort = self.select_cohort(agent_list)  # keeping agen_list for now. Will reduce the total # of agents
+                cohort = self.select_cohort(agent_list, env)
+                states = utils.flatten_state_list(observations, cohort)
                 received_updates = {}  # await len of received_updates == len(cohort), if at least n steps. Drop the training for the agents that did not send updates.
-                completed, steps_comm = self.sync_download_global_solution(cohort, env, self.global_id)
+                if self.cluster_heads:
+                    completed, steps_comm = self.sync_download_cluster_solution(cohort, env)
+                else:
+                    completed, steps_comm = self.sync_download_global_solution(cohort, env, self.global_id)
                 if not completed:
                     break
                 self.clear_all_agent_memory()
@@ -105,6 +101,8 @@ class FedAvgTrainerSync(FLAgent):
                     if utils.is_done(dones):
                          break
 
+                    # Step every agent of the cohort first, then train them together.
+                    step_results = []
                     for idx, agent in enumerate(cohort):
                         single_agent_list = [agent]
                         targets = {agent: np.floor(self.get_action(np.array([states[idx]]), agent))}
@@ -112,43 +110,30 @@ class FedAvgTrainerSync(FLAgent):
 
                         # self.mh.register_actions(actions)
                         print(f'{bcolors.OKCYAN}Step: {step} {bcolors.ENDC}')
-                        next_states, rewards, dones, _, info = env.step(actions)
+                        observations, rewards, dones, _, info = env.step(actions)
                         step += 1
-                        next_states = utils.flatten_state_list(states=next_states, agents=cohort)
+                        next_states = utils.flatten_state_list(states=observations, agents=cohort)
 
-                        # select single_agent_list:
-                        # for idx, agent in enumerate(single_agent_list):
-                        total_reward_in_step = self.__store_agent_step_data(states, actions, rewards, next_states, dones,
+                        total_reward_in_step = self.__store_agent_step_data(states[idx:idx + 1], actions, rewards,
+                                                                            next_states[idx:idx + 1], dones,
                                                                             single_agent_list)
                         score += total_reward_in_step
 
                         # Advance to next iter
                         states = next_states
-                        last_losses = {agent: 0 for agent in single_agent_list}
-
-                        # if step % self.steps_per_exchange == 0:
-                        #     print(f"{bcolors.WARNING}Integrating updates...{bcolors.ENDC}")
-                        #     for ag in env.agents:
-                        #         updates_for_agent = env.get_updates(ag)
-                        #         updates_for_agent = list(map(lambda x: x['update'], updates_for_agent))
-                        #         updates_for_agent.append(self.models[ag].state_dict())
-                        #         averaged_weights = self.align_weights(updates_for_agent)
-                        #         self.set_agent_model(ag, averaged_weights)
-
-                        if return_step % steps_per_return == 0 or self.check_all_done(dones):
-                            # Here we will learn the paths from all the agents
-                            print(f"{bcolors.WARNING}Training... {bcolors.ENDC}")
-                            for ag in single_agent_list:
-                                s, a, r, s_next, fin = self.__get_agent_step_data(ag)
-                                if s and a and r and s_next and fin:  # Check if fin is always not empty as well
-                                    last_loss = self.learn(s=s, a=a, r=r, s_next=s_next, k=step, fin=fin, agent=ag)
-                                    last_losses[ag] = last_loss if not last_loss is None else 0
-
-                        self.__clean_agent_step_data(single_agent_list)
-
-                        print(f'Action{actions}  -   Loss: {last_losses}  -    Rewards: {rewards}')
+                        step_results.append((agent, actions, rewards, info))
+
+                    last_losses = {agent: 0 for agent in cohort}
+                    if return_step % steps_per_return == steps_per_return - 1 or self.check_all_done(dones):
+                        # Here we will learn the paths from all the agents, each agent only touches its own model.
+                        print(f"{bcolors.WARNING}Training... {bcolors.ENDC}")
+                        last_losses.update(self.map_agents(lambda ag: self.__learn_agent(ag, step), cohort))
+                        self.__clean_agent_step_data(cohort)
+
+                    for agent, actions, rewards, info in step_results:
+                        print(f'Action{actions}  -   Loss: {last_losses[agent]}  -    Rewards: {rewards}')
                         self.mh.update_metrics_after_step(rewards=rewards,
-                                                          losses=last_losses,
+                                                          losses={agent: last_losses[agent]},
                                                           overloaded_nodes=info[pg.STATE_G_OVERLOADED_NODES],
                                                           average_response_time=info[pg.STATE_G_AVERAGE_COMPLETION_TIMES],
                                                           occupancy=info[pg.STATE_G_OCCUPANCY],
@@ -156,15 +141,28 @@ class FedAvgTrainerSync(FLAgent):
                                                           finished_tasks=info[pg.STATE_G_FINISHED_TASKS],
                                                           total_tasks=info[pg.STATE_G_TOTAL_TASKS],
                                                           consumed_energy=info[pg.STATE_G_CONSUMED_ENERGY],
-                                                          agents=single_agent_list)
-                local_solutions, steps_comm = self.sync_upload_local_solutions(cohort, env, self.global_id)
-                if local_solutions is None:
-                    break
-                print(f"Spent {bcolors.WARNING} {steps_comm} {bcolors.ENDC} uploading the local solutions in this round.")
-                step += steps_comm
-                # align models
-                averaged_weights = self.align_weights(local_solutions.values())
-                self.global_model.load_state_dict(averaged_weights)
+                                                          agents=[agent])
+                # The steps after the last full window are trained on before the models are uploaded.
+                pending = [agent for agent in cohort if self.agent_states.count(agent) > 0]
+                if pending:
+                    print(f"{bcolors.WARNING}Training... {bcolors.ENDC}")
+                    self.map_agents(lambda ag: self.__learn_agent(ag, step), pending)
+                    self.__clean_agent_step_data(pending)
+                if self.cluster_heads:
+                    # Two tier aggregation, the agents align with their cluster heads.
+                    completed, steps_comm = self.sync_aggregate_clusters(cohort, env)
+                    if not completed:
+                        break
+                    print(f"Spent {bcolors.WARNING} {steps_comm} {bcolors.ENDC} aggregating the clusters in this round.")
+                    step += steps_comm
+                else:
+                    local_solutions, steps_comm = self.sync_upload_local_solutions(cohort, env, self.global_id)
+                    if local_solutions is None:
+                        break
+                    print(f"Spent {bcolors.WARNING} {steps_comm} {bcolors.ENDC} uploading the local solutions in this round.")
+                    step += steps_comm
+                    # align models
+                    self.align_into(self.global_model, local_solutions)
 
             # Update final metrics
             self.mh.print_action_density_episode()
@@ -185,7 +183,6 @@ class FedAvgTrainerSync(FLAgent):
     def generate_agents(self, env):
 
         max_neighbours = env.max_neighbours
-        self.models = {}
         self.global_model = self.initialize_model()(
             lr=self.learning_rate,
             input_dims=self.input_shape,
@@ -194,26 +191,29 @@ class FedAvgTrainerSync(FLAgent):
             fc3_dims=128,
             n_actions=max_neighbours
         )
-        for agent in self.possible_agents:
-            # TODO Make sure this works for the other models. Might need an extra parameter passing mechanism. IE build model_args
-            #  as well and pass that.
-            self.models[agent] = self.initialize_model()(
-                lr=self.learning_rate,
-                input_dims=self.input_shape,
-                fc1_dims=512,
-                fc2_dims=256,
-                fc3_dims=128,
-                n_actions=max_neighbours
-            )
+        # TODO Make sure this works for the other models. Might need an extra parameter passing mechanism. IE build model_args
+        #  as well and pass that.
+        # The agent models share the architecture of the global one, and are only built when first used.
+        self.models = self.make_model_pool(lambda: self.initialize_model()(
+            lr=self.learning_rate,
+            input_dims=self.input_shape,
+            fc1_dims=512,
+            fc2_dims=256,
+            fc3_dims=128,
+            n_actions=max_neighbours
+        ), self.possible_agents)
 
-            summary(self.models[agent], input_size=self.input_shape)
+        summary(self.global_model, input_size=self.input_shape)
 
 
     def learn(self, s, a, r, s_next, k, fin, agent):
         self.models[agent].remember_batch(states=s, actions=a, rewards=r, next_states=s_next, dones=fin)  # States should be ordered.
         self.models[agent].optimizer.zero_grad()
         loss = self.models[agent].calculate_loss(fin)
+        # Proximal term when aligning with FedProx.
+        loss = loss + self.local_regularization(agent)
         loss.backward()
+        self.correct_gradients(agent)
         T.nn.utils.clip_grad_value_(self.models[agent].parameters(), 10)
         self.models[agent].optimizer.step()
         self.models[agent].clear_memory()  # Test if debug any none is working properly in the blowing up scenario.
@@ -227,32 +227,35 @@ class FedAvgTrainerSync(FLAgent):
         return action
 
     def __store_agent_step_data(self, states, actions, rewards, next_states, dones, agent_list):
-        total_rwrd = 0
-        for idx, agent in enumerate(agent_list):
-            # Update history
-            agent_data = self.agent_states[agent]
-            agent_data['state'].append(states[idx])
-            agent_data['action'].append(actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD])
-            agent_data['reward'].append(rewards[agent])
-            agent_data['next_state'].append(next_states[idx])
-            agent_data['done'].append(dones[agent])
-            total_rwrd += rewards[agent]
-        return total_rwrd
+        self.agent_states.store(agent_list, states=states[:len(agent_list)],
+                                actions=[actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD] for agent in agent_list],
+                                rewards=[rewards[agent] for agent in agent_list],
+                                next_states=next_states[:len(agent_list)],
+                                dones=[dones[agent] for agent in agent_list])
+        self.count_samples(agent_list)
+        return sum(rewards[agent] for agent in agent_list)
+
+    def __learn_agent(self, agent, k):
+        """
+        Trains an agent on its rollout. Safe to run for several agents at the same time.
+        :param agent:
+        :param k: current step
+        :return: the loss, 0 if the agent had nothing to learn from.
+        """
+        if self.agent_states.count(agent) == 0:
+            return 0
+        s, a, r, s_next, fin = self.__get_agent_step_data(agent)
+        last_loss = self.learn(s=s, a=a, r=r, s_next=s_next, k=k, fin=fin, agent=agent)
+        self.agent_losses[agent] = last_loss
+        return last_loss if last_loss is not None else 0
 
     def __get_agent_step_data(self, agent):
-        agent_data = self.agent_states[agent]
-        return agent_data['state'], agent_data['action'], agent_data['reward'], agent_data['next_state'], agent_data[
-            'done']
+        agent_data = self.agent_states.get(agent)
+        return agent_data.get('state'), agent_data.get('action'), agent_data.get('reward'), \
+            agent_data.get('next_state'), agent_data.get('done')
 
     def __clean_agent_step_data(self, agents):
-        for agent in agents:
-            self.agent_states[agent] = {
-                'state': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': []
-            }
+        self.agent_states.reset(agents)
     def clear_all_agent_memory(self):
         for agent in self.agents:
             self.models[agent].clear_memory()  # Test if debug any none is working properly in the blowing up scenario.
@@ -269,15 +272,6 @@ class FedAvgTrainerSync(FLAgent):
         """
         return any([d for d in dones.values()])
 
-    def select_cohort(self, agent_list):
-        return agent_list
-
-    def get_update_from_agent(self, agent):
-        return copy.deepcopy(self.models[agent].state_dict())
-
-    def get_update_from_global(self,):
-        return copy.deepcopy(self.global_model.state_dict())
-
     def set_agent_model(self, agent, model):
         self.models[agent].clear_memory()
         self.models[agent].load_state_dict(model)
@@ -294,6 +288,8 @@ class FedAvgTrainerSync(FLAgent):
             return PPO
         elif self.control_type == "DQN":
             return DQN
+        elif self.control_type == "GNN":
+            return GraphActorCritic
         else:
             raise ValueError("Model not found")
 
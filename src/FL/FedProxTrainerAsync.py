@@ -9,13 +9,14 @@ from src.FL.FLAgent import FLAgent
 from src.FL.Networks.A2C import ActorCritic
 from src.FL.Networks.PPO import PPO
 from src.FL.Networks.DQN import DQN
+from src.MARL.Networks.GNN import GraphActorCritic
 from src.Utils import utils
+from src.Utils.RolloutBuffer import RolloutBuffer
 
 import peersim_gym.envs.PeersimEnv as pe
 from src.Utils.MetricHelper import MetricHelper as mh
 import peersim_gym.envs.PeersimEnv as pg
 from tqdm import tqdm
-from multiprocessing import Pool
 
 from src.Utils.printHelper import bcolors
 
@@ -32,6 +33,8 @@ class FedProxTrainerAsync(FLAgent):
     - https://github.com/litian96/FedProx/blob/master/flearn/optimizer/pgd.py
     """
 
+    DEFAULT_MU = 0.5
+
     def __init__(self, args):
         super().__init__(args)
         self.steps_for_return = args.get('steps_for_return', 50)
@@ -41,22 +44,14 @@ class FedProxTrainerAsync(FLAgent):
         self.possible_agents = args.get('agents')
         self.save_interval = args.get('save_interval', 50)
         self.action_shape = args.get('output_shape')
-        self.mu = args.get("mu", 0.5)
 
         self.amount_of_metrics = 50
         self.last_losses = np.zeros(self.amount_of_metrics)
         self.last_rewards = np.zeros(self.amount_of_metrics)
 
-        self.agent_states = {
-            agent: {
-                'state': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': [],
-                'align_ver': []
-            } for agent in self.agents
-        }
+        # Rollout of each agent since its last update, written in place and rewound after every update.
+        self.agent_states = RolloutBuffer(agents=self.agents, capacity=self.steps_for_return,
+                                          extra_fields={'align_ver': T.long})
         # Used for debugging purposes
         self.agent_align_ver = {
             agent: 0 for agent in self.agents
@@ -96,20 +91,22 @@ class FedProxTrainerAsync(FLAgent):
 
             # Reset the state
             print(f"{bcolors.FAIL} Resetting environment... {bcolors.ENDC}")
-            states, _ = env.reset()
-            states = utils.flatten_state_list(states, agent_list)
+            observations, _ = env.reset()
 
             while not utils.is_done(dones):
                 print(f'{bcolors.OKCYAN}Step: {step} {bcolors.ENDC}')
 
                 # Cohort selection:
-                cohort = self.select_cohort(agent_list)  # keeping agen_list for now. Will reduce the total # of agents
+                cohort = self.select_cohort(agent_list, env)
+                states = utils.flatten_state_list(observations, cohort)
                 received_updates = {}  # await len of received_updates == len(cohort), if at least n steps. Drop the training for the agents that did not send updates.
 
                 for r_step in range(steps_per_return):
                     step += 1
                     if utils.is_done(dones):
                         break
+                    # Step every agent of the cohort first, then train them together.
+                    step_results = []
                     for idx, agent in enumerate(cohort):
                         single_agent_list = [agent]
                         # global has always the latest updates.
@@ -119,34 +116,29 @@ class FedProxTrainerAsync(FLAgent):
 
                         # self.mh.register_actions(actions)
                         print(f'{bcolors.OKCYAN}Step: {step} {bcolors.ENDC}')
-                        next_states, rewards, dones, _, info = env.step(actions)
-                        next_states = utils.flatten_state_list(states=next_states, agents=cohort)
+                        observations, rewards, dones, _, info = env.step(actions)
+                        next_states = utils.flatten_state_list(states=observations, agents=cohort)
 
-                        # select single_agent_list:
-                        # for idx, agent in enumerate(single_agent_list):
-                        total_reward_in_step = self.__store_agent_step_data(states, actions, rewards, next_states, dones, single_agent_list, self.agent_align_ver[agent])
+                        total_reward_in_step = self.__store_agent_step_data(states[idx:idx + 1], actions, rewards, next_states[idx:idx + 1], dones,
+                                                                            single_agent_list, self.agent_align_ver[agent])
                         score += total_reward_in_step
 
                         # Advance to next iter
                         states = next_states
-                        last_losses = {agent: 0 for agent in single_agent_list}
-
-                        if r_step % steps_per_return == 0 or self.check_all_done(dones):
-                            # Here we will learn the paths from all the agents
-                            print(f"{bcolors.WARNING}Training... {bcolors.ENDC}")
-                            for agent in single_agent_list:
-                                s, a, r, s_next, fin, align_ver = self.__get_agent_step_data(agent)
-                                if align_ver.count(self.agent_align_ver[agent]) != len(align_ver):
-                                    raise ValueError(f"Agent {agent} has different alignment versions in their states, this will lead to problems later on.")
-                                if s and a and r and s_next and fin:  # Check if fin is always not empty as well
-                                    last_loss = self.learn(s=s, a=a, r=r, s_next=s_next, k=r_step, fin=fin, agent=agent, align_ver=align_ver)
-                                    self.agent_align_ver[agent] += 1
-                                    last_losses[agent] = last_loss if not last_loss is None else 0
-                            self.__clean_agent_step_data(single_agent_list)
-
-                        print(f'Action{actions}  -   Loss: {last_losses}  -    Rewards: {rewards}')
+                        step_results.append((agent, actions, rewards, info))
+
+                    last_losses = {agent: 0 for agent in cohort}
+                    if r_step == steps_per_return - 1 or self.check_all_done(dones):
+                        # Here we will learn the paths from all the agents, each agent only touches its own model.
+                        # Done at the end of the round, before the next cohort is picked.
+                        print(f"{bcolors.WARNING}Training... {bcolors.ENDC}")
+                        last_losses.update(self.map_agents(lambda ag: self.__learn_agent(ag, r_step), cohort))
+                        self.__clean_agent_step_data(cohort)
+
+                    for agent, actions, rewards, info in step_results:
+                        print(f'Action{actions}  -   Loss: {last_losses[agent]}  -    Rewards: {rewards}')
                         self.mh.update_metrics_after_step(rewards=rewards,
-                                                          losses=last_losses,
+                                                          losses={agent: last_losses[agent]},
                                                           overloaded_nodes=info[pg.STATE_G_OVERLOADED_NODES],
                                                           average_response_time=info[pg.STATE_G_AVERAGE_COMPLETION_TIMES],
                                                           occupancy=info[pg.STATE_G_OCCUPANCY],
@@ -154,7 +146,7 @@ class FedProxTrainerAsync(FLAgent):
                                                           finished_tasks=info[pg.STATE_G_FINISHED_TASKS],
                                                           total_tasks=info[pg.STATE_G_TOTAL_TASKS],
                                                           consumed_energy=info[pg.STATE_G_CONSUMED_ENERGY],
-                                                          agents=single_agent_list)
+                                                          agents=[agent])
                         if r_step % self.steps_per_exchange == 0 and r_step > 0:
                             print(f"{bcolors.WARNING}Pulling Global for {agent}... {bcolors.ENDC}")
                             self.async_upload_local_solution(env, agent)
@@ -178,7 +170,6 @@ class FedProxTrainerAsync(FLAgent):
     def generate_agents(self, env):
 
         max_neighbours = env.max_neighbours
-        self.models = {}
         self.global_model = self.initialize_model()(
             lr=self.learning_rate,
             input_dims=self.input_shape,
@@ -187,24 +178,25 @@ class FedProxTrainerAsync(FLAgent):
             fc3_dims=128,
             n_actions=max_neighbours
         )
-        for agent in self.possible_agents:
-            # TODO Make sure this works for the other models. Might need an extra parameter passing mechanism. IE build model_args
-            #  as well and pass that.
-            self.models[agent] = self.initialize_model()(
-                lr=self.learning_rate,
-                input_dims=self.input_shape,
-                fc1_dims=512,
-                fc2_dims=256,
-                fc3_dims=128,
-                n_actions=max_neighbours
-            )
-
-            summary(self.models[agent], input_size=self.input_shape)
+        # TODO Make sure this works for the other models. Might need an extra parameter passing mechanism. IE build model_args
+        #  as well and pass that.
+        # The agent models share the architecture of the global one, and are only built when first used.
+        self.models = self.make_model_pool(lambda: self.initialize_model()(
+            lr=self.learning_rate,
+            input_dims=self.input_shape,
+            fc1_dims=512,
+            fc2_dims=256,
+            fc3_dims=128,
+            n_actions=max_neighbours
+        ), self.possible_agents)
+
+        summary(self.global_model, input_size=self.input_shape)
 
     def await_global_getting_local_solutions(self, cohort, env, global_id):
         agents, srcs, dsts, updates = self.generate_pairings(cohort, env.whichControllersMatrix, type="global-up", neighbourhoodMatrix=env.neighbourMatrix)  # TODO broken
-        env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
-        local_solutions = self.await_local_solutions_for_aligning(cohort, env, global_id)
+        predictions = self.predict_arrivals(env, [global_id], srcs, dsts, updates)
+        self.post_updates(env, agents, updates, srcs, dsts)
+        local_solutions = self.await_local_solutions_for_aligning(cohort, env, global_id, predictions)
         ticks_after_first_weight = 0
 
         synched_global = []
@@ -213,7 +205,7 @@ class FedProxTrainerAsync(FLAgent):
             # Guarantee they all received updates.
             global_models = env.get_updates(global_id)
             if len(global_models) > 0:
-                self.models[agent].load_state_dict(global_models[0]['update'])
+                self.load_update(agent, global_models[0]['update'])
                 self.clear_agent_memory(agent)
                 synched_global.append(agent)
             if len(synched_global) == len(cohort):
@@ -222,18 +214,11 @@ class FedProxTrainerAsync(FLAgent):
             ticks_after_first_weight += 1
         return local_solutions
 
-    def await_local_solutions_for_aligning(self, cohort, env, global_id):
+    def await_local_solutions_for_aligning(self, cohort, env, global_id, predictions=None):
+        received, _, _ = self.await_updates(env, {global_id: len(cohort)}, predictions)
         local_solutions = {}
-        received_updates = []
-        while len(received_updates) < len(cohort):
-            updates = env.get_updates(global_id)
-            for update in updates:
-                received_updates.append(update)
-                if update['agent'] in local_solutions:
-                    local_solutions[update['agent']].append(update['update'])
-                else:
-                    local_solutions[update['agent']] = [update['update']]
-            env.step({})
+        for update in received[global_id]:
+            local_solutions.setdefault(update['agent'], []).append(update['update'])
         return local_solutions
 
     def learn(self, s, a, r, s_next, k, fin, agent, align_ver):
@@ -242,9 +227,9 @@ class FedProxTrainerAsync(FLAgent):
         self.models[agent].optimizer.zero_grad()
         loss = self.models[agent].calculate_loss(fin)
         # Adding the proximal term:
-        proxTerm = self.proximalTerm(local_model=self.models[agent], global_model=self.global_model)
-        loss += proxTerm
+        loss = loss + self.proximal_term(agent)
         loss.backward()
+        self.correct_gradients(agent)
         T.nn.utils.clip_grad_value_(self.models[agent].parameters(), 10)
         self.models[agent].optimizer.step()
         self.models[agent].clear_memory()
@@ -258,40 +243,40 @@ class FedProxTrainerAsync(FLAgent):
         return action
 
     def __store_agent_step_data(self, states, actions, rewards, next_states, dones, agent_list, align_ver):
-        total_rwrd = 0
-        for idx, agent in enumerate(agent_list):
-            # Update history
-            agent_data = self.agent_states[agent]
-            agent_data['state'].append(states[idx])
-            agent_data['action'].append(actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD])
-            agent_data['reward'].append(rewards[agent])
-            agent_data['next_state'].append(next_states[idx])
-            agent_data['done'].append(dones[agent])
-            agent_data['align_ver'].append(align_ver)
-            total_rwrd += rewards[agent]
-        return total_rwrd
+        self.agent_states.store(agent_list, states=states[:len(agent_list)],
+                                actions=[actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD] for agent in agent_list],
+                                rewards=[rewards[agent] for agent in agent_list],
+                                next_states=next_states[:len(agent_list)],
+                                dones=[dones[agent] for agent in agent_list],
+                                align_ver=[align_ver for _ in agent_list])
+        self.count_samples(agent_list)
+        return sum(rewards[agent] for agent in agent_list)
+
+    def __learn_agent(self, agent, k):
+        """
+        Trains an agent on its rollout and moves it to the next alignment version. Safe to run for several agents at
+        the same time.
+        :param agent:
+        :param k: current step
+        :return: the loss, 0 if the agent had nothing to learn from.
+        """
+        if self.agent_states.count(agent) == 0:
+            return 0
+        s, a, r, s_next, fin, align_ver = self.__get_agent_step_data(agent)
+        if align_ver is not None and (align_ver != self.agent_align_ver[agent]).any():
+            raise ValueError(f"Agent {agent} has different alignment versions in their states, this will lead to problems later on.")
+        last_loss = self.learn(s=s, a=a, r=r, s_next=s_next, k=k, fin=fin, agent=agent, align_ver=align_ver)
+        self.agent_losses[agent] = last_loss
+        self.agent_align_ver[agent] += 1
+        return last_loss if last_loss is not None else 0
 
     def __get_agent_step_data(self, agent):
-        agent_data = self.agent_states[agent]
-        return agent_data['state'], agent_data['action'], agent_data['reward'], agent_data['next_state'], agent_data['done'] , agent_data['align_ver']
+        agent_data = self.agent_states.get(agent)
+        return agent_data.get('state'), agent_data.get('action'), agent_data.get('reward'), \
+            agent_data.get('next_state'), agent_data.get('done'), agent_data.get('align_ver')
 
     def __clean_agent_step_data(self, agents):
-        for agent in agents:
-            self.agent_states[agent] = {
-                'state': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': [],
-                'align_ver': []
-            }
-
-    def proximalTerm(self, local_model, global_model):
-        fed_prox_reg = 0.0
-        global_weight_collector = list(global_model.cuda().parameters())
-        for param_index, param in enumerate(local_model.parameters()):
-            fed_prox_reg += ((self.mu / 2) * T.norm((param - global_weight_collector[param_index])) ** 2)
-        return fed_prox_reg
+        self.agent_states.reset(agents)
 
     def tally_actions(self, actions):
         for worker, action in actions.items():
@@ -305,15 +290,6 @@ class FedProxTrainerAsync(FLAgent):
         """
         return any([d for d in dones.values()])
 
-    def select_cohort(self, agent_list):
-        return agent_list
-
-    def get_update_from_agent(self, agent):
-        return self.models[agent].state_dict()
-
-    def get_update_from_global(self, ):
-        return self.global_model.state_dict()
-
     def set_agent_model(self, agent, model):
         self.models[agent].load_state_dict(model)
         self.clear_agent_memory(agent)
@@ -330,6 +306,8 @@ class FedProxTrainerAsync(FLAgent):
             return PPO
         elif self.control_type == "DQN":
             return DQN
+        elif self.control_type == "GNN":
+            return GraphActorCritic
         else:
             raise ValueError("Model not found")
 
@@ -344,13 +322,13 @@ class FedProxTrainerAsync(FLAgent):
         if updates:
             self.clear_agent_memory(agent)
         for update in updates:
-            self.models[agent].load_state_dict(update['update'])
+            self.load_update(agent, update['update'])
             self.agent_align_ver[agent] += 1
             print(f"{bcolors.WARNING} Agent {agent} updated to version {self.agent_align_ver[agent]} {bcolors.ENDC}")
 
     def async_upload_local_solution(self, env, agent):
         agents, srcs, dsts, updates = self.generate_pairings([agent], env.whichControllersMatrix, type="global-up", neighbourhoodMatrix=env.neighbourMatrix)
-        env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
+        self.post_updates(env, agents, updates, srcs, dsts)
 
     def async_add_new_solutions_to_global(self, env, global_id):
         """
@@ -361,21 +339,26 @@ class FedProxTrainerAsync(FLAgent):
         :return:
         """
         updates = env.get_updates(global_id)
-        avg_weights = self.align_weights({update['agent']: [update['update']] for update in updates}.values(), base_model_state_dict=self.global_model.state_dict())
-        if avg_weights:
-            self.global_model.load_state_dict(avg_weights)
+        if self.align_into(self.global_model, {update['agent']: [update['update']] for update in updates}):
             self.agent_align_ver["global"] += 1
             aux = self.agent_align_ver["global"]
             print(f"{bcolors.WARNING} Global updated to version {aux} {bcolors.ENDC}")
             agents, srcs, dsts, updates = self.generate_pairings([update['agent'] for update in updates if not update['agent'] == self.global_id], env.whichControllersMatrix, type="global-down",
                                                                  neighbourhoodMatrix=env.neighbourMatrix)
-            env.post_updates(agents=agents, updates=updates, srcs=srcs, dst=dsts)
+            self.post_updates(env, agents, updates, srcs, dsts)
             # Global ID updates immediatelly.
             self.agent_align_ver[global_id] += 1
             print(f"{bcolors.WARNING} {global_id} updated to version {self.agent_align_ver[global_id]} {bcolors.ENDC}")
             self.models[self.global_id].load_state_dict(self.global_model.state_dict())
+            self.acked_versions[self.global_id] = self.get_codec().version
             self.clear_agent_memory(self.global_id)
 
+    def get_staleness(self):
+        # Each agent's version is bumped whenever it receives the global model, so the difference to the global's
+        # version is how many aggregations its update missed.
+        return {agent: self.agent_align_ver["global"] - ver for agent, ver in self.agent_align_ver.items()
+                if agent != "global"}
+
     def clear_agent_memory(self, agent):
         self.__clean_agent_step_data([agent])
 
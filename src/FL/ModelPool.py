@@ -0,0 +1,217 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch as T
+
+
+def optimizers_of(model):
+    """
+    :param model:
+    :return: list of (module name, optimizer) for the model and its submodules that keep an optimizer (e.g. PPO's
+    actor and critic).
+    """
+    return [(name, module.optimizer) for name, module in model.named_modules()
+            if isinstance(getattr(module, 'optimizer', None), T.optim.Optimizer)]
+
+
+def model_nbytes(model):
+    """
+    :param model:
+    :return: bytes taken by the weights, buffers and optimizer state of the model.
+    """
+    nbytes = sum(value.nbytes for value in model.state_dict().values())
+    for _, optimizer in optimizers_of(model):
+        for param_state in optimizer.state.values():
+            nbytes += sum(value.nbytes for value in param_state.values() if T.is_tensor(value))
+    return nbytes
+
+
+class PackedModel:
+    """
+    An idle agent model: its state_dict and optimizer state packed into one flat float32 vector, kept in memory or in a
+    memory-mapped file.
+    """
+
+    def __init__(self, flat, layout, extras, param_groups, path=None):
+        """
+        :param flat: the flat vector, None when it is in path.
+        :param layout: list of (key, shape, dtype) of the packed tensors, in order.
+        :param extras: dict key -> the non-tensor entries of the optimizer state.
+        :param param_groups: dict optimizer name -> its param_groups.
+        :param path: memory-mapped file with the flat vector.
+        """
+        self.flat = flat
+        self.layout = layout
+        self.extras = extras
+        self.param_groups = param_groups
+        self.path = path
+        self.n_values = sum(int(np.prod(shape)) for _, shape, _ in layout)
+
+    @classmethod
+    def pack(cls, model, path=None):
+        """
+        :param model:
+        :param path: when given, the flat vector is written there instead of kept in memory.
+        :return: PackedModel
+        """
+        tensors = OrderedDict((('model', key), value) for key, value in model.state_dict().items())
+        extras, param_groups = {}, {}
+        for name, optimizer in optimizers_of(model):
+            state = optimizer.state_dict()
+            param_groups[name] = state['param_groups']
+            for idx, param_state in state['state'].items():
+                for key, value in param_state.items():
+                    if T.is_tensor(value):
+                        tensors[(name, idx, key)] = value
+                    else:
+                        extras[(name, idx, key)] = value
+        layout = [(key, value.shape, value.dtype) for key, value in tensors.items()]
+        with T.no_grad():
+            flat = T.cat([value.detach().reshape(-1).to(device='cpu', dtype=T.float) for value in tensors.values()]) \
+                if tensors else T.empty(0)
+        if path is None:
+            return cls(flat, layout, extras, param_groups)
+        stored = np.memmap(path, dtype=np.float32, mode='w+', shape=(max(flat.numel(), 1),))
+        stored[:flat.numel()] = flat.numpy()
+        stored.flush()
+        del stored
+        return cls(None, layout, extras, param_groups, path=path)
+
+    def load_flat(self):
+        if self.path is None:
+            return self.flat
+        # Copy on write, the file stays untouched and the vector can be handed to torch.
+        return T.from_numpy(np.memmap(self.path, dtype=np.float32, mode='c', shape=(max(self.n_values, 1),)))
+
+    def restore(self, model):
+        """
+        Loads the packed state into model, which must have the same architecture.
+        :param model:
+        """
+        flat = self.load_flat()
+        values, start = {}, 0
+        for key, shape, dtype in self.layout:
+            end = start + int(np.prod(shape))
+            value = flat[start:end].reshape(shape)
+            values[key] = value.round().to(dtype) if not dtype.is_floating_point else value.to(dtype)
+            start = end
+        model.load_state_dict(OrderedDict((key[1], value) for key, value in values.items() if key[0] == 'model'))
+        for name, optimizer in optimizers_of(model):
+            state = {}
+            for key, value in list(values.items()) + list(self.extras.items()):
+                if key[0] == name and len(key) == 3:
+                    # Cloned, a view would keep the whole flat vector alive.
+                    state.setdefault(key[1], {})[key[2]] = value.clone() if T.is_tensor(value) else value
+            optimizer.load_state_dict({'state': state, 'param_groups': self.param_groups.get(name, optimizer.state_dict()['param_groups'])})
+
+
+class AgentModelPool:
+    """
+    Dict-like holder of the agent models (agent -> nn.Module with its optimizer), so the trainers keep using
+    self.models[agent]. A model is only built the first time its agent is used. Under a memory budget the least recently
+    used models are packed into flat vectors (PackedModel), in memory or memory-mapped in offload_dir, and materialized
+    again when their agent is used. The agents of the current cohort are pinned and never evicted, so the models
+    trained in parallel stay put.
+    """
+
+    def __init__(self, factory, agents, memory_budget=None, offload_dir=None):
+        """
+        :param factory: builds a new model, with its optimizer.
+        :param agents: the agents the pool holds models for.
+        :param memory_budget: bytes the materialized models may take (weights, buffers and optimizer state), None for
+        no limit. Pinned models are kept even when they go over it.
+        :param offload_dir: directory for the memory-mapped models, None keeps the packed models in memory.
+        """
+        self.factory = factory
+        self.agents = list(agents)
+        self.known = set(self.agents)
+        self.memory_budget = memory_budget
+        self.offload_dir = offload_dir
+        if offload_dir is not None:
+            os.makedirs(offload_dir, exist_ok=True)
+        self.resident = OrderedDict()  # agent -> model, least recently used first.
+        self.packed = {}  # agent -> PackedModel
+        self.pinned = set()
+        self.spare = None  # Last evicted module, reused for the next agent that was packed.
+        self.lock = threading.RLock()
+        self.materializations = 0
+        self.evictions = 0
+
+    def __getitem__(self, agent):
+        with self.lock:
+            model = self.resident.get(agent)
+            if model is not None:
+                self.resident.move_to_end(agent)
+                return model
+            if agent not in self.known:
+                raise KeyError(agent)
+            model = self.materialize(agent)
+            self.enforce_budget(keep=agent)
+            return model
+
+    def __contains__(self, agent):
+        return agent in self.known
+
+    def __iter__(self):
+        return iter(self.agents)
+
+    def __len__(self):
+        return len(self.agents)
+
+    def keys(self):
+        return list(self.agents)
+
+    def retain(self, agents):
+        """
+        Pins the agents (normally the cohort of the round) and materializes their models, unpinning the previous ones.
+        :param agents:
+        """
+        with self.lock:
+            self.pinned = set(agents)
+            for agent in agents:
+                self[agent]
+            self.enforce_budget()
+
+    def materialize(self, agent):
+        packed = self.packed.pop(agent, None)
+        if packed is None:
+            # Never used, gets its own initialization.
+            model = self.factory()
+        else:
+            model = self.spare if self.spare is not None else self.factory()
+            self.spare = None
+            packed.restore(model)
+            self.materializations += 1
+        self.resident[agent] = model
+        return model
+
+    def evict(self, agent):
+        model = self.resident.pop(agent)
+        if hasattr(model, 'clear_memory'):
+            model.clear_memory()
+        path = os.path.join(self.offload_dir, f"{agent}.bin") if self.offload_dir is not None else None
+        self.packed[agent] = PackedModel.pack(model, path)
+        self.spare = model
+        self.evictions += 1
+
+    def resident_nbytes(self):
+        return sum(model_nbytes(model) for model in self.resident.values())
+
+    def enforce_budget(self, keep=None):
+        """
+        Evicts the least recently used models that are not pinned until the resident ones fit in the budget.
+        :param keep: an agent that must stay resident, besides the pinned ones.
+        """
+        if self.memory_budget is None:
+            return
+        nbytes = {agent: model_nbytes(model) for agent, model in self.resident.items()}
+        used = sum(nbytes.values())
+        for agent in list(self.resident.keys()):
+            if used <= self.memory_budget:
+                break
+            if agent in self.pinned or agent == keep:
+                continue
+            self.evict(agent)
+            used -= nbytes[agent]
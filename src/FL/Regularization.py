@@ -0,0 +1,133 @@
+import torch as T
+from torch.nn.utils import parameters_to_vector
+
+
+class ProximalTerm:
+    """
+    FedProx proximal term, mu / 2 * ||w - w_global||^2. The parameters of the global model are snapshot once per
+    round as one flat vector on the device of the learners, so each learn() step is a single concatenation of the local
+    parameters and one fused reduction, instead of a python loop over the layers that also copies the global model.
+
+    Based on:
+    - https://arxiv.org/abs/1812.06127 | Federated Optimization in Heterogeneous Networks
+    """
+
+    def __init__(self, mu):
+        """
+        :param mu: weight of the proximal term.
+        """
+        self.mu = mu
+        self.anchor = None
+
+    def snapshot(self, model, device=None):
+        """
+        Takes the parameters the local models are pulled towards, normally when a new global model is published.
+        :param model: the global model.
+        :param device: device of the learners, defaults to the device of model.
+        """
+        with T.no_grad():
+            anchor = parameters_to_vector(model.parameters()).detach().clone()
+        self.anchor = anchor.to(device) if device is not None else anchor
+
+    def __call__(self, model):
+        """
+        :param model: the local model.
+        :return: the proximal term, differentiable w.r.t. the parameters of model.
+        """
+        local = parameters_to_vector(model.parameters())
+        if self.anchor.device != local.device:
+            self.anchor = self.anchor.to(local.device)
+        return (self.mu / 2) * T.sum((local - self.anchor) ** 2)
+
+
+class ScaffoldControl:
+    """
+    SCAFFOLD control variates, kept as flat vectors over the parameters of the models. Each local gradient is corrected
+    with c - c_i, so the agents drift less towards their own load when the loads differ across the nodes. After a round
+    each agent updates its variate with option II of the paper:
+        c_i+ = c_i - c + (x - y_i) / (K * lr)
+    x being the parameters the agent started the round from, y_i the ones it ended with and K its local steps. The
+    server variate moves by sum(c_i+ - c_i) / N, N being the number of agents.
+
+    The agents train with AdamW and not plain SGD, so (x - y_i) / (K * lr) is only an estimate of the average gradient.
+
+    Based on:
+    - https://arxiv.org/abs/1910.06378 | SCAFFOLD: Stochastic Controlled Averaging for Federated Learning
+    """
+
+    def __init__(self, model):
+        """
+        :param model: a model with the layout of all the others.
+        """
+        params = list(model.parameters())
+        self.shapes = [param.shape for param in params]
+        self.numels = [param.numel() for param in params]
+        self.device = params[0].device
+        self.server = T.zeros(sum(self.numels), dtype=T.float, device=self.device)
+        self.agents = {}  # agent -> c_i
+        self.starts = {}  # agent -> parameters at the start of its round.
+        self.steps = {}  # agent -> local steps since the start of its round.
+        self.corrections = {}  # agent -> c - c_i, split per parameter. Only changes when the variates do.
+
+    def start_round(self, agent, model):
+        """
+        Called when an agent gets a new model to train from.
+        :param agent:
+        :param model: the agent's model, already loaded.
+        """
+        with T.no_grad():
+            self.starts[agent] = parameters_to_vector(model.parameters()).detach().clone()
+        self.steps[agent] = 0
+
+    def correction(self, agent):
+        if agent not in self.corrections:
+            correction = self.server - self.agents[agent] if agent in self.agents else self.server.clone()
+            self.corrections[agent] = [part.view(shape) for part, shape in
+                                       zip(correction.split(self.numels), self.shapes)]
+        return self.corrections[agent]
+
+    def correct(self, agent, model):
+        """
+        Adds c - c_i to the gradients of the agent's model, between backward() and the optimizer step.
+        :param agent:
+        :param model:
+        """
+        grads = [param.grad for param in model.parameters()]
+        if any(grad is None for grad in grads):
+            for grad, correction in zip(grads, self.correction(agent)):
+                if grad is not None:
+                    grad.add_(correction)
+        else:
+            T._foreach_add_(grads, self.correction(agent))
+        self.steps[agent] = self.steps.get(agent, 0) + 1
+
+    def end_round(self, agent, model, lr):
+        """
+        Updates the variate of an agent once its update is aggregated.
+        :param agent:
+        :param model: the agent's model, with the parameters it sent.
+        :param lr: learning rate of the agent.
+        :return: c_i+ - c_i, None if the agent did not train since it got its model.
+        """
+        start = self.starts.pop(agent, None)
+        steps = self.steps.pop(agent, 0)
+        if start is None or steps == 0:
+            return None
+        with T.no_grad():
+            local = parameters_to_vector(model.parameters()).detach().to(self.device)
+            previous = self.agents.get(agent)
+            previous = previous if previous is not None else T.zeros_like(self.server)
+            updated = previous - self.server + (start - local) / (steps * lr)
+        self.agents[agent] = updated
+        self.corrections.pop(agent, None)
+        return updated - previous
+
+    def update_server(self, deltas, n_agents):
+        """
+        :param deltas: the c_i+ - c_i of the agents aggregated this round.
+        :param n_agents: number of agents in the federation.
+        """
+        if not deltas:
+            return
+        self.server += T.stack(deltas).sum(dim=0) / n_agents
+        self.corrections = {}
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+
+from src.FL.Compression import CompressedTensor, payload_nbytes
+
+
+class DeltaUpdate:
+    """
+    Model update as sent through env.post_updates. Instead of a copy of the whole state_dict it carries the flat
+    difference to a version of the global model, plus the version counters:
+    - base_version: the global version the delta is relative to. None means the delta is the full weights (e.g. an agent
+     that never received the global model).
+    - version: for updates sent by the global, the global version they bring the receiver to. None for local updates.
+
+    The same object is handed to every destination of a fan-out, it must be treated as immutable. The delta can be
+    compressed (a CompressedTensor), see Compression.py.
+
+    The receiver holds the base version already, in this single process setting it is kept as a reference to the
+    codec's copy, so decoding is one addition.
+    """
+    __slots__ = ('delta', 'base_version', 'version', '_base')
+
+    def __init__(self, delta, base=None, base_version=None, version=None):
+        self.delta = delta
+        self._base = base
+        self.base_version = base_version
+        self.version = version
+
+    def decode(self):
+        """
+        :return: the flat weights.
+        """
+        delta = self.decode_delta()
+        return delta if self._base is None else self._base + delta
+
+    def decode_delta(self):
+        """
+        :return: the flat difference to the base version, the full weights when there is no base.
+        """
+        return self.delta.decompress() if isinstance(self.delta, CompressedTensor) else self.delta
+
+    def nbytes(self):
+        return payload_nbytes(self.delta)
+
+
+class UpdateCodec:
+    """
+    Keeps the recent versions of the global model (as flat vectors) and encodes the updates as deltas against them.
+    Every aggregation publishes a new version. The updates of the global are cached per base version, so the agents
+    that acknowledged the same version share one DeltaUpdate.
+    """
+
+    def __init__(self, aggregator, max_versions=16, upload_compressor=None, download_compressor=None):
+        """
+        :param aggregator: FlatAggregator with the layout of the models.
+        :param max_versions: how many global versions are kept. Agents that are further behind get full updates.
+        :param upload_compressor: Compressor for the updates of the agents, the sender is the key of its state.
+        :param download_compressor: Compressor for the updates of the global model.
+        """
+        self.aggregator = aggregator
+        self.max_versions = max_versions
+        self.upload_compressor = upload_compressor
+        self.download_compressor = download_compressor
+        self.versions = OrderedDict()
+        self.version = -1
+        self.cache = {}
+
+    def publish(self, flat):
+        """
+        Registers a new version of the global model.
+        :param flat: the flat weights of the global model, owned by the codec from now on.
+        :return: the new version.
+        """
+        self.version += 1
+        self.versions[self.version] = flat.detach()
+        while len(self.versions) > self.max_versions:
+            self.versions.popitem(last=False)
+        self.cache = {}
+        return self.version
+
+    def encode(self, flat, base_version=None, version=None, compressor=None, key=None):
+        """
+        Limitation: the delta is taken against, and decoded onto (FLAgent.decode_update), the codec's exact copy of
+        base_version. With a lossy download_compressor the receivers are modelled as holding that exact base, not what
+        they reconstructed from the previous compressed update, so the compression error never accumulates across
+        versions as it would on real receivers.
+        :param flat: flat weights to send.
+        :param base_version: global version the receiver holds. When it is no longer kept the full weights are sent.
+        :param version: global version the update brings the receiver to, for the updates of the global model. None for
+        the local updates of the agents.
+        :param compressor: optional Compressor for the delta.
+        :param key: the sender, for the compressors with state.
+        :return: DeltaUpdate
+        """
+        base = self.versions.get(base_version)
+        if base is None:
+            full = flat.detach()
+            if compressor is not None and compressor.applies_to_full:
+                full = compressor.compress(full, key)
+            return DeltaUpdate(full, version=version)
+        delta = flat.detach() - base
+        if compressor is not None:
+            delta = compressor.compress(delta, key)
+        return DeltaUpdate(delta, base=base, base_version=base_version, version=version)
+
+    def encode_model(self, model, base_version=None, key=None):
+        return self.encode(self.aggregator.flatten(model.state_dict()), base_version,
+                           compressor=self.upload_compressor, key=key)
+
+    def encode_global(self, base_version=None):
+        """
+        :param base_version: global version the receiver holds.
+        :return: DeltaUpdate bringing the receiver to the latest global version, shared by all the receivers with the
+        same base version.
+        """
+        key = base_version if base_version in self.versions else None
+        if key not in self.cache:
+            self.cache[key] = self.encode(self.versions[self.version], key, version=self.version,
+                                          compressor=self.download_compressor)
+        return self.cache[key]
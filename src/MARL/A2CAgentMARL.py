@@ -3,9 +3,15 @@ from peersim_gym.envs.PeersimEnv import PeersimEnv
 from torchsummary import summary
 
 import torch as T
+import torch.nn.functional as F
+from torch.distributions import Categorical
 from src.MARL.Agent import Agent
 from src.MARL.Networks.A2C import ActorCritic
+from src.MARL.Networks.GNN import GraphActorCritic
+from src.MARL.Networks.Stacked import StackedMLP
 from src.Utils import utils
+from src.Utils.ReturnHelper import discounted_returns
+from src.Utils.RolloutBuffer import RolloutBuffer
 
 import peersim_gym.envs.PeersimEnv as pe
 from src.Utils.MetricHelper import MetricHelper as mh
@@ -22,7 +28,8 @@ class A2CAgentMARL(Agent):
 
     def __init__(self, input_shape, action_space, output_shape, agents, learning_rate=0.7, gamma=0.4,
                  steps_for_return=150,
-                 collect_data=False, save_interval=50, control_type="A2C"):
+                 collect_data=False, save_interval=50, control_type="A2C", shared=False, network="MLP",
+                 neighbour_matrix=None):
         super().__init__(input_shape, action_space, output_shape, learning_rate, collect_data=collect_data)
         self.steps_for_return = steps_for_return
         self.gamma = gamma
@@ -32,26 +39,47 @@ class A2CAgentMARL(Agent):
 
         self.A2Cs = {}
         self.action_shape = output_shape
-        for agent in self.possible_agents:
+        self.agent_idx = {agent: idx for idx, agent in enumerate(self.possible_agents)}
+        # In shared mode a single network is used by every agent. The node ID in the flattened observation tells the
+        # agents apart, and the actions past each agent's neighbourhood size are masked out.
+        self.shared = shared
+        # With network="GNN" a single GraphActorCritic decides for every agent with message passing over the topology
+        # in neighbour_matrix (env.neighbourMatrix). It is shared by definition.
+        self.network = network
+        if self.network == "GNN":
+            if neighbour_matrix is None:
+                raise ValueError("The GNN network needs the neighbour_matrix of the environment.")
+            self.shared = True
+            self.graph_A2C = GraphActorCritic(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512,
+                                              fc2_dims=128, fc3_dims=128, gamma=self.gamma,
+                                              neighbour_matrix=neighbour_matrix,
+                                              agent_nodes=[int(agent.split("_")[1]) for agent in self.possible_agents])
+            # The slots past each node's neighbourhood are masked by the network itself.
+            self.A2Cs = {agent: self.graph_A2C for agent in self.possible_agents}
+        elif self.shared:
+            shared_A2C = ActorCritic(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512, fc2_dims=256,
+                                     fc3_dims=128,
+                                     n_actions=max(output_shape[agent] for agent in self.possible_agents))
+            summary(shared_A2C, input_size=self.input_shape)
+            self.A2Cs = {agent: shared_A2C for agent in self.possible_agents}
+            self.action_masks = T.from_numpy(utils.action_masks(output_shape, self.possible_agents)).to(shared_A2C.device)
+        for agent in self.possible_agents if not self.shared else []:
             rank = output_shape[agent]
             self.A2Cs[agent] = ActorCritic(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512, fc2_dims=256,
                                            fc3_dims=128,
                                            n_actions=rank)
             summary(self.A2Cs[agent], input_size=self.input_shape)
+        if not self.shared:
+            # Used to pick the actions of all the agents in one pass, see get_actions.
+            self.stacked_A2Cs = StackedMLP([self.A2Cs[agent] for agent in self.possible_agents],
+                                           trunk=['fc11', 'fc12', 'fc21', 'fc22', 'fc31', 'fc32'], heads=['actor'])
 
         self.amount_of_metrics = 50
         self.last_losses = np.zeros(self.amount_of_metrics)
         self.last_rewards = np.zeros(self.amount_of_metrics)
 
-        self.agent_states = {
-            agent: {
-                'state': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': []
-            } for agent in agents
-        }
+        # Rollout of each agent since the last update, written in place and rewound after every update.
+        self.agent_states = RolloutBuffer(agents=agents, capacity=self.steps_for_return)
 
     def train_loop(self, env: PeersimEnv, num_episodes, print_instead=True, controllers=None, warm_up_file=None,
                    load_weights=None,
@@ -65,9 +93,10 @@ class A2CAgentMARL(Agent):
                      file_name=results_file + "_result")
 
         if load_weights is not None:
-            for idx, agent in enumerate(env.possible_agents):
+            for idx, agent in enumerate(self.__checkpointed_agents(env.possible_agents)):
                 agent_w = load_weights + f"_{agent}.pth.tar"
                 self.A2Cs[agent].load_checkpoint(agent_w)
+            self.__invalidate_stacked()
 
         for i in tqdm(range(num_episodes)):
             # Prepare variables for the next run
@@ -84,8 +113,7 @@ class A2CAgentMARL(Agent):
             while not utils.is_done(dones):
                 print(f'Step: {step}\n')
                 # Interaction Step:
-                targets = {agent: np.floor(self.get_action(np.array([states[idx]])[0], agent)) for idx, agent in
-                           enumerate(agent_list)}
+                targets = {agent: np.floor(action) for agent, action in self.get_actions(states, agent_list).items()}
                 actions = utils.make_action(targets, agent_list)
 
                 self.mh.register_actions(actions)
@@ -93,10 +121,9 @@ class A2CAgentMARL(Agent):
                 next_states, rewards, dones, _, info = env.step(actions)
                 next_states = utils.flatten_state_list(states=next_states, agents=agent_list)
 
-                for idx, agent in enumerate(agent_list):
-                    total_reward_in_step = self.__store_agent_step_data(states, actions, rewards, next_states, dones,
-                                                                        agent_list)
-                    score += total_reward_in_step
+                total_reward_in_step = self.__store_agent_step_data(states, actions, rewards, next_states, dones,
+                                                                    agent_list)
+                score += total_reward_in_step
 
                 # Advance to next iter
                 states = next_states
@@ -106,11 +133,16 @@ class A2CAgentMARL(Agent):
                 if step % steps_per_return == 0 or self.check_all_done(dones):
                     # Here we will learn the paths from all the agents
                     print("Training...")
-                    for agent in agent_list:
+                    if self.network == "GNN":
+                        last_losses = self.learn_graph(agent_list)
+                    elif self.shared:
+                        last_losses = self.learn_shared(agent_list)
+                    for agent in agent_list if self.network != "GNN" and not self.shared else []:
                         s, a, r, s_next, fin = self.__get_agent_step_data(agent)
-                        if s and a and r and s_next and fin:  # Check if fin is always not empty as well
+                        if self.agent_states.count(agent) > 0:
                             last_loss = self.learn(s=s, a=a, r=r, s_next=s_next, k=step, fin=fin, agent=agent)
                             last_losses[agent] = last_loss if not last_loss is None else 0
+                    self.__invalidate_stacked()
                     self.__clean_agent_step_data(agent_list)
 
                 print(f'Action{actions}  -   Loss: {last_losses}  -    Rewards: {rewards}')
@@ -128,7 +160,7 @@ class A2CAgentMARL(Agent):
             self.mh.print_action_density_episode()
             self.mh.compile_aggregate_metrics(i, step)
             if i % self.save_interval == 0:
-                for agent in env.agents:
+                for agent in self.__checkpointed_agents(env.agents):
                     self.A2Cs[agent].save_checkpoint(filename=f"{self.control_type}_value_{i}_{agent}.pth.tar", epoch=i)
 
             print("Episode {0}/{1}, Score: {2}, AVG Score: {3}".format(i, num_episodes, score,
@@ -143,47 +175,150 @@ class A2CAgentMARL(Agent):
     def learn(self, s, a, r, s_next, k, fin, agent):
         self.A2Cs[agent].remember_batch(states=s, actions=a, rewards=r, next_states=s_next, dones=fin)  # States should be ordered.
         self.A2Cs[agent].optimizer.zero_grad()
-        loss = self.A2Cs[agent].calculate_loss(fin)
+        loss = self.A2Cs[agent].calculate_loss(fin, self.action_masks[self.agent_idx[agent]] if self.shared else None)
         loss.backward()
         T.nn.utils.clip_grad_value_(self.A2Cs[agent].parameters(), 10)
         self.A2Cs[agent].optimizer.step()
         self.A2Cs[agent].clear_memory()
         return loss.item()
 
+    def learn_shared(self, agent_list):
+        """
+        Trains the shared network on the rollouts of all the agents in agent_list at once: the rollouts are
+        concatenated into a single batch, so there is one forward pass, one backward pass and one optimizer step per
+        call. The returns are still computed per agent, each bootstrapped from the value of its own last state, and the
+        logits of each transition are masked with the actions of its agent.
+        :param agent_list:
+        :return: dict with the loss of each agent (its share of the batch loss).
+        """
+        last_losses = {agent: 0 for agent in agent_list}
+        agents = [agent for agent in agent_list if self.agent_states.count(agent) > 0]
+        if not agents:
+            return last_losses
+        shared_A2C = self.A2Cs[agents[0]]
+        device = shared_A2C.device
+        rollouts = [self.agent_states.get(agent) for agent in agents]
+        lengths = [self.agent_states.count(agent) for agent in agents]
+        rows = T.repeat_interleave(T.arange(len(agents), device=device), T.tensor(lengths, device=device))
+
+        states = T.cat([T.as_tensor(rollout['state'], dtype=T.float, device=device) for rollout in rollouts])
+        actions = T.cat([T.as_tensor(rollout['action'], dtype=T.long, device=device).reshape(-1)
+                         for rollout in rollouts]).unsqueeze(1)
+        with T.no_grad():
+            last_states = T.stack([T.as_tensor(rollout['next_state'][-1], dtype=T.float, device=device)
+                                   for rollout in rollouts])
+            _, v_last = shared_A2C.forward(last_states)
+        returns = T.cat([discounted_returns(T.as_tensor(rollout['reward'], dtype=T.float, device=device).reshape(-1),
+                                            T.as_tensor(rollout['done'], device=device).reshape(-1),
+                                            v_last[idx, 0], shared_A2C.gamma)
+                         for idx, rollout in enumerate(rollouts)])
+
+        actor_logits, critic_values = shared_A2C.forward(states)
+        critic_values = critic_values.squeeze(1)
+        agent_rows = T.tensor([self.agent_idx[agent] for agent in agents], device=device)
+        actor_logits = actor_logits.masked_fill(~self.action_masks[agent_rows][rows], -float('inf'))
+        advantages = returns - critic_values
+        log_probs = T.log(F.softmax(actor_logits, dim=1).gather(1, actions)).squeeze(1)
+        element_losses = -log_probs * advantages.detach() + F.smooth_l1_loss(critic_values, returns.detach(),
+                                                                             reduction='none')
+        loss = element_losses.mean()
+
+        shared_A2C.optimizer.zero_grad()
+        loss.backward()
+        T.nn.utils.clip_grad_value_(shared_A2C.parameters(), 10)
+        shared_A2C.optimizer.step()
+
+        agent_losses = T.zeros(len(agents), device=device).index_add_(0, rows, element_losses.detach())
+        agent_losses = agent_losses / T.tensor(lengths, dtype=T.float, device=device)
+        for agent, agent_loss in zip(agents, agent_losses.tolist()):
+            last_losses[agent] = agent_loss
+        return last_losses
+
+    def learn_graph(self, agent_list):
+        """
+        Trains the GraphActorCritic on the rollouts of all the agents at once. The rollouts are stored for every agent
+        at every step, so they are stacked into (T, n_agents, ...) and the network sees every step as one graph.
+        :param agent_list:
+        :return: dict with the loss of each agent, all the agents share the same loss.
+        """
+        if any(self.agent_states.count(agent) == 0 for agent in self.possible_agents):
+            return {agent: 0 for agent in agent_list}
+        rollouts = [self.agent_states.get(agent) for agent in self.possible_agents]
+        s, a, r, s_next, fin = [T.stack([rollout[field] for rollout in rollouts], dim=1)
+                                for field in ['state', 'action', 'reward', 'next_state', 'done']]
+        self.graph_A2C.remember_batch(states=s, actions=a, rewards=r, next_states=s_next, dones=fin)
+        self.graph_A2C.optimizer.zero_grad()
+        loss = self.graph_A2C.calculate_loss(fin)
+        loss.backward()
+        T.nn.utils.clip_grad_value_(self.graph_A2C.parameters(), 10)
+        self.graph_A2C.optimizer.step()
+        self.graph_A2C.clear_memory()
+        return {agent: loss.item() for agent in agent_list}
+
     def get_action(self, observation, agent):
+        if self.shared:
+            return self.get_actions([observation], [agent])[agent]
         self.A2Cs[agent].eval()
         with T.no_grad():
             action = self.A2Cs[agent].choose_action(observation)
         self.A2Cs[agent].train()
         return action
 
+    def get_actions(self, observations, agent_list):
+        """
+        Samples the actions of all the agents at once, with a single batched forward pass over the stacked observations.
+        :param observations: list/array of flattened observations, ordered like agent_list.
+        :param agent_list:
+        :return: dict with the action of each agent.
+        """
+        rows = None if list(agent_list) == list(self.possible_agents) else \
+            T.tensor([self.agent_idx[agent] for agent in agent_list])
+        with T.no_grad():
+            if self.network == "GNN":
+                # The graph needs the observations of every agent, the ones not in agent_list are left empty.
+                state = T.zeros((len(self.possible_agents), *self.input_shape), dtype=T.float,
+                                device=self.graph_A2C.device)
+                members = slice(None) if rows is None else rows.to(self.graph_A2C.device)
+                state[members] = T.tensor(np.array(observations), dtype=T.float).to(self.graph_A2C.device)
+                logits = self.graph_A2C.forward(state)[0][members]
+            elif self.shared:
+                # One batched pass of the shared network, with the observations of all the agents as the batch.
+                shared_A2C = self.A2Cs[agent_list[0]]
+                state = T.tensor(np.array(observations), dtype=T.float).to(shared_A2C.device)
+                masks = self.action_masks if rows is None else self.action_masks[rows.to(shared_A2C.device)]
+                logits = shared_A2C.forward(state)[0].masked_fill(~masks, -float('inf'))
+            else:
+                state = T.tensor(np.array(observations), dtype=T.float).to(self.stacked_A2Cs.device)
+                logits = self.stacked_A2Cs.forward(state, rows)['actor']
+                logits = self.stacked_A2Cs.masked_head('actor', logits, rows)
+            actions = Categorical(logits=logits).sample().cpu().numpy()
+        return {agent: actions[idx] for idx, agent in enumerate(agent_list)}
+
+    def __invalidate_stacked(self):
+        if not self.shared:
+            self.stacked_A2Cs.invalidate()
+
+    def __checkpointed_agents(self, agents):
+        """
+        In shared mode all the agents have the same network, so only one checkpoint is kept (named after the first
+        agent).
+        """
+        return list(agents)[:1] if self.shared else agents
+
     def __store_agent_step_data(self, states, actions, rewards, next_states, dones, agent_list):
-        total_rwrd = 0
-        for idx, agent in enumerate(agent_list):
-            # Update history
-            agent_data = self.agent_states[agent]
-            agent_data['state'].append(states[idx])
-            agent_data['action'].append(actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD])
-            agent_data['reward'].append(rewards[agent])
-            agent_data['next_state'].append(next_states[idx])
-            agent_data['done'].append(dones[agent])
-            total_rwrd += rewards[agent]
-        return total_rwrd
+        self.agent_states.store(agent_list, states=states,
+                                actions=[actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD] for agent in agent_list],
+                                rewards=[rewards[agent] for agent in agent_list], next_states=next_states,
+                                dones=[dones[agent] for agent in agent_list])
+        return sum(rewards[agent] for agent in agent_list)
 
     def __get_agent_step_data(self, agent):
-        agent_data = self.agent_states[agent]
-        return agent_data['state'], agent_data['action'], agent_data['reward'], agent_data['next_state'], agent_data[
-            'done']
+        agent_data = self.agent_states.get(agent)
+        return agent_data.get('state'), agent_data.get('action'), agent_data.get('reward'), \
+            agent_data.get('next_state'), agent_data.get('done')
 
     def __clean_agent_step_data(self, agents):
-        for agent in agents:
-            self.agent_states[agent] = {
-                'state': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': []
-            }
+        self.agent_states.reset(agents)
 
     def tally_actions(self, actions):
         for worker, action in actions.items():
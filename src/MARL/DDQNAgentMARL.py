@@ -7,7 +7,9 @@ import torch.optim as optim
 from torchsummary import summary
 
 from src.MARL.Agent import Agent
-from src.MARL.Networks.DQN import DQN
+from src.MARL.Networks.DQN import DQN, DQNEnsemble
+from src.MARL.Networks.Stacked import StackedMLP
+from src.MARL.ReplayBuffer import MultiAgentReplayBuffer, PrioritizedMultiAgentReplayBuffer
 from src.Utils import utils as utils
 import peersim_gym.envs.PeersimEnv as pe
 from src.Utils.MetricHelper import MetricHelper as mh
@@ -32,7 +34,8 @@ class DDQNAgentMARL(Agent):
 
     def __init__(self, input_shape, action_spaces, output_shape, batch_size, memory_max_size=10000, epsilon_start=0.7,
                  epsilon_decay=5e-4, gamma=0.7, epsilon_end=0.01, update_interval=150, learning_rate=0.7,
-                 collect_data=False, save_interval=50, control_type="DQN_MARL", agents=None):
+                 collect_data=False, save_interval=50, control_type="DQN_MARL", agents=None, ensemble=False,
+                 prioritized=False, priority_alpha=0.6, priority_beta=0.4, priority_beta_increment=1e-4, shared=False):
         super().__init__(input_shape, action_spaces, output_shape, memory_max_size, collect_data=collect_data)
 
         self.possible_agents = agents
@@ -48,17 +51,15 @@ class DDQNAgentMARL(Agent):
 
         # Replay Buffer
         self.memory_size = memory_max_size
-        self.state_memory = {agent: np.zeros((self.memory_size, *self.input_shape), dtype=np.float32) for agent in
-                             self.possible_agents}
-        self.reward_memory = {agent: np.zeros(self.memory_size, dtype=np.float32) for agent in
-                              self.possible_agents}
-        self.action_memory = {agent: np.zeros((self.memory_size, 1), dtype=np.float32) for agent in
-                              self.possible_agents}  # Hard coded, represents the target only
-        self.new_state_memory = {agent: np.zeros((self.memory_size, *self.input_shape), dtype=np.float32) for agent in
-                                 self.possible_agents}
-        self.terminal_memory = {agent: np.zeros(self.memory_size, dtype=bool) for agent in
-                                self.possible_agents}
-        self.memory_counter = 0
+        # With prioritized replay transitions are sampled proportionally to their last TD error, see learn_all.
+        self.prioritized = prioritized
+        if self.prioritized:
+            self.memory = PrioritizedMultiAgentReplayBuffer(agents=self.possible_agents, capacity=self.memory_size,
+                                                            input_shape=self.input_shape, alpha=priority_alpha,
+                                                            beta=priority_beta, beta_increment=priority_beta_increment)
+        else:
+            self.memory = MultiAgentReplayBuffer(agents=self.possible_agents, capacity=self.memory_size,
+                                                 input_shape=self.input_shape)
         self.control_type = "DDQN_MARL"
 
         # Networks - For some reaon couldn't use the original constructor on the laptop. This has taken too much time
@@ -67,7 +68,30 @@ class DDQNAgentMARL(Agent):
         self.Q_values = {}
         self.target_Q_values = {}
         self.action_shape = output_shape
-        for agent in self.possible_agents:
+        # In ensemble mode all the agents' networks live in one DQNEnsemble and are trained with one fused update.
+        self.ensemble = ensemble
+        # In shared mode a single network (and target) is used by every agent. The node ID in the flattened
+        # observation tells the agents apart, and the actions past each agent's neighbourhood size are masked out.
+        self.shared = shared
+        if self.ensemble and self.shared:
+            raise ValueError("The ensemble and shared modes can not be used together.")
+        if self.shared:
+            shared_Q = DQN(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512, fc2_dims=256, fc3_dims=128,
+                           n_actions=max(output_shape[agent] for agent in self.possible_agents))
+            shared_target_Q = DQN(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512, fc2_dims=256,
+                                  fc3_dims=128, n_actions=shared_Q.n_actions)
+            shared_target_Q.load_state_dict(shared_Q.state_dict())
+            self.Q_values = {agent: shared_Q for agent in self.possible_agents}
+            self.target_Q_values = {agent: shared_target_Q for agent in self.possible_agents}
+            self.action_masks = T.from_numpy(utils.action_masks(output_shape, self.possible_agents)).to(shared_Q.device)
+        if self.ensemble:
+            ranks = [output_shape[agent] for agent in self.possible_agents]
+            self.Q_ensemble = DQNEnsemble(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512, fc2_dims=256,
+                                          fc3_dims=128, n_actions=ranks)
+            self.target_Q_ensemble = DQNEnsemble(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512,
+                                                 fc2_dims=256, fc3_dims=128, n_actions=ranks)
+            self.target_Q_ensemble.load_state_dict(self.Q_ensemble.state_dict())
+        for agent in self.possible_agents if not (self.ensemble or self.shared) else []:
             rank = output_shape[agent]
             self.Q_values[agent] = DQN(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512, fc2_dims=256, fc3_dims=128,
                                        n_actions=rank)
@@ -75,8 +99,13 @@ class DDQNAgentMARL(Agent):
                                               fc3_dims=128, n_actions=rank)
             self.target_Q_values[agent].load_state_dict(self.Q_values[agent].state_dict())
 
+        if not (self.ensemble or self.shared):
+            # Used to pick the actions of all the agents in one pass, see get_actions.
+            self.stacked_Q_values = StackedMLP([self.Q_values[agent] for agent in self.possible_agents],
+                                               trunk=['fc11', 'fc21', 'fc31'], heads=['out'])
+
         self.save_interval = save_interval
-        for agent in self.possible_agents:
+        for agent in (self.possible_agents[:1] if self.shared else self.possible_agents) if not self.ensemble else []:
             summary(self.Q_values[agent], input_size=self.input_shape)
             summary(self.target_Q_values[agent], input_size=self.input_shape)
 
@@ -95,10 +124,7 @@ class DDQNAgentMARL(Agent):
             self.warm_up(warm_up_file, env.possible_agents)
 
         if load_weights is not None: # Not implemented for MARL yet.
-            for idx, agent in enumerate(env.possible_agents):
-                agent_w = load_weights + f"_{agent}.pth.tar"
-                self.Q_values[agent].load_checkpoint(agent_w)
-                self.target_Q_values[agent].load_checkpoint(agent_w)
+            self.load_networks(load_weights, env.possible_agents)
 
         for i in range(num_episodes):
             # Prepare variables for the next run
@@ -114,8 +140,7 @@ class DDQNAgentMARL(Agent):
             while not utils.is_done(dones):
                 print(f'Step: {step}\n')
                 # Interaction Step:
-                targets = {agent: np.floor(self.get_action(states[idx], agent)) for idx, agent in
-                           enumerate(agent_list)}
+                targets = {agent: np.floor(action) for agent, action in self.get_actions(states, agent_list).items()}
                 actions = utils.make_action(targets, agent_list)
 
                 # self.tally_actions(actions)
@@ -123,26 +148,24 @@ class DDQNAgentMARL(Agent):
 
                 next_states, rewards, dones, _, info = env.step(actions)
                 next_states = utils.flatten_state_list(next_states, agent_list)
-                for idx, agent in enumerate(agent_list):
-                    # Update history
-                    self.__store_transition(states[idx], actions[agent]['neighbourIndex'], rewards[agent],
-                                            next_states[idx], dones[agent], agent, idx)
-                    score += rewards[agent]
+                # Update history, all the agents are stored at once.
+                self.memory.store_transitions(states=states,
+                                              actions=[actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD] for agent in agent_list],
+                                              rewards=[rewards[agent] for agent in agent_list],
+                                              next_states=next_states,
+                                              dones=[dones[agent] for agent in agent_list],
+                                              agent_list=agent_list)
+                score += sum(rewards[agent] for agent in agent_list)
                 # Advance to next iter
                 states = next_states
 
                 # Learn
-                last_losses = {agent: 0 for agent in agent_list}
-                for agent in agent_list:
-                    last_loss = self.learn(s=self.state_memory, a=self.action_memory, r=self.reward_memory,
-                                           s_next=self.new_state_memory, k=step, fin=self.terminal_memory, agent=agent)
-                    last_losses[agent] = last_loss if not last_loss is None else 0
+                last_losses = self.learn_all(agent_list, k=step)
 
                 print(f'Action(e:{self.epsilon}) {actions}  -   Loss: {last_losses}  -    Rewards: {rewards}')
 
                 if step != 0 and (step % self.update_interval == 0 or dones):
-                    for agent in env.agents:
-                        self.target_Q_values[agent].load_state_dict(self.Q_values[agent].state_dict())
+                    self.update_target_networks(env.agents)
 
                 step += 1
                 self.mh.update_metrics_after_step(rewards=rewards,
@@ -160,8 +183,7 @@ class DDQNAgentMARL(Agent):
             print("Episode {0}/{1}, Score: {2} ({3}), AVG Score: {4}".format(i, num_episodes, score, self.epsilon,
                                                                              self.mh.episode_average_reward(i)))
             if i % self.save_interval == 0:
-                for agent in env.agents:
-                    self.Q_values[agent].save_checkpoint(filename=f"DDQN_Q_value_{i}_{agent}.pth.tar", epoch=i)
+                self.save_networks(f"DDQN_Q_value_{i}", env.agents, epoch=i)
 
         if results_file is not None:
             self.mh.store_as_cvs(results_file)
@@ -171,6 +193,87 @@ class DDQNAgentMARL(Agent):
 
         env.close()
 
+    def train_loop_vectorized(self, vec_env, num_episodes, print_instead=True, warm_up_file=None, load_weights=None,
+                              results_file=None):
+        """
+        Same as train_loop, but the experience comes from the K simulators of a VecPeersimEnv stepped in parallel. The
+        transitions of every environment go to the replay buffer, and the networks are trained once per vectorized
+        step. The episodes and the metrics are the ones of the first environment, the others only add experience.
+        :param vec_env: VecPeersimEnv
+        :param num_episodes: episodes of the first environment.
+        """
+        self.mh = mh(agents=vec_env.possible_agents, num_nodes=vec_env.number_nodes, num_episodes=num_episodes,
+                     file_name=results_file + "_result")
+        self.dg = dg(agents=vec_env.possible_agents)
+        if warm_up_file is not None:
+            self.warm_up(warm_up_file, vec_env.possible_agents)
+
+        if load_weights is not None:
+            self.load_networks(load_weights, vec_env.possible_agents)
+
+        states = vec_env.reset()
+        agent_list = vec_env.agents
+        step = 0
+        for i in range(num_episodes):
+            episode_done = False
+            episode_step = 0
+            score = 0.0
+            while not episode_done:
+                print(f'Step: {step}\n')
+                # One batched pass per environment, the K actions are then sent together.
+                actions = []
+                for k in range(len(vec_env)):
+                    targets = {agent: np.floor(action) for agent, action in self.get_actions(states[k], agent_list).items()}
+                    actions.append(utils.make_action(targets, agent_list))
+                self.mh.register_actions(actions[0])
+
+                next_states, rewards, dones, infos = vec_env.step(actions)
+                for k in range(len(vec_env)):
+                    # Finished environments were already reset, the transition ends in the terminal state.
+                    s_next = infos[k].get('terminal_observation', next_states[k])
+                    self.memory.store_transitions(states=states[k],
+                                                  actions=[actions[k][agent][pe.ACTION_NEIGHBOUR_IDX_FIELD] for agent in agent_list],
+                                                  rewards=rewards[k],
+                                                  next_states=s_next,
+                                                  dones=dones[k],
+                                                  agent_list=agent_list)
+                score += rewards[0].sum()
+                states = next_states
+
+                last_losses = self.learn_all(agent_list, k=step)
+                print(f'Action(e:{self.epsilon}) {actions[0]}  -   Loss: {last_losses}  -    Rewards: {rewards[0]}')
+
+                episode_done = bool(dones[0].all())
+                if step != 0 and (step % self.update_interval == 0 or episode_done):
+                    self.update_target_networks(agent_list)
+
+                step += 1
+                episode_step += 1
+                info = infos[0]
+                self.mh.update_metrics_after_step(rewards={agent: rewards[0][idx] for idx, agent in enumerate(agent_list)},
+                                                  losses=last_losses,
+                                                  overloaded_nodes=info[pg.STATE_G_OVERLOADED_NODES],
+                                                  average_response_time=info[pg.STATE_G_AVERAGE_COMPLETION_TIMES],
+                                                  occupancy=info[pg.STATE_G_OCCUPANCY],
+                                                  dropped_tasks=info[pg.STATE_G_DROPPED_TASKS],
+                                                  finished_tasks=info[pg.STATE_G_FINISHED_TASKS],
+                                                  total_tasks=info[pg.STATE_G_TOTAL_TASKS],
+                                                  consumed_energy=info[pg.STATE_G_CONSUMED_ENERGY])
+
+            self.mh.print_action_density_episode()
+            self.mh.compile_aggregate_metrics(i, episode_step)
+            print("Episode {0}/{1}, Score: {2} ({3}), AVG Score: {4}".format(i, num_episodes, score, self.epsilon,
+                                                                             self.mh.episode_average_reward(i)))
+            if i % self.save_interval == 0:
+                self.save_networks(f"DDQN_Q_value_{i}", agent_list, epoch=i)
+
+        if results_file is not None:
+            self.mh.store_as_cvs(results_file)
+        self.mh.plot_agent_metrics(num_episodes=num_episodes, title=self.control_type, print_instead=print_instead)
+        self.mh.plot_simulation_data(num_episodes=num_episodes, title=self.control_type, print_instead=print_instead)
+        self.mh.clean_plt_resources()
+
+        vec_env.close()
 
     def get_action(self, observation, agent, pre_train_policy=False):
         """
@@ -208,49 +311,128 @@ class DDQNAgentMARL(Agent):
             # https://stackoverflow.com/questions/58447885/pytorch-going-back-and-forth-between-eval-and-train-modes
             # https://pytorch.org/tutorials/intermediate/reinforcement_q_learning.html
 
+            if self.ensemble:
+                with T.no_grad():
+                    state = T.tensor(np.array([observation]), dtype=T.float32).to(self.Q_ensemble.device)
+                    actions = self.Q_ensemble.forward_member(state, self.memory.agent_idx[agent])
+                return T.argmax(actions).item()
+
             self.Q_values[agent].eval()
             with T.no_grad():
                 state = T.tensor(np.array([observation]), dtype=T.float32).to(self.Q_values[agent].device)
                 actions = self.Q_values[agent].forward(state)
+                if self.shared:
+                    actions = actions.masked_fill(~self.action_masks[self.memory.agent_idx[agent]], -float('inf'))
             self.Q_values[agent].train()
             # We get the index of the highest Q value. This is returned in a tensor, we use item() to convertit to
             # a scaler
             action = T.argmax(actions).item()
         return action
 
-    def __store_transition(self, state, action, reward, n_state, done, agent, idx_agent):
-        index = self.memory_counter % self.memory_size  # Allows overwriting old memories
-        self.state_memory[agent][index] = state
-
-        self.action_memory[agent][index] = action
-        self.reward_memory[agent][index] = reward
-        self.new_state_memory[agent][index] = n_state
-        self.terminal_memory[agent][index] = done
-        self.memory_counter += 1
+    def get_actions(self, observations, agent_list):
+        """
+        Epsilon-greedy action selection for all the agents at once. The exploring agents draw a random action, the
+        Q values of the others are computed with a single batched forward pass over the stacked observations.
+        :param observations: list/array of flattened observations, ordered like agent_list.
+        :param agent_list:
+        :return: dict with the action of each agent.
+        """
+        n_agents = len(agent_list)
+        n_actions = np.array([self.actions[agent] for agent in agent_list])
+        actions = np.floor(np.random.random(n_agents) * n_actions).astype(np.int64)
+        exploit = np.random.random(n_agents) >= self.epsilon
+        if exploit.any():
+            rows = None if list(agent_list) == self.memory.agents else T.from_numpy(self.memory.rows(agent_list))
+            with T.no_grad():
+                if self.ensemble:
+                    # The ensemble runs every member, agents not in agent_list get an empty observation.
+                    members = slice(None) if rows is None else rows
+                    state = T.zeros((self.Q_ensemble.n_members, 1, *self.input_shape), dtype=T.float32,
+                                    device=self.Q_ensemble.device)
+                    state[members, 0] = T.tensor(np.array(observations), dtype=T.float32).to(self.Q_ensemble.device)
+                    q_values = self.Q_ensemble.mask_invalid(self.Q_ensemble.forward(state))[members, 0]
+                elif self.shared:
+                    # One batched pass of the shared network, with the observations of all the agents as the batch.
+                    shared_Q = self.Q_values[agent_list[0]]
+                    state = T.tensor(np.array(observations), dtype=T.float32).to(shared_Q.device)
+                    masks = self.action_masks if rows is None else self.action_masks[rows.to(shared_Q.device)]
+                    q_values = shared_Q.forward(state).masked_fill(~masks, -float('inf'))
+                else:
+                    state = T.tensor(np.array(observations), dtype=T.float32).to(self.stacked_Q_values.device)
+                    q_values = self.stacked_Q_values.forward(state, rows)['out']
+                    q_values = self.stacked_Q_values.masked_head('out', q_values, rows)
+            greedy = T.argmax(q_values, dim=-1).cpu().numpy()
+            actions = np.where(exploit, greedy, actions)
+        return {agent: actions[idx] for idx, agent in enumerate(agent_list)}
+
+    def learn_all(self, agent_list, k):
+        """
+        Samples one batch for every agent in a single call to the replay buffer and then trains each agent on its own
+        batch.
+        :param agent_list:
+        :param k:
+        :return: dict with the last loss of each agent.
+        """
+        last_losses = {agent: 0 for agent in agent_list}
+        if not self.memory.ready(self.batch_size, agent_list):
+            return last_losses
+        if self.prioritized:
+            s, a, r, s_next, fin, batch, weights = self.memory.sample(self.batch_size)
+        else:
+            s, a, r, s_next, fin = self.memory.sample(self.batch_size)
+            weights = None
+        if self.ensemble:
+            member_losses, td_errors = self.learn_ensemble(s=s, a=a, r=r, s_next=s_next, fin=fin,
+                                                           agents=agent_list, weights=weights)
+            for agent in agent_list:
+                last_losses[agent] = member_losses[self.memory.agent_idx[agent]]
+        elif self.shared:
+            agent_losses, td_errors = self.learn_shared(s=s, a=a, r=r, s_next=s_next, fin=fin,
+                                                        agents=agent_list, weights=weights)
+            for agent in agent_list:
+                last_losses[agent] = agent_losses[self.memory.agent_idx[agent]]
+        else:
+            td_errors = np.zeros(a.shape, dtype=np.float32)
+            for agent in agent_list:
+                row = self.memory.agent_idx[agent]
+                last_loss, td_errors[row] = self.__learn_agent(s=s[row], a=a[row], r=r[row], s_next=s_next[row],
+                                                               fin=fin[row], agent=agent,
+                                                               weights=None if weights is None else weights[row])
+                last_losses[agent] = last_loss if not last_loss is None else 0
+            self.stacked_Q_values.invalidate()
+        if self.prioritized:
+            # The priorities of every agent are refreshed with a single update of the sum-trees.
+            rows = self.memory.rows(agent_list)
+            self.memory.update_priorities(batch[rows], td_errors[rows], agent_rows=rows)
+        return last_losses
 
     def learn(self, s, a, r, s_next, k, fin, agent):
-        if self.memory_counter < self.batch_size:  # self.memory_size:
-            return None
-        # Select a sub-set of the memory by picking batch_size random indexes between 0 and max_mem
-        max_mem = min(self.memory_counter, self.memory_size)
-        # Turns out we need the batch indexes for proper array slicing...
-        batch = np.random.choice(max_mem, self.batch_size, replace=False)
-        batch_index = np.arange(self.batch_size, dtype=np.int32)
-
-        state_batch = T.tensor(s[agent][batch]).to(self.Q_values[agent].device)
-        next_state_batch = T.tensor(s_next[agent][batch]).to(self.Q_values[agent].device)
-        reward_batch = T.tensor(r[agent][batch]).to(self.Q_values[agent].device)
-        terminal_batch = T.tensor(fin[agent][batch]).to(self.Q_values[agent].device)
-
-        action_batch = a[agent][batch]
-        q_value = self.Q_values[agent].forward(state_batch)[
-            batch_index, action_batch.squeeze()]  # Q value for the action we took
+        """
+        Trains the agent's Q network on one batch of transitions, as sampled from the replay buffer.
+        """
+        return self.__learn_agent(s=s, a=a, r=r, s_next=s_next, fin=fin, agent=agent)[0]
+
+    def __learn_agent(self, s, a, r, s_next, fin, agent, weights=None):
+        """
+        :param weights: importance-sampling weights of the batch, when using prioritized replay.
+        :return: the loss and the absolute TD error of each transition.
+        """
+        batch_index = np.arange(len(a), dtype=np.int32)
+
+        state_batch = T.from_numpy(s).to(self.Q_values[agent].device)
+        next_state_batch = T.from_numpy(s_next).to(self.Q_values[agent].device)
+        reward_batch = T.from_numpy(r).to(self.Q_values[agent].device)
+        terminal_batch = T.from_numpy(fin).to(self.Q_values[agent].device)
+
+        action_batch = a
+        q_value = self.Q_values[agent].forward(state_batch)[batch_index, action_batch]  # Q value for the action we took
 
         q_next_state = self.target_Q_values[agent].forward(next_state_batch)  # This is the Q value for the next state
         q_next_state[terminal_batch] = 0.0  # If we are in a terminal state, the Q value is 0, we only count the rewards
         aux = T.max(q_next_state, dim=1)
         q_value_target = reward_batch + self.gamma * aux[0]
-        loss = self.Q_values[agent].lossFunction(q_value, q_value_target).to(self.Q_values[agent].device)  # Calculate the loss
+        weight_batch = None if weights is None else T.from_numpy(weights).to(self.Q_values[agent].device)
+        loss = self.Q_values[agent].lossFunction(q_value, q_value_target, weight_batch).to(self.Q_values[agent].device)  # Calculate the loss
 
         self.Q_values[agent].optimizer.zero_grad()
         # https://stackoverflow.com/questions/53975717/pytorch-connection-between-loss-backward-and-optimizer-step
@@ -260,7 +442,117 @@ class DDQNAgentMARL(Agent):
         # In-place gradient clipping src:https://pytorch.org/tutorials/intermediate/reinforcement_q_learning.html
         T.nn.utils.clip_grad_value_(self.Q_values[agent].parameters(), 100)
         self.Q_values[agent].optimizer.step()  # Manually confirmed that there is some training going on. The values change at least.
-        return loss.item()
+        return loss.item(), (q_value_target - q_value).detach().abs().cpu().numpy()
+
+    def learn_ensemble(self, s, a, r, s_next, fin, agents, weights=None):
+        """
+        Same update as learn(), but for every agent in agents at once through the DQNEnsemble. The batches have shape
+        (n_agents, batch_size, ...) as returned by the replay buffer, with a row for every agent, the members of the
+        agents that are not in agents are left out of the loss.
+        :param weights: importance-sampling weights of the batches, when using prioritized replay.
+        :return: array with the loss of each agent and array with the absolute TD error of each transition.
+        """
+        device = self.Q_ensemble.device
+        state_batch = T.from_numpy(s).to(device)
+        next_state_batch = T.from_numpy(s_next).to(device)
+        reward_batch = T.from_numpy(r).to(device)
+        terminal_batch = T.from_numpy(fin).to(device)
+        action_batch = T.from_numpy(a).to(device)
+
+        q_value = self.Q_ensemble.forward(state_batch).gather(2, action_batch.unsqueeze(2)).squeeze(2)
+
+        with T.no_grad():
+            q_next_state = self.target_Q_ensemble.mask_invalid(self.target_Q_ensemble.forward(next_state_batch))
+            q_next_state = T.max(q_next_state, dim=2)[0]
+            q_next_state[terminal_batch] = 0.0
+        q_value_target = reward_batch + self.gamma * q_next_state
+        weight_batch = None if weights is None else T.from_numpy(weights).to(device)
+        # Only the agents in agents are trained, the batches of the others would be stale.
+        active = T.zeros(q_value.shape[0], dtype=T.bool, device=device)
+        active[T.from_numpy(self.memory.rows(agents)).to(device)] = True
+        loss, member_losses = self.Q_ensemble.ensemble_loss(q_value, q_value_target, weight_batch, active=active)
+
+        self.Q_ensemble.optimizer.zero_grad()
+        loss.backward()
+        # Decay once per agent, the same schedule as calling learn() for each agent.
+        self.epsilon = max(self.epsilon - self.epsilon_decay * len(agents), self.epsilon_end)
+
+        T.nn.utils.clip_grad_value_(self.Q_ensemble.parameters(), 100)
+        self.Q_ensemble.step(active)
+        return member_losses.detach().cpu().numpy(), (q_value_target - q_value).detach().abs().cpu().numpy()
+
+    def learn_shared(self, s, a, r, s_next, fin, agents, weights=None):
+        """
+        Same update as learn(), for the shared network. The batches of the agents in agents are merged into a single
+        batch, so the shared network gets one update per step with the transitions of all the agents. The target Q
+        values only consider the actions each agent actually has.
+        :return: array with the loss of each agent and array with the absolute TD error of each transition.
+        """
+        shared_Q = self.Q_values[agents[0]]
+        shared_target_Q = self.target_Q_values[agents[0]]
+        device = shared_Q.device
+        rows = T.from_numpy(self.memory.rows(agents)).to(device)
+        n_agents, batch_size = a.shape
+
+        state_batch = T.from_numpy(s).to(device).flatten(0, 1)
+        next_state_batch = T.from_numpy(s_next).to(device).flatten(0, 1)
+        reward_batch = T.from_numpy(r).to(device)
+        terminal_batch = T.from_numpy(fin).to(device)
+        action_batch = T.from_numpy(a).to(device).flatten()
+
+        q_value = shared_Q.forward(state_batch).gather(1, action_batch.unsqueeze(1)).view(n_agents, batch_size)
+
+        with T.no_grad():
+            q_next_state = shared_target_Q.forward(next_state_batch).view(n_agents, batch_size, -1)
+            q_next_state = q_next_state.masked_fill(~self.action_masks.unsqueeze(1), -float('inf'))
+            q_next_state = T.max(q_next_state, dim=2)[0]
+            q_next_state[terminal_batch] = 0.0
+        q_value_target = reward_batch + self.gamma * q_next_state
+
+        # Only the agents in agents are trained, the others keep their rows out of the loss.
+        in_step = T.zeros(n_agents, dtype=T.bool, device=device)
+        in_step[rows] = True
+        weight_batch = in_step.float().unsqueeze(1).expand(n_agents, batch_size)
+        if weights is not None:
+            weight_batch = weight_batch * T.from_numpy(weights).to(device)
+        element_losses = F.smooth_l1_loss(q_value, q_value_target, reduction='none') * weight_batch
+        loss = element_losses.sum() / (len(agents) * batch_size)
+
+        shared_Q.optimizer.zero_grad()
+        loss.backward()
+        self.epsilon = max(self.epsilon - self.epsilon_decay * len(agents), self.epsilon_end)
+
+        T.nn.utils.clip_grad_value_(shared_Q.parameters(), 100)
+        shared_Q.optimizer.step()
+        return element_losses.mean(dim=1).detach().cpu().numpy(), \
+            (q_value_target - q_value).detach().abs().cpu().numpy()
+
+    def update_target_networks(self, agents):
+        if self.ensemble:
+            self.target_Q_ensemble.load_state_dict(self.Q_ensemble.state_dict())
+            return
+        for agent in agents[:1] if self.shared else agents:
+            self.target_Q_values[agent].load_state_dict(self.Q_values[agent].state_dict())
+
+    def save_networks(self, prefix, agents, epoch=0):
+        if self.ensemble:
+            self.Q_ensemble.save_checkpoint(filename=f"{prefix}_ensemble.pth.tar", epoch=epoch)
+            return
+        # In shared mode all the agents have the same network, only one checkpoint is kept (named after the first agent).
+        for agent in agents[:1] if self.shared else agents:
+            self.Q_values[agent].save_checkpoint(filename=f"{prefix}_{agent}.pth.tar", epoch=epoch)
+
+    def load_networks(self, prefix, agents):
+        if self.ensemble:
+            self.Q_ensemble.load_checkpoint(prefix + "_ensemble.pth.tar")
+            self.target_Q_ensemble.load_checkpoint(prefix + "_ensemble.pth.tar")
+            return
+        for agent in agents[:1] if self.shared else agents:
+            agent_w = prefix + f"_{agent}.pth.tar"
+            self.Q_values[agent].load_checkpoint(agent_w)
+            self.target_Q_values[agent].load_checkpoint(agent_w)
+        if not self.shared:
+            self.stacked_Q_values.invalidate()
 
     def get_stats(self, last_loss, last_reward, avg_reward, cumulative_reward, total_steps, step, episode_number, env):
         index = total_steps % self.amount_of_metrics
@@ -281,31 +573,33 @@ class DDQNAgentMARL(Agent):
     def warm_up(self, dataset_file, agents):
         """
         This function is used to warm up the agent. This is done by loading a dataset and running the agent on it.
-        :param dataset_file: The file containing the dataset.
+        :param dataset_file: The dataset directory, or a CSV dataset (converted once to a dataset, see
+        SarsaDataCollector.load_dataset).
         :return:
         """
-        data = self.dg.load_from_csv_to_arrays(dataset_file)
-        states, actions, rewards, next_states, dones = data
-        no_batches = len(states) // self.batch_size
+        dataset = self.dg.load_dataset(dataset_file)
+        no_batches = len(dataset) // self.batch_size
         for i in range(no_batches):  # len(states)):
             loss = [0 for agent in agents]
             print("Beginning warm up batch {}".format(i))
-            first_idx = min(i * self.batch_size, len(states) - self.batch_size)
+            first_idx = min(i * self.batch_size, len(dataset) - self.batch_size)
             print(" Covering from: {}".format(first_idx) + "  to {}".format(first_idx + self.batch_size))
+            # Sliced from the memory-mapped shards, no parsing.
+            batch = dataset.batch(first_idx, first_idx + self.batch_size)
             for j in range(self.batch_size):
-                self.__store_transition(states[first_idx + j], actions[first_idx + j], rewards[first_idx + j],
-                                        next_states[first_idx + j], dones[first_idx + j])
-                idx = 0
-                for agent in agents:
-                    l = self.learn(s=self.state_memory, a=self.action_memory, r=self.reward_memory,
-                               s_next=self.new_state_memory, k=i, fin=self.terminal_memory, agent=agent)
-                    loss[idx] += l if not l is None else 0  # for the first time steps where no training is done
-                    idx += 1
-            print(f"Loss Total: {loss}  Loss Avg: {loss / self.batch_size}  ")  # (This is kinda irrelevant btw)
-            for agent in agents:
-                self.target_Q_values[agent].load_state_dict(self.Q_values[agent].state_dict())
-        for agent in agents:
-            self.Q_values[agent].save_checkpoint(filename="warm_up_Q_value.pth.tar", epoch=-1)
+                # The dataset transition is given to every agent.
+                n_agents = len(agents)
+                self.memory.store_transitions(states=np.repeat(batch['state'][j:j + 1], n_agents, axis=0),
+                                              actions=np.repeat(batch['action'][j, :1], n_agents),
+                                              rewards=np.repeat(batch['reward'][j:j + 1], n_agents),
+                                              next_states=np.repeat(batch['next_state'][j:j + 1], n_agents, axis=0),
+                                              dones=np.repeat(batch['done'][j], n_agents),
+                                              agent_list=agents)
+                step_losses = self.learn_all(agents, k=i)
+                loss = [l + step_losses[agent] for l, agent in zip(loss, agents)]
+            print(f"Loss Total: {loss}  Loss Avg: {np.array(loss) / self.batch_size}  ")  # (This is kinda irrelevant btw)
+            self.update_target_networks(agents)
+        self.save_networks("warm_up_Q_value", agents, epoch=-1)
         print("Warm up complete")
 
     def tally_actions(self, actions):
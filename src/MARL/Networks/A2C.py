@@ -5,6 +5,9 @@ import torch.nn.functional as F
 from torch.distributions import Categorical
 import os
 
+from src.Utils.ReturnHelper import discounted_returns
+from src.Utils.RolloutBuffer import as_tensor
+
 
 class ActorCritic(nn.Module):
     """
@@ -135,29 +138,27 @@ class ActorCritic(nn.Module):
         :param done:
         :return: n-step bootstrapped returns
         """
-        # Calculate the returns of the episode
-        states = T.tensor(np.array(self.states[0]), dtype=T.float).to(self.device)  # We must convert the state vector to a tensor
-        next_states = T.tensor(np.array(self.next_states[0]), dtype=T.float).to(self.device)
-        _, v_t = self.forward(states)
-        _, v_t_1 = self.forward(next_states)
-        done_t = T.tensor(done, dtype=T.float).to(self.device)
-
-        returns = T.zeros_like(v_t).to(self.device)
-
-        # This computes the reward/return for each time-step in the episode. This must be done from the end to the start
-        # of the episode, because the return at time-step t depends on the return at time-step t+1. We then reverse the
-        # list so that the first element is the return at time-step 0.
-        next_return = v_t_1[-1][0]
-        for t in reversed(range(len(self.rewards[0]))): # Iterate over reversed memory
-            # reward + \gamma * R_{t+1}
-            next_return = self.rewards[0][t] + self.gamma * next_return * (1 - done_t[t])
-            returns[t][0] = next_return
+        # Only the value of the state after the last step is needed, to bootstrap the returns.
+        with T.no_grad():
+            last_state = as_tensor(self.next_states[0][-1], dtype=T.float, device=self.device)
+            _, v_last = self.forward(last_state)
+        rewards = as_tensor(self.rewards[0], dtype=T.float, device=self.device)
+        done_t = as_tensor(done, dtype=T.float, device=self.device)
+
+        # R_t = r_t + gamma * R_{t+1}, computed for the whole rollout at once. See Utils/ReturnHelper.py
+        returns = discounted_returns(rewards, done_t, v_last[0], self.gamma).unsqueeze(1)
         return returns
 
-    def calculate_loss(self, done):
+    def calculate_loss(self, done, action_mask=None):
+        """
+        :param done:
+        :param action_mask: bool tensor with shape (n_actions,), the actions that exist for the agent. Used when
+        agents with different neighbourhood sizes share the network.
+        :return: the actor-critic loss of the stored rollout.
+        """
 
-        states = T.tensor(np.array(self.states[0]), dtype=T.float).to(self.device)
-        actions = T.tensor(self.actions, dtype=T.long).to(self.device)
+        states = as_tensor(self.states[0], dtype=T.float, device=self.device)
+        actions = as_tensor(self.actions[0], dtype=T.long, device=self.device).reshape(-1, 1)  # One action per step
         # rewards = T.tensor(self.rewards, dtype=T.float).to(self.device)
         # next_states = T.tensor(self.next_states, dtype=T.float).to(self.device)
         # dones = T.tensor(done, dtype=T.float).to(self.device)
@@ -165,16 +166,21 @@ class ActorCritic(nn.Module):
         # Forward pass to get actor logits and critic values
         actor_logits, critic_values = self.forward(states)
 
-        # Compute advantages
-        returns = self.calculate_returns(done).squeeze()
-        advantages = returns - critic_values.squeeze()
+        # Compute advantages, everything is (T,) from here. squeeze(1) and not squeeze(), so a rollout of one step
+        # keeps its dimension, and the log probs below are not broadcast against the advantages into a (T, T) matrix.
+        critic_values = critic_values.squeeze(1)
+        returns = self.calculate_returns(done).squeeze(1)
+        advantages = returns - critic_values
 
         # Actor loss
+        if action_mask is not None:
+            actor_logits = actor_logits.masked_fill(~action_mask, -float('inf'))
         actor_probs = F.softmax(actor_logits, dim=1)
-        actor_loss = -T.mean(T.log(actor_probs.gather(1, actions)) * advantages.detach())
+        log_prob = T.log(actor_probs.gather(1, actions)).squeeze(1)
+        actor_loss = -T.mean(log_prob * advantages.detach())
 
         # Critic loss
-        critic_loss = F.smooth_l1_loss(critic_values.squeeze(), returns.detach())  # Equivalent to Huber loss delta=1
+        critic_loss = F.smooth_l1_loss(critic_values, returns.detach())  # Equivalent to Huber loss delta=1
 
         # Total loss
         total_loss = actor_loss + critic_loss
@@ -4,11 +4,25 @@ import torch.nn.functional as F
 import torch.nn.init
 from torch import optim
 from torch.distributions import Categorical
+import math
 import os
 
 
 # src: https://www.youtube.com/watch?v=wc-FxNENg9U
 
+class WeightedSmoothL1Loss(nn.Module):
+    """
+    nn.SmoothL1Loss that can scale each element by a weight before averaging, used to apply the importance-sampling
+    weights of prioritized replay. Without weights it is the same as nn.SmoothL1Loss().
+    """
+
+    def forward(self, input, target, weights=None):
+        loss = F.smooth_l1_loss(input, target, reduction='none')
+        if weights is not None:
+            loss = loss * weights
+        return loss.mean()
+
+
 # Every Class that extends functionality of base NN layers derives from nn.Module, this gives access to parameters
 # for optimization and does backpropagation for us
 class DQN(nn.Module):
@@ -69,7 +83,7 @@ class DQN(nn.Module):
 
         self.optimizer = optim.AdamW(self.parameters(), lr=lr, amsgrad=True)  # https://stackoverflow.com/questions/64621585/adamw-and-adam-with-weight-decay
         # MSE is the loss function
-        self.lossFunction = nn.SmoothL1Loss()  # nn.MSELoss()  #  nn.HuberLoss()
+        self.lossFunction = WeightedSmoothL1Loss()  # nn.SmoothL1Loss()  # nn.MSELoss()  #  nn.HuberLoss()
         # GPU support, in torch we need to specify where we are sending the Network.
         self.device = T.device('cuda:0' if T.cuda.is_available() else 'cpu')
         # self.device = "cpu"  # Debugging purposes
@@ -107,4 +121,154 @@ class DQN(nn.Module):
         self.load_state_dict(checkpoint['model_state_dict'])
         self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         epoch = checkpoint['epoch']
-        self.lossFunction = checkpoint['loss']
\ No newline at end of file
+        # Older checkpoints store a plain nn.SmoothL1Loss, which can not take importance-sampling weights.
+        if isinstance(checkpoint['loss'], WeightedSmoothL1Loss):
+            self.lossFunction = checkpoint['loss']
+
+
+class EnsembleLinear(nn.Module):
+    """
+    A stack of independent linear layers, one per ensemble member. The weights are kept as one batched tensor with
+    shape (n_members, out_features, in_features), mirroring nn.Linear, and the layer runs as one batched matmul.
+    """
+
+    def __init__(self, n_members, in_features, out_features):
+        super(EnsembleLinear, self).__init__()
+        self.n_members = n_members
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(T.empty(n_members, out_features, in_features))
+        self.bias = nn.Parameter(T.empty(n_members, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self, nonlinearity='leaky_relu'):
+        # Each member is initialized like an individual nn.Linear would be.
+        bound = 1 / math.sqrt(self.in_features)
+        with T.no_grad():
+            for member in range(self.n_members):
+                torch.nn.init.kaiming_normal_(self.weight[member], nonlinearity=nonlinearity)
+            torch.nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        # x: (n_members, batch, in_features) -> (n_members, batch, out_features)
+        return T.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+
+    def forward_member(self, x, member):
+        return F.linear(x, self.weight[member], self.bias[member])
+
+
+class DQNEnsemble(nn.Module):
+    """
+    The same network as DQN but holding the weights of several agents as batched tensors, so all the agents can be
+    trained with a single forward/backward pass and a single optimizer step.
+
+    Agents may have a different number of actions, the output layer is sized for the largest one and the extra actions
+    are masked out with mask_invalid(). Because the members share no parameters, and both AdamW and value clipping are
+    element-wise, summing the per-agent losses gives each member exactly the update it would get on its own.
+    """
+
+    def __init__(self, lr, input_dims, fc1_dims, fc2_dims, fc3_dims, n_actions, gamma=0.99):
+        super(DQNEnsemble, self).__init__()
+
+        self.input_dims = input_dims
+        self.fc1_dims = fc1_dims
+        self.fc2_dims = fc2_dims
+        self.fc3_dims = fc3_dims
+        self.n_actions = list(n_actions)  # One entry per member.
+        self.n_members = len(self.n_actions)
+        self.max_actions = max(self.n_actions)
+
+        # Network
+        self.fc11 = EnsembleLinear(self.n_members, *self.input_dims, self.fc1_dims)
+        self.fc21 = EnsembleLinear(self.n_members, self.fc1_dims, self.fc2_dims)
+        self.fc31 = EnsembleLinear(self.n_members, self.fc2_dims, self.fc3_dims)
+        # Output
+        self.out = EnsembleLinear(self.n_members, self.fc3_dims, self.max_actions)
+
+        # True where the action exists for the member.
+        self.register_buffer('action_mask', T.arange(self.max_actions).unsqueeze(0) < T.tensor(self.n_actions).unsqueeze(1))
+
+        self.optimizer = optim.AdamW(self.parameters(), lr=lr, amsgrad=True)
+        # Per-element loss, reduced per member in ensemble_loss.
+        self.lossFunction = nn.SmoothL1Loss(reduction='none')
+        self.device = T.device('cuda:0' if T.cuda.is_available() else 'cpu')
+        self.to(self.device)
+
+    def forward(self, state):
+        # state: (n_members, batch, *input_dims)
+        layer11 = F.leaky_relu(self.fc11(state))
+        layer21 = F.leaky_relu(self.fc21(layer11))
+        last = F.leaky_relu(self.fc31(layer21))
+        q_values = self.out(last)
+        return q_values
+
+    def forward_member(self, state, member):
+        layer11 = F.leaky_relu(self.fc11.forward_member(state, member))
+        layer21 = F.leaky_relu(self.fc21.forward_member(layer11, member))
+        last = F.leaky_relu(self.fc31.forward_member(layer21, member))
+        q_values = self.out.forward_member(last, member)
+        return q_values[..., :self.n_actions[member]]
+
+    def mask_invalid(self, q_values, fill=-float('inf')):
+        """
+        Sets the Q values of the actions a member does not have to fill, so they are never picked by max/argmax.
+        :param q_values: (n_members, batch, max_actions)
+        :return:
+        """
+        return q_values.masked_fill(~self.action_mask.unsqueeze(1), fill)
+
+    def ensemble_loss(self, q_value, q_value_target, weights=None, active=None):
+        """
+        :param q_value: (n_members, batch)
+        :param q_value_target: (n_members, batch)
+        :param weights: optional importance-sampling weights, (n_members, batch)
+        :param active: optional bool mask (n_members,) of the members trained, the others are left out of the total.
+        :return: the total loss to back-propagate and the loss of each member.
+        """
+        loss = self.lossFunction(q_value, q_value_target)
+        if weights is not None:
+            loss = loss * weights
+        member_losses = loss.mean(dim=1)
+        if active is not None:
+            return member_losses[active].sum(), member_losses
+        return member_losses.sum(), member_losses
+
+    def step(self, active=None):
+        """
+        Optimizer step that leaves the members not in active as they were. Leaving them out of the loss only zeroes
+        their gradients, AdamW would still move them with its weight decay and momentum, so their slices of the
+        parameters and of the optimizer state are put back after the step. The step count of AdamW is per tensor, so
+        it still advances for them, which only changes the bias correction of the first steps.
+        :param active: optional bool mask (n_members,) of the members trained, None steps all of them.
+        """
+        if active is None or bool(active.all()):
+            self.optimizer.step()
+            return
+        inactive = ~active
+        saved = []
+        for param in self.parameters():
+            state = {name: value[inactive].clone() for name, value in self.optimizer.state[param].items()
+                     if T.is_tensor(value) and value.dim() > 0 and value.shape[0] == self.n_members}
+            saved.append((param, param.data[inactive].clone(), state))
+        self.optimizer.step()
+        for param, data, state in saved:
+            param.data[inactive] = data
+            for name, value in state.items():
+                self.optimizer.state[param][name][inactive] = value
+
+    def save_checkpoint(self, filename='dqn_ensemble.pth.tar', path='./models', epoch=0):
+        print('... saving checkpoint ...')
+        T.save({
+            'epoch': epoch,
+            'model_state_dict': self.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'loss': self.lossFunction
+        }, os.path.join(path, filename))
+
+    def load_checkpoint(self, filename='./models/dqn_ensemble.pth.tar'):
+        print('... loading checkpoint ...')
+        checkpoint = T.load(filename)
+        self.load_state_dict(checkpoint['model_state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        epoch = checkpoint['epoch']
+        self.lossFunction = checkpoint['loss']
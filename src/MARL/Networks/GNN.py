@@ -0,0 +1,231 @@
+import numpy as np
+import torch as T
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.distributions import Categorical
+import os
+
+from src.Utils.ReturnHelper import discounted_returns
+from src.Utils.RolloutBuffer import as_tensor
+
+
+def build_adjacency(neighbour_matrix, device):
+    """
+    Builds the row-normalized adjacency of the topology, with self loops, as a sparse tensor. Row i averages node i and
+    the nodes in neighbour_matrix[i].
+    :param neighbour_matrix: list with the neighbours of each node, as in env.neighbourMatrix.
+    :param device:
+    :return: sparse tensor with shape (n_nodes, n_nodes)
+    """
+    n_nodes = len(neighbour_matrix)
+    edges = {(i, i) for i in range(n_nodes)}
+    edges.update((i, int(j)) for i, neighbours in enumerate(neighbour_matrix) for j in neighbours)
+    src, dst = np.array(sorted(edges)).T
+    degree = np.bincount(src, minlength=n_nodes)
+    values = 1.0 / degree[src]
+    return T.sparse_coo_tensor(T.from_numpy(np.stack((src, dst))), T.from_numpy(values), (n_nodes, n_nodes),
+                               dtype=T.float, device=device).coalesce()
+
+
+class GraphActorCritic(nn.Module):
+    """
+    Message-passing Actor Critic Network. Instead of reading the flattened observation as a single vector, each
+    neighbour slot of the observation (Q, free spaces and processing power of the neighbour) is encoded by the same
+    small network, and the decision is a score per slot. The number of parameters depends on neither the number of
+    nodes nor the neighbourhood sizes, so the same weights work for any topology.
+
+    Two modes:
+    - With neighbour_matrix (and agent_nodes), the embeddings of the controllers are propagated over the topology with
+     n_layers rounds of message passing, one sparse matmul each. The input then has the observations of every agent in
+     the second to last dimension, (..., n_agents, obs), and all the decisions are made in one forward pass.
+    - Without it, each observation is handled on its own, with the same interface as ActorCritic. This is what the FL
+     trainers use, as each model only sees its own observation.
+
+    The flattened observation layout is Q[m], free[m], nodeId, w[m], see utils.flatten_observation.
+
+    Based on:
+    - https://arxiv.org/abs/1609.02907 | Semi-Supervised Classification with Graph Convolutional Networks
+    - https://arxiv.org/abs/1810.09202 | Graph Convolutional Reinforcement Learning
+    """
+
+    def __init__(self, lr, input_dims, fc1_dims=64, fc2_dims=64, fc3_dims=64, n_actions=None, gamma=0.99,
+                 neighbour_matrix=None, agent_nodes=None, n_layers=2):
+        """
+        :param lr:
+        :param input_dims: shape of the flattened observation.
+        :param fc1_dims: not used, kept so the network can be built like ActorCritic.
+        :param fc2_dims: hidden size of the slot encoder.
+        :param fc3_dims: size of the embeddings.
+        :param n_actions: in the local mode, the number of valid slots. Defaults to all the slots.
+        :param gamma:
+        :param neighbour_matrix: env.neighbourMatrix, enables message passing over the topology.
+        :param agent_nodes: the node of each agent, in the order the observations are given.
+        :param n_layers: rounds of message passing.
+        """
+        super(GraphActorCritic, self).__init__()
+
+        self.gamma = gamma
+        self.lr = lr  # The FL trainers rebuild the optimizer with it when a model is received.
+        self.input_dims = input_dims
+        self.n_slots = (input_dims[0] - 1) // 3
+        self.n_actions = n_actions if n_actions is not None else self.n_slots
+        self.embedding_dims = fc3_dims
+        self.n_layers = n_layers
+
+        self.states = []
+        self.actions = []
+        self.rewards = []
+        self.next_states = []
+        self.dones = []
+
+        # Slot encoder, shared by all the neighbours of all the agents.
+        self.slot1 = nn.Linear(3, fc2_dims)
+        T.nn.init.kaiming_normal_(self.slot1.weight, nonlinearity='leaky_relu')
+        self.slot2 = nn.Linear(fc2_dims, fc3_dims)
+        T.nn.init.kaiming_normal_(self.slot2.weight, nonlinearity='leaky_relu')
+
+        # Message passing layers.
+        self.self_layers = nn.ModuleList([nn.Linear(fc3_dims, fc3_dims) for _ in range(n_layers)])
+        self.neighbour_layers = nn.ModuleList([nn.Linear(fc3_dims, fc3_dims, bias=False) for _ in range(n_layers)])
+
+        # Actor Head: scores each slot from its encoding, the agent's embedding and the neighbour's embedding.
+        self.score1 = nn.Linear(3 * fc3_dims, fc3_dims)
+        T.nn.init.kaiming_normal_(self.score1.weight, nonlinearity='leaky_relu')
+        self.score2 = nn.Linear(fc3_dims, 1)
+        # Critic Head:
+        self.critic = nn.Linear(fc3_dims, 1)
+
+        self.optimizer = T.optim.AdamW(self.parameters(), lr=lr)
+
+        # GPU support, in torch we need to specify where we are sending the Network.
+        self.device = T.device('cuda:0' if T.cuda.is_available() else 'cpu')
+
+        self.graph = neighbour_matrix is not None
+        if self.graph:
+            agent_nodes = list(range(len(neighbour_matrix))) if agent_nodes is None else list(agent_nodes)
+            self.n_nodes = len(neighbour_matrix)
+            self.adjacency = build_adjacency(neighbour_matrix, self.device)
+            self.register_buffer('agent_nodes', T.tensor(agent_nodes, dtype=T.long), persistent=False)
+            # The node behind each slot of each agent, padded slots point at the agent itself and are masked.
+            slot_nodes = np.array([[neighbour_matrix[node][k] if k < len(neighbour_matrix[node]) else node
+                                    for k in range(self.n_slots)] for node in agent_nodes])
+            self.register_buffer('slot_nodes', T.tensor(slot_nodes, dtype=T.long), persistent=False)
+            n_neighbours = T.tensor([len(neighbour_matrix[node]) for node in agent_nodes]).unsqueeze(1)
+        else:
+            n_neighbours = T.tensor(self.n_actions)
+        # (n_agents, n_slots) with message passing, (n_slots,) in the local mode. The topology is not part of the state
+        # dict, so the weights can be loaded (or averaged) across topologies.
+        self.register_buffer('slot_mask', T.arange(self.n_slots) < n_neighbours, persistent=False)
+
+        self.to(self.device)
+
+    def remember_batch(self, states, actions, rewards, next_states, dones):
+        self.states.append(states)
+        self.actions.append(actions)
+        self.rewards.append(rewards)
+        self.next_states.append(next_states)
+        self.dones.append(dones)
+
+    def clear_memory(self):
+        self.states = []
+        self.actions = []
+        self.rewards = []
+        self.next_states = []
+        self.dones = []
+
+    def __slots(self, state):
+        m = self.n_slots
+        # (..., m, 3) with the Q, free spaces and processing power of each neighbour.
+        return T.stack((state[..., :m], state[..., m:2 * m], state[..., 2 * m + 1:3 * m + 1]), dim=-1)
+
+    def forward(self, state):
+        """
+        :param state: (..., obs) in the local mode, (..., n_agents, obs) with message passing.
+        :return: logits with shape (..., n_slots), padded slots are -inf, and values with shape (..., 1).
+        """
+        slots = F.leaky_relu(self.slot2(F.leaky_relu(self.slot1(self.__slots(state)))))
+        mask = self.slot_mask
+        # Permutation invariant summary of the neighbourhood.
+        agent_embedding = (slots * mask.unsqueeze(-1)).sum(-2) / mask.sum(-1, keepdim=True)
+
+        if self.graph:
+            batch_shape = agent_embedding.shape[:-2]
+            embedding = agent_embedding.reshape(-1, agent_embedding.shape[-2], self.embedding_dims)
+            batch = embedding.shape[0]
+            # Nodes that are not controlled by an agent start empty and only carry messages.
+            nodes = embedding.new_zeros(batch, self.n_nodes, self.embedding_dims)
+            nodes[:, self.agent_nodes] = embedding
+            for self_layer, neighbour_layer in zip(self.self_layers, self.neighbour_layers):
+                # The batch is moved to the columns, so every round is one sparse matmul for the whole batch.
+                flat = nodes.transpose(0, 1).reshape(self.n_nodes, -1)
+                aggregated = T.sparse.mm(self.adjacency, flat).reshape(self.n_nodes, batch, -1).transpose(0, 1)
+                nodes = F.leaky_relu(self_layer(nodes) + neighbour_layer(aggregated))
+            nodes = nodes.reshape(*batch_shape, self.n_nodes, self.embedding_dims)
+            agent_embedding = nodes[..., self.agent_nodes, :]
+            neighbour_embedding = nodes[..., self.slot_nodes, :]
+        else:
+            # The only neighbours are the slots, and their message is the summary computed above.
+            message = agent_embedding
+            for self_layer, neighbour_layer in zip(self.self_layers, self.neighbour_layers):
+                agent_embedding = F.leaky_relu(self_layer(agent_embedding) + neighbour_layer(message))
+            neighbour_embedding = slots
+
+        scores_in = T.cat((slots, agent_embedding.unsqueeze(-2).expand_as(slots), neighbour_embedding), dim=-1)
+        logits = self.score2(F.leaky_relu(self.score1(scores_in))).squeeze(-1)
+        logits = logits.masked_fill(~mask, -float('inf'))
+        return logits, self.critic(agent_embedding)  # Logits, Value
+
+    def calculate_loss(self, done, action_mask=None):
+        """
+        Same loss as ActorCritic, over the stored rollout. In the message passing mode the rollout has the steps of
+        all the agents, (T, n_agents, ...), and the returns of every agent are computed at once.
+        :param done:
+        :param action_mask: extra mask over the slots, see ActorCritic.calculate_loss.
+        :return:
+        """
+        states = as_tensor(self.states[0], dtype=T.float, device=self.device)
+        actions = as_tensor(self.actions[0], dtype=T.long, device=self.device)
+        rewards = as_tensor(self.rewards[0], dtype=T.float, device=self.device)
+        done_t = as_tensor(done, dtype=T.float, device=self.device)
+
+        logits, values = self.forward(states)
+        if action_mask is not None:
+            logits = logits.masked_fill(~action_mask, -float('inf'))
+        values = values.squeeze(-1)
+        with T.no_grad():
+            _, v_last = self.forward(as_tensor(self.next_states[0][-1], dtype=T.float, device=self.device))
+        returns = discounted_returns(rewards, done_t, v_last.squeeze(-1), self.gamma)
+        advantages = returns - values
+
+        log_prob = F.log_softmax(logits, dim=-1).gather(-1, actions.reshape(*logits.shape[:-1], 1)).squeeze(-1)
+        actor_loss = -T.mean(log_prob * advantages.detach())
+        critic_loss = F.smooth_l1_loss(values, returns.detach())  # Equivalent to Huber loss delta=1
+        return actor_loss + critic_loss
+
+    def choose_action(self, observation):
+        state = T.tensor(np.array(observation), dtype=T.float).to(self.device)
+        logits, _ = self.forward(state)
+        action = Categorical(logits=logits).sample()
+        return action.detach().cpu().numpy()
+
+    def save_checkpoint(self, filename='gnn.pth.tar', path='./models', epoch=0):
+        # This saves the network parameters
+        print('... saving checkpoint ...')
+        T.save({
+            'epoch': epoch,
+            'model_state_dict': self.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+        }, os.path.join(path, filename))
+
+    def load_checkpoint(self, filename='./models/gnn.pth.tar'):
+        # This loads the network parameters
+        print('... loading checkpoint ...')
+        checkpoint = T.load(filename)
+        self.load_state_dict(checkpoint['model_state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+
+    def debug_any_none(self):
+        for w in self.parameters():
+            if T.isnan(w).any() or T.isinf(w).any():
+                return True
+        return False
@@ -10,68 +10,45 @@ import peersim_gym.envs.PeersimEnv as pe
 
 import os
 
+from src.Utils.ReturnHelper import discounted_returns, gae_advantages
+from src.Utils.RolloutBuffer import RolloutBuffer, as_tensor
+
 
 
 class PPOMemory:
-    def __init__(self, agents, batch_size=32):
-        self.agent_states = {
-
-                'state': [],
-                'prob': [],
-                'val': [],
-                'action': [],
-                'reward': [],
-                'next_state': [],
-                'done': []
-        }
+    """
+    Rollouts of the agents using one PPO, kept in a preallocated RolloutBuffer sized to the number of steps between
+    updates. Usually a single agent, several when the PPO is shared.
+    """
+    def __init__(self, agents, batch_size=32, capacity=2048):
+        self.agent_states = RolloutBuffer(agents=agents, capacity=capacity,
+                                          extra_fields={'prob': T.float, 'val': T.float})
         self.batch_size = batch_size
 
     def store_agent_step_data(self, states, actions, prob, val, rewards, next_states, dones, agent_list):
-        total_rwrd = 0
-            # Update history
-        agent_data = self.agent_states
-        agent_data['state'].append(states)
-        agent_data['action'].append(actions)
-        agent_data['prob'].append(prob)
-        agent_data['val'].append(val)
-        agent_data['reward'].append(rewards)
-        agent_data['next_state'].append(next_states)
-        agent_data['done'].append(dones)
-        total_rwrd += rewards
-        return total_rwrd
-
-    def get_agent_step_data(self,):
+        """
+        :param agent_list: the agent the step belongs to.
+        """
+        self.agent_states.store([agent_list], states=[states], actions=[actions], rewards=[rewards],
+                                next_states=[next_states], dones=[dones], prob=[prob], val=[val])
+        return rewards
+
+    def get_agent_step_data(self, agent):
+        """
+        :return: dict with views over the stored rollout, the steps are in the first dimension.
+        """
+        return self.agent_states.get(agent)
+
+    def get_minibatches(self, agent, fields):
         """
         Samples a set of tragetories from the data
-        :param agent:
-        :return:
+        :param fields: the fields to include in each minibatch.
+        :return: the minibatches and the permutation that was used to shuffle the steps.
         """
-        agent_data = self.agent_states
-        states = agent_data['state']
-        n_states = len(states)
-        batch_start = np.arange(0, n_states, self.batch_size)
-        indices = np.arange(n_states, dtype=np.int64)
-        np.random.shuffle(indices)
-        batches = [indices[i:i + self.batch_size] for i in batch_start]
-        return (np.array(agent_data['state']),
-                np.array(agent_data['action']),
-                np.array(agent_data['prob']),
-                np.array(agent_data['val']),
-                np.array(agent_data['reward']),
-                np.array(agent_data['next_state']),
-                np.array(agent_data['done']),
-                batches)
-
-    def clean_agent_step_data(self,):
-            self.agent_states = {
-                'state': [],
-                'action': [],
-                'prob': [],
-                'val': [],
-                'reward': [],
-                'next_state': [],
-                'done': []
-            }
+        return self.agent_states.minibatches(agent, self.batch_size, fields)
+
+    def clean_agent_step_data(self, agents=None):
+        self.agent_states.reset(agents)
 
 class Actor(nn.Module):
     def __init__(self, input_dims, n_actions, fc1_dims, fc2_dims, alpha, fc3_dims=64):
@@ -96,11 +73,19 @@ class Actor(nn.Module):
         self.to(self.device)
 
 
-    def forward(self, state):
+    def forward(self, state, action_mask=None):
+        """
+        :param state:
+        :param action_mask: bool tensor broadcastable to the logits, the actions that exist for the agent. Used when
+        agents with different neighbourhood sizes share the actor.
+        :return: the distribution over the actions.
+        """
         prob = F.leaky_relu(self.fc1(state))
         prob = F.leaky_relu(self.fc2(prob))
         prob = F.leaky_relu(self.fc3(prob))
         logits = self.logits(prob)
+        if action_mask is not None:
+            logits = logits.masked_fill(~action_mask, -float('inf'))
         action_probs = F.softmax(logits, dim=-1)
         dist = Categorical(action_probs)
         return dist
@@ -187,7 +172,7 @@ class PPO:
 
         self.critic = Critic(input_dims, fc1_dims, fc2_dims, lr, fc3_dims)
 
-        self.memory = PPOMemory(agents, batch_size=batch_size)
+        self.memory = PPOMemory(agents, batch_size=batch_size, capacity=N)
 
     def calculate_returns(self, dones, states, next_states, rewards):
         """
@@ -200,24 +185,28 @@ class PPO:
         :param done:
         :return: n-step bootstrapped returns
         """
-        # Calculate the returns of the episode
-        states = T.tensor(np.array(states), dtype=T.float).to(self.device)  # We must convert the state vector to a tensor
-        next_states = T.tensor(np.array(next_states), dtype=T.float).to(self.device)
-        v_t = self.critic.forward(states)
-        v_t_1 = self.critic.forward(next_states)
-        done_t = T.tensor(dones, dtype=T.float).to(self.device)
-
-        returns = T.zeros_like(v_t).to(self.device)
-
-        # This computes the reward/return for each time-step in the episode. This must be done from the end to the start
-        # of the episode, because the return at time-step t depends on the return at time-step t+1. We then reverse the
-        # list so that the first element is the return at time-step 0.
-        next_return = v_t_1[-1][0]
-        for t in reversed(range(len(rewards))): # Iterate over reversed memory
-            # reward + \gamma * R_{t+1}
-            next_return = rewards[t] + self.gamma * next_return * (1 - done_t[t])
-            returns[t] = next_return
-        return returns
+        with T.no_grad():
+            last_state = as_tensor(next_states[-1], dtype=T.float, device=self.device)
+            v_last = self.critic.forward(last_state)
+        rewards = as_tensor(rewards, dtype=T.float, device=self.device)
+        done_t = as_tensor(dones, dtype=T.float, device=self.device)
+        return discounted_returns(rewards, done_t, v_last[0], self.gamma).unsqueeze(1)
+
+    def calculate_advantages(self, dones, values, next_states, rewards):
+        """
+        Computes the GAE(lambda) advantages of the rollout, see Utils/ReturnHelper.py.
+        :param dones:
+        :param values: the values the critic gave to the states when the actions were chosen.
+        :param next_states:
+        :param rewards:
+        :return: advantages, with shape (T,)
+        """
+        with T.no_grad():
+            next_states = as_tensor(next_states, dtype=T.float, device=self.device)
+            next_values = self.critic.forward(next_states).squeeze(-1)
+        rewards = as_tensor(rewards, dtype=T.float, device=self.device)
+        done_t = as_tensor(dones, dtype=T.float, device=self.device)
+        return gae_advantages(rewards, values, next_values, done_t, self.gamma, self.gae_lambda)
 
     def choose_action(self, state):
         state = T.tensor(np.array(state), dtype=T.float).to(self.device)
@@ -230,23 +219,32 @@ class PPO:
 
         return action, log_prob, value
 
-    def learn(self):
-        state_arr, action_arr, old_prob_arr, vals_arr, reward_arr, next_state_arr, dones_arr, batches = self.memory.get_agent_step_data()
+    def learn(self, agent=None, action_mask=None):
+        """
+        Runs the PPO update on the rollout of one agent.
+        :param agent: the agent to train on, defaults to the first (only) agent of the PPO.
+        :param action_mask: the actions that exist for the agent, see Actor.forward.
+        :return: the average loss over the minibatches.
+        """
+        agent = self.agents[0] if agent is None else agent
+        rollout = self.memory.get_agent_step_data(agent)
 
-        values = vals_arr
+        values = rollout['val']
+        advantages = self.calculate_advantages(dones=rollout['done'], values=values, next_states=rollout['next_state'], rewards=rollout['reward']) # Note, only the very last state is done=true
 
-        values = T.tensor(values, dtype=T.float).to(self.actor.device)
-        returns = self.calculate_returns(dones=dones_arr, states=state_arr, next_states=next_state_arr, rewards=reward_arr).squeeze() # Note, only the very last state is done=true
-        advantages = returns - values.squeeze()
-        advantages = T.tensor(advantages, dtype=T.float).to(self.actor.device)
+        # The rollout is shuffled once, each minibatch is then a contiguous slice.
+        batches, permutation = self.memory.get_minibatches(agent, ['state', 'prob', 'action'])
+        advantages = advantages[permutation]
+        values = values[permutation]
 
         total_loss_cum = 0
-        for batch in batches:
-            states = T.tensor(state_arr[batch], dtype=T.float).to(self.actor.device)
-            old_log_probs = T.tensor(old_prob_arr[batch], dtype=T.float).to(self.actor.device)
-            actions = T.tensor(action_arr[batch], dtype=T.float).to(self.actor.device)
+        for start, minibatch in zip(range(0, len(permutation), self.batch_size), batches):
+            batch = slice(start, start + self.batch_size)
+            states = minibatch['state']
+            old_log_probs = minibatch['prob']
+            actions = minibatch['action']
 
-            dist = self.actor.forward(states)
+            dist = self.actor.forward(states, action_mask)
             critic_value = self.critic.forward(states)
 
             new_probs = dist.log_prob(actions)
@@ -271,16 +269,16 @@ class PPO:
             T.nn.utils.clip_grad_norm_(self.critic.parameters(), 5)
             self.actor.optimizer.step()
             self.critic.optimizer.step()
-            total_loss_cum += total_loss
-        self.clear_memory()
+            total_loss_cum += total_loss.item()
+        self.clear_memory([agent])
         return total_loss_cum/len(batches)
 
     def remember(self, states, actions, probs, vals, rewards, next_states, dones, agent_list):
         self.memory.store_agent_step_data(states, actions, probs, vals, rewards, next_states, dones, agent_list)
         return rewards
 
-    def clear_memory(self):
-        self.memory.clean_agent_step_data()
+    def clear_memory(self, agents=None):
+        self.memory.clean_agent_step_data(agents)
     def save_checkpoint(self, filename):
         self.actor.save_checkpoint(f'actor_{filename}')
         self.critic.save_checkpoint(f'critic_{filename}')
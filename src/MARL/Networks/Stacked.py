@@ -0,0 +1,81 @@
+import torch as T
+import torch.nn.functional as F
+
+
+class StackedMLP:
+    """
+    Inference-only view of several per-agent MLPs with the same body, stacked into batched tensors so that the decision
+    of every agent can be computed with one batched matmul per layer instead of one forward pass per agent.
+
+    The networks are expected to be a chain of nn.Linear layers with leaky_relu activations (the trunk) followed by
+    one or more linear heads, which is the shape of every network in src/MARL/Networks. Heads may have a different
+    number of outputs per agent (agents have different neighbourhood sizes), those are padded with zeros to the largest
+    one and masked_head() hides the padding.
+
+    The stacked weights are a snapshot, call invalidate() whenever the source networks are trained and they will be
+    copied again on the next forward.
+    """
+
+    def __init__(self, modules, trunk, heads):
+        self.modules = list(modules)
+        self.trunk = list(trunk)
+        self.heads = list(heads)
+        self.n_members = len(self.modules)
+        self.device = next(self.modules[0].parameters()).device
+
+        self.weights = {}
+        self.biases = {}
+        for name in self.trunk + self.heads:
+            out_features = max(getattr(m, name).out_features for m in self.modules)
+            in_features = getattr(self.modules[0], name).in_features
+            self.weights[name] = T.zeros(self.n_members, out_features, in_features, device=self.device)
+            self.biases[name] = T.zeros(self.n_members, 1, out_features, device=self.device)
+
+        # True where the head output exists for the member.
+        self.head_masks = {}
+        for name in self.heads:
+            sizes = T.tensor([getattr(m, name).out_features for m in self.modules], device=self.device)
+            self.head_masks[name] = T.arange(int(sizes.max()), device=self.device).unsqueeze(0) < sizes.unsqueeze(1)
+
+        self.dirty = True
+
+    def invalidate(self):
+        self.dirty = True
+
+    @T.no_grad()
+    def refresh(self):
+        for name in self.trunk + self.heads:
+            weight = self.weights[name]
+            bias = self.biases[name]
+            for idx, module in enumerate(self.modules):
+                layer = getattr(module, name)
+                weight[idx, :layer.out_features].copy_(layer.weight)
+                bias[idx, 0, :layer.out_features].copy_(layer.bias)
+        self.dirty = False
+
+    @T.no_grad()
+    def forward(self, states, rows=None):
+        """
+        :param states: tensor with shape (n, *input_dims), one observation per member.
+        :param rows: the members the observations belong to, when None all the members in order.
+        :return: dict with the output of each head, each with shape (n, out_features).
+        """
+        if self.dirty:
+            self.refresh()
+        x = states.unsqueeze(1)
+        for name in self.trunk:
+            x = F.leaky_relu(T.baddbmm(self.__select(self.biases[name], rows), x,
+                                       self.__select(self.weights[name], rows).transpose(1, 2)))
+        return {name: T.baddbmm(self.__select(self.biases[name], rows), x,
+                                self.__select(self.weights[name], rows).transpose(1, 2)).squeeze(1)
+                for name in self.heads}
+
+    def masked_head(self, name, output, rows=None, fill=-float('inf')):
+        """
+        Hides the padded outputs of a head, so they are never picked by argmax or sampled.
+        """
+        return output.masked_fill(~self.__select(self.head_masks[name], rows), fill)
+
+    @staticmethod
+    def __select(tensor, rows):
+        return tensor if rows is None else tensor[rows]
@@ -1,10 +1,13 @@
 import numpy as np
+import torch as T
 import peersim_gym.envs.PeersimEnv as pe
 import peersim_gym.envs.PeersimEnv as pg
 from peersim_gym.envs.PeersimEnv import PeersimEnv
 
 from src.MARL.Agent import Agent
 from src.MARL.Networks.PPO import PPO
+from src.MARL.Networks.Stacked import StackedMLP
+from torch.distributions import Categorical
 from src.Utils import utils
 from src.Utils.MetricHelper import MetricHelper as mh
 
@@ -20,7 +23,7 @@ class PPOAgentMARL(Agent):
 
     def __init__(self, input_shape, action_space, output_shape, agents, learning_rate=0.7, gamma=0.4,
                  steps_for_return=150, policy_clip=0.1, batch_size=64, N=2048, gae_lambda=0.95,
-                 collect_data=False, save_interval=50, control_type="PPO"):
+                 collect_data=False, save_interval=50, control_type="PPO", shared=False):
         super().__init__(input_shape, action_space, output_shape, learning_rate, collect_data=collect_data)
         self.last_val = {agent: 0 for agent in agents}
         self.last_prob = {agent: 0 for agent in agents}
@@ -39,10 +42,27 @@ class PPOAgentMARL(Agent):
         if self.steps_for_return < self.batch_size:
             print("Steps for return is smaller than the batch size, setting the steps for return to the batch size")
             self.steps_for_return = self.batch_size
-        for agent in self.possible_agents:
+        self.agent_idx = {agent: idx for idx, agent in enumerate(self.possible_agents)}
+        # In shared mode a single actor and critic are used by every agent, each agent keeps its own rollout. The node
+        # ID in the flattened observation tells the agents apart, and the actions past each agent's neighbourhood size
+        # are masked out.
+        self.shared = shared
+        if self.shared:
+            shared_PPO = PPO(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512, fc2_dims=256, fc3_dims=128,
+                             policy_clip=0.1, batch_size=64, N=self.steps_for_return, gae_lambda=0.95,
+                             n_actions=max(output_shape[agent] for agent in self.possible_agents), agents=agents)
+            self.PPOs = {agent: shared_PPO for agent in self.possible_agents}
+            self.action_masks = T.from_numpy(utils.action_masks(output_shape, self.possible_agents)).to(shared_PPO.device)
+        for agent in self.possible_agents if not self.shared else []:
             rank = output_shape[agent]
             self.PPOs[agent] = PPO(lr=learning_rate, input_dims=self.input_shape, fc1_dims=512, fc2_dims=256, fc3_dims=128,
-                                    policy_clip=0.1, batch_size=64, N=2048, gae_lambda=0.95, n_actions=rank, agents=agents)
+                                    policy_clip=0.1, batch_size=64, N=self.steps_for_return, gae_lambda=0.95, n_actions=rank, agents=[agent])
+        if not self.shared:
+            # Used to pick the actions of all the agents in one pass, see get_actions.
+            self.stacked_actors = StackedMLP([self.PPOs[agent].actor for agent in self.possible_agents],
+                                             trunk=['fc1', 'fc2', 'fc3'], heads=['logits'])
+            self.stacked_critics = StackedMLP([self.PPOs[agent].critic for agent in self.possible_agents],
+                                              trunk=['fc1', 'fc2', 'fc3'], heads=['v'])
 
         self.amount_of_metrics = 50
         self.last_losses = np.zeros(self.amount_of_metrics)
@@ -61,9 +81,10 @@ class PPOAgentMARL(Agent):
                      file_name=results_file + "_result")
 
         if load_weights is not None:
-            for idx, agent in enumerate(env.possible_agents):
+            for idx, agent in enumerate(self.__checkpointed_agents(env.possible_agents)):
                 agent_w = load_weights + f"_{agent}.pth.tar"
                 self.PPOs[agent].load_checkpoint(agent_w, "")  # need to convert this to what I've been using.
+            self.__invalidate_stacked()
 
         for i in range(num_episodes):
             # Prepare variables for the next run
@@ -80,8 +101,7 @@ class PPOAgentMARL(Agent):
             while not utils.is_done(dones):
                 print(f'Step: {step}\n')
                 # Interaction Step:
-                targets = {agent: np.floor(self.get_action(np.array([states[idx]])[0], agent)) for idx, agent in
-                           enumerate(agent_list)}
+                targets = {agent: np.floor(action) for agent, action in self.get_actions(states, agent_list).items()}
                 actions = utils.make_action(targets, agent_list)
 
                 self.mh.register_actions(actions)
@@ -103,6 +123,7 @@ class PPOAgentMARL(Agent):
                     for agent in agent_list:
                         last_loss = self.learn(s=None, a=None, r=None, s_next=None, k=step, fin=None, agent=agent) # Not used inside of PPO
                         last_losses[agent] = last_loss if not last_loss is None else 0
+                    self.__invalidate_stacked()
 
                 print(f'Action{actions}  -   Loss: {last_losses}  -    Rewards: {rewards}')
                 self.mh.update_metrics_after_step(rewards=rewards,
@@ -119,7 +140,7 @@ class PPOAgentMARL(Agent):
             self.mh.print_action_density_episode()
             self.mh.compile_aggregate_metrics(i, step)
             if i % self.save_interval == 0:
-                for agent in env.agents:
+                for agent in self.__checkpointed_agents(env.agents):
                     self.PPOs[agent].save_checkpoint(filename=f"{self.control_type}_value_{i}_{agent}.pth.tar")
 
             print("Episode {0}/{1}, Score: {2}, AVG Score: {3}".format(i, num_episodes, score,
@@ -132,10 +153,14 @@ class PPOAgentMARL(Agent):
         self.mh.clean_plt_resources()
 
     def learn(self, s, a, r, s_next, k, fin, agent):
+        if self.shared:
+            return self.PPOs[agent].learn(agent, self.action_masks[self.agent_idx[agent]])
         loss = self.PPOs[agent].learn()
         return loss
 
     def get_action(self, observation, agent):
+        if self.shared:
+            return self.get_actions([observation], [agent])[agent]
         action = self.PPOs[agent].choose_action(observation)
         self.last_val[agent] = action[1]
         self.last_prob[agent] = action[2]
@@ -143,6 +168,50 @@ class PPOAgentMARL(Agent):
 
 
 
+    def get_actions(self, observations, agent_list):
+        """
+        Batched version of get_action. Samples the actions of all the agents with one pass of the stacked actors and
+        critics, and moves the actions, log probs and values to the cpu with a single transfer.
+        :param observations: list/array of flattened observations, ordered like agent_list.
+        :param agent_list:
+        :return: dict with the action of each agent.
+        """
+        rows = None if list(agent_list) == list(self.possible_agents) else \
+            T.tensor([self.agent_idx[agent] for agent in agent_list])
+        with T.no_grad():
+            if self.shared:
+                # One batched pass of the shared actor and critic, with the observations of all the agents as the batch.
+                shared_PPO = self.PPOs[agent_list[0]]
+                state = T.tensor(np.array(observations), dtype=T.float).to(shared_PPO.device)
+                masks = self.action_masks if rows is None else self.action_masks[rows.to(shared_PPO.device)]
+                dist = shared_PPO.actor.forward(state, masks)
+                value = shared_PPO.critic.forward(state).squeeze(1)
+            else:
+                state = T.tensor(np.array(observations), dtype=T.float).to(self.stacked_actors.device)
+                logits = self.stacked_actors.forward(state, rows)['logits']
+                dist = Categorical(logits=self.stacked_actors.masked_head('logits', logits, rows))
+                value = self.stacked_critics.forward(state, rows)['v'].squeeze(1)
+            action = dist.sample()
+            log_prob = dist.log_prob(action)
+            action, log_prob, value = T.stack((action.float(), log_prob, value)).cpu().numpy()
+        for idx, agent in enumerate(agent_list):
+            # Same convention as get_action.
+            self.last_val[agent] = log_prob[idx]
+            self.last_prob[agent] = value[idx]
+        return {agent: int(action[idx]) for idx, agent in enumerate(agent_list)}
+
+    def __invalidate_stacked(self):
+        if not self.shared:
+            self.stacked_actors.invalidate()
+            self.stacked_critics.invalidate()
+
+    def __checkpointed_agents(self, agents):
+        """
+        In shared mode all the agents have the same networks, so only one checkpoint is kept (named after the first
+        agent).
+        """
+        return list(agents)[:1] if self.shared else agents
+
     def tally_actions(self, actions):
         for worker, action in actions.items():
             self.mh.register_action(action[pe.ACTION_NEIGHBOUR_IDX_FIELD], worker)
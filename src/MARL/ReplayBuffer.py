@@ -0,0 +1,243 @@
+import numpy as np
+
+
+class MultiAgentReplayBuffer:
+    """
+    Replay buffer shared by all the agents in a MARL setting. Instead of keeping one set of arrays per agent, each field
+    is kept as one contiguous array with shape (n_agents, capacity, ...). This allows storing the transitions of every
+    agent for one step with a single vectorized write, and sampling a batch of indexes for all the agents at once.
+
+    The memory counter advances once per environment step (not once per agent), all agents share the same write
+    position. The agents missing from a step (store_transitions with an agent_list) get nothing written there, so
+    valid_memory marks which positions hold a transition of each agent, and only those are sampled.
+
+    Inspired by DanielPalaio's Project in:
+    https://github.com/DanielPalaio/LunarLander-v2_DeepRL/blob/main/DQN/replay_buffer.py
+    """
+
+    def __init__(self, agents, capacity, input_shape, seed=None):
+        self.agents = list(agents)
+        self.agent_idx = {agent: idx for idx, agent in enumerate(self.agents)}
+        self.n_agents = len(self.agents)
+        self.capacity = capacity
+        self.input_shape = input_shape
+
+        self.state_memory = np.zeros((self.n_agents, self.capacity, *self.input_shape), dtype=np.float32)
+        self.new_state_memory = np.zeros((self.n_agents, self.capacity, *self.input_shape), dtype=np.float32)
+        self.action_memory = np.zeros((self.n_agents, self.capacity), dtype=np.int64)
+        self.reward_memory = np.zeros((self.n_agents, self.capacity), dtype=np.float32)
+        self.terminal_memory = np.zeros((self.n_agents, self.capacity), dtype=bool)
+        self.valid_memory = np.zeros((self.n_agents, self.capacity), dtype=bool)
+        self.valid_counts = np.zeros(self.n_agents, dtype=np.int64)  # Positions of each agent in valid_memory.
+        self.memory_counter = 0
+
+        self.rng = np.random.default_rng(seed)
+        # Used for fancy indexing when gathering the batches, avoids re-allocating it on every sample.
+        self._row_index = np.arange(self.n_agents)[:, None]
+
+    def __len__(self):
+        return min(self.memory_counter, self.capacity)
+
+    def rows(self, agent_list):
+        """
+        Converts a list of agent names into the rows they occupy in the buffer.
+        :param agent_list:
+        :return:
+        """
+        return np.array([self.agent_idx[agent] for agent in agent_list], dtype=np.int64)
+
+    def store_transitions(self, states, actions, rewards, next_states, dones, agent_list=None):
+        """
+        Stores the transitions of all the agents for one step in a single write.
+        :param states: array-like with shape (n_agents, *input_shape), ordered like agent_list.
+        :param actions: array-like with shape (n_agents,)
+        :param rewards: array-like with shape (n_agents,)
+        :param next_states: array-like with shape (n_agents, *input_shape)
+        :param dones: array-like with shape (n_agents,)
+        :param agent_list: agents the rows belong to. When None, all the agents in the buffer, in order.
+        :return: the index where the transitions were written.
+        """
+        index = self.memory_counter % self.capacity  # Allows overwriting old memories
+        rows = slice(None) if agent_list is None else self.rows(agent_list)
+        # What the missing agents had at this position is from capacity steps ago (or zeros), it is no longer theirs.
+        self.valid_counts -= self.valid_memory[:, index]
+        self.valid_memory[:, index] = False
+        self.valid_memory[rows, index] = True
+        self.valid_counts[rows] += 1
+        self.state_memory[rows, index] = states
+        self.new_state_memory[rows, index] = next_states
+        self.action_memory[rows, index] = np.asarray(actions).reshape(-1)
+        self.reward_memory[rows, index] = rewards
+        self.terminal_memory[rows, index] = dones
+        self.memory_counter += 1
+        return index
+
+    def ready(self, batch_size, agent_list=None):
+        """
+        :param batch_size:
+        :param agent_list: the agents that are going to be trained, when None all the agents.
+        :return: True if every agent in agent_list has batch_size transitions.
+        """
+        rows = slice(None) if agent_list is None else self.rows(agent_list)
+        return self.valid_counts[rows].min() >= batch_size
+
+    def sample_indexes(self, batch_size):
+        """
+        Draws batch_size indexes for every agent at once. Sampling is done with replacement, which is O(batch_size)
+        instead of the O(capacity) permutation np.random.choice(..., replace=False) requires. With the buffer sizes
+        used here the chance of repeated transitions in a batch is negligible.
+        The positions where an agent was missing are drawn again, which only costs something for the agents that miss
+        most of the steps. Those that still hit one after a few draws pick from their valid positions directly.
+        :param batch_size:
+        :return: array with shape (n_agents, batch_size)
+        """
+        batch = self.rng.integers(0, len(self), size=(self.n_agents, batch_size))
+        for _ in range(4):
+            invalid = ~self.valid_memory[self._row_index, batch]
+            if not invalid.any():
+                return batch
+            batch[invalid] = self.rng.integers(0, len(self), size=int(invalid.sum()))
+        invalid = ~self.valid_memory[self._row_index, batch]
+        for row in np.flatnonzero(invalid.any(axis=1) & (self.valid_counts > 0)):
+            valid = np.flatnonzero(self.valid_memory[row])
+            batch[row, invalid[row]] = self.rng.choice(valid, size=int(invalid[row].sum()))
+        return batch
+
+    def gather(self, batch):
+        """
+        Collects the transitions for a (n_agents, batch_size) array of indexes.
+        :param batch:
+        :return: states, actions, rewards, next_states, dones. Each with shape (n_agents, batch_size, ...)
+        """
+        rows = self._row_index
+        return (self.state_memory[rows, batch],
+                self.action_memory[rows, batch],
+                self.reward_memory[rows, batch],
+                self.new_state_memory[rows, batch],
+                self.terminal_memory[rows, batch])
+
+    def sample(self, batch_size):
+        return self.gather(self.sample_indexes(batch_size))
+
+
+class SumTree:
+    """
+    Array-backed sum-tree, one tree per row so that the priorities of every agent are kept in a single array with shape
+    (n_trees, 2 * leaves). Node i has children 2i and 2i+1, the root is node 1 and the leaves start at node `leaves`.
+    Both updates and prefix-sum searches walk the tree level by level, which is O(log n) and vectorized over all the
+    rows and batch entries.
+
+    Based on:
+    - https://arxiv.org/abs/1511.05952 | Prioritized Experience Replay
+    - https://github.com/rlcode/per/blob/master/SumTree.py
+    """
+
+    def __init__(self, n_trees, capacity):
+        self.n_trees = n_trees
+        self.capacity = capacity
+        self.depth = max(1, int(np.ceil(np.log2(capacity))))
+        self.leaves = 2 ** self.depth
+        self.tree = np.zeros((n_trees, 2 * self.leaves), dtype=np.float64)
+        self._row_index = np.arange(n_trees)[:, None]
+
+    def total(self):
+        return self.tree[:, 1]
+
+    def get(self, rows, data_idx):
+        return self.tree[rows, data_idx + self.leaves]
+
+    def update(self, rows, data_idx, priorities):
+        """
+        Sets the priority of the given entries and propagates the change up to the root.
+        :param rows: array broadcastable with data_idx, the tree of each entry.
+        :param data_idx: the position of each entry in the buffer.
+        :param priorities:
+        :return:
+        """
+        rows, node = np.broadcast_arrays(rows, data_idx + self.leaves)
+        self.tree[rows, node] = priorities
+        for _ in range(self.depth):
+            node = node // 2
+            self.tree[rows, node] = self.tree[rows, 2 * node] + self.tree[rows, 2 * node + 1]
+
+    def find(self, values):
+        """
+        Finds, for each row, the entries whose cumulative priority interval contains the value.
+        :param values: array with shape (n_trees, batch_size), each in [0, total) of its row.
+        :return: the buffer positions, same shape as values.
+        """
+        values = np.array(values, dtype=np.float64)
+        node = np.ones(values.shape, dtype=np.int64)
+        rows = self._row_index
+        for _ in range(self.depth):
+            left = self.tree[rows, 2 * node]
+            go_right = values > left
+            values = np.where(go_right, values - left, values)
+            node = 2 * node + go_right
+        return node - self.leaves
+
+
+class PrioritizedMultiAgentReplayBuffer(MultiAgentReplayBuffer):
+    """
+    Multi-agent replay buffer with proportional prioritization. New transitions get the highest priority seen so far,
+    and priorities are refreshed from the TD errors of the sampled batches with update_priorities(). The positions
+    where an agent was missing get priority 0, so they are never sampled.
+
+    sample() returns, next to the transitions, the sampled positions and the importance-sampling weights that correct
+    for the non-uniform sampling, with beta annealed towards 1 at every sample.
+    """
+
+    def __init__(self, agents, capacity, input_shape, alpha=0.6, beta=0.4, beta_increment=1e-4, epsilon=1e-6,
+                 seed=None):
+        super().__init__(agents, capacity, input_shape, seed=seed)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+        self.tree = SumTree(self.n_agents, self.capacity)
+        self.max_priority = np.ones(self.n_agents, dtype=np.float64)
+
+    def store_transitions(self, states, actions, rewards, next_states, dones, agent_list=None):
+        index = super().store_transitions(states, actions, rewards, next_states, dones, agent_list)
+        priorities = np.where(self.valid_memory[:, index], self.max_priority ** self.alpha, 0.0)
+        self.tree.update(np.arange(self.n_agents), index, priorities)
+        return index
+
+    def sample_indexes(self, batch_size):
+        """
+        Stratified sampling, the priority mass of each agent is split in batch_size segments and one entry is drawn
+        from each.
+        :param batch_size:
+        :return: array with shape (n_agents, batch_size)
+        """
+        total = self.tree.total()[:, None]
+        segments = (np.arange(batch_size) + self.rng.random((self.n_agents, batch_size))) / batch_size
+        # Keeps float error from landing on the (empty) leaves past the end of the data.
+        values = np.minimum(segments * total, total * (1 - 1e-12))
+        return np.minimum(self.tree.find(values), len(self) - 1)
+
+    def importance_weights(self, batch):
+        # An agent that was never stored has no priority mass at all.
+        probs = self.tree.get(self._row_index, batch) / np.maximum(self.tree.total()[:, None], 1e-12)
+        weights = (len(self) * np.maximum(probs, 1e-12)) ** (-self.beta)
+        # Normalized per agent, so the weights only ever scale the updates down.
+        return (weights / weights.max(axis=1, keepdims=True)).astype(np.float32)
+
+    def sample(self, batch_size):
+        batch = self.sample_indexes(batch_size)
+        weights = self.importance_weights(batch)
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return (*self.gather(batch), batch, weights)
+
+    def update_priorities(self, batch, td_errors, agent_rows=None):
+        """
+        Refreshes the priorities of the sampled entries of all the agents at once.
+        :param batch: the positions returned by sample(), shape (n_agents, batch_size).
+        :param td_errors: absolute TD errors with the same shape.
+        :param agent_rows: the rows the batch belongs to, when None all the agents in order.
+        :return:
+        """
+        rows = self._row_index if agent_rows is None else np.asarray(agent_rows)[:, None]
+        priorities = np.abs(td_errors) + self.epsilon
+        self.tree.update(rows, batch, priorities ** self.alpha)
+        np.maximum.at(self.max_priority, np.broadcast_to(rows, batch.shape).reshape(-1), priorities.reshape(-1))
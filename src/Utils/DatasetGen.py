@@ -1,30 +1,49 @@
 import csv
+import os
+
 import numpy as np
 from src.Utils import utils as fl
+from src.Utils.SarsaDataset import INDEX, SarsaDataset, SarsaDatasetWriter, is_dataset
+
+DATASET_SUFFIX = "_sarsa"
+
+
 class SarsaDataCollector:
     """
     Automaically generated class, that I fixed.
+    The transitions go to a SarsaDatasetWriter, as float32 columns: streamed to the shards of a dataset directory when
+    one is given, otherwise kept in memory until save or save_to_csv.
     """
-    def __init__(self, agents):
-        # TODO: When I have  multiple agents maybe pivoting to a dict with an entry per agent would be better
-        self.data = []
+    def __init__(self, agents, directory=None, chunk_size=4096):
+        """
+        :param agents:
+        :param directory: dataset directory the transitions are streamed to, None keeps them in memory.
+        :param chunk_size: transitions per shard.
+        """
         self.agents = agents
+        self.writer = SarsaDatasetWriter(agents, directory=directory, chunk_size=chunk_size)
     def add_data_point(self, episode, step, state, action, reward, next_state, done):
         for agent in self.agents:
             if agent not in state.keys():
                 continue
+            self.writer.append(agent, episode, step,
+                               state=fl.flatten_observation(state[agent]),
+                               action=fl.flatten_action(action[agent]),
+                               reward=float(reward[agent]),
+                               next_state=fl.flatten_observation(next_state[agent]),
+                               done=done[agent])
 
-            data_point = {
-                'agent': agent,
-                'episode': episode,
-                'step': step,
-                'state': fl.flatten_observation(state[agent]),
-                'action': fl.flatten_action(action[agent]),
-                'reward': float(reward[agent]),
-                'next_state': fl.flatten_observation(next_state[agent]),
-                'done': done[agent]
-            }
-            self.data.append(data_point)
+    def save(self, directory=None):
+        """
+        Commits the transitions collected as a binary dataset, see load_dataset.
+        :param directory: where to write them, only needed when they are not being streamed.
+        """
+        if self.writer.directory is not None:
+            self.writer.close()
+        elif directory is None:
+            raise ValueError("The transitions are kept in memory, save needs the directory to write them to")
+        else:
+            self.writer.save(directory)
 
     def save_to_csv(self, filename):
         with open(filename, 'w', newline='') as csvfile:
@@ -32,11 +51,57 @@ class SarsaDataCollector:
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames, lineterminator='\n')
 
             writer.writeheader()
-            for data_point in self.data:
-                writer.writerow(data_point)
+            if self.writer.directory is None:
+                chunks = self.writer.chunks()
+            else:
+                self.writer.flush()
+                chunks = [SarsaDataset(self.writer.directory).batch(0, len(self.writer))]
+            for chunk in chunks:
+                for row in range(len(chunk['reward'])):
+                    writer.writerow({
+                        'agent': self.agents[chunk['agent'][row]],
+                        'episode': chunk['episode'][row],
+                        'step': chunk['step'][row],
+                        'state': chunk['state'][row],
+                        'action': chunk['action'][row],
+                        'reward': float(chunk['reward'][row]),
+                        'next_state': chunk['next_state'][row],
+                        'done': bool(chunk['done'][row])
+                    })
+
+    def load_dataset(self, path):
+        """
+        Opens a dataset memory-mapped. A CSV (the old format) is converted once to a dataset directory next to it,
+        <name>_sarsa, and converted again only when the CSV is newer.
+        :param path: dataset directory or CSV file.
+        :return: SarsaDataset
+        """
+        if is_dataset(path):
+            return SarsaDataset(path)
+        directory = os.path.splitext(path)[0] + DATASET_SUFFIX
+        if not os.path.exists(path):
+            # Only the dataset was written (e.g. by ControlAlgorithm), nothing to convert.
+            return SarsaDataset(directory)
+        if not is_dataset(directory) or os.path.getmtime(os.path.join(directory, INDEX)) < os.path.getmtime(path):
+            self.convert_csv(path, directory)
+        return SarsaDataset(directory)
+
+    def convert_csv(self, filename, directory):
+        with open(filename, 'r') as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        agents = list(dict.fromkeys(row['agent'] for row in rows))
+        writer = SarsaDatasetWriter(agents, directory=directory)
+        for row in rows:
+            writer.append(row['agent'], int(row['episode']), int(row['step']),
+                          state=self.brute_force_convert(row['state']),
+                          action=self.brute_force_convert(row['action']),
+                          reward=float(row['reward']),
+                          next_state=self.brute_force_convert(row['next_state']),
+                          done=row['done'] == 'True')
+        writer.close()
 
     def load_from_csv(self, filename):
-        self.data = []
+        data = []
         with open(filename, 'r') as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
@@ -46,8 +111,8 @@ class SarsaDataCollector:
                 row['next_state'] = self.brute_force_convert(row['next_state'])
                 row['reward'] = float(row['reward'])
                 row['done'] = row['done'] == 'True'
-                self.data.append(row)
-        return self.data
+                data.append(row)
+        return data
     def load_from_csv_to_arrays(self, filename):
         states  = []
         actions = []
@@ -67,7 +132,6 @@ class SarsaDataCollector:
                 rewards.append(self.brute_force_convert(row['reward']))
                 next_states.append(self.brute_force_convert(row['next_state']))
                 dones.append(row['done'] == 'True')
-                self.data.append(row)
         return states, actions, rewards, next_states, dones
     def brute_force_convert(self, string_data):
         values = string_data.replace("[", "").replace("]", "").replace("\n", "").split()
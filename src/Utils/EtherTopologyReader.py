@@ -171,3 +171,64 @@ def get_topology_data(filename="SimpleNetwork_data.json", project_coordinates=Fa
         "controllers": controllers,
     }
     return result_dict
+
+
+def get_cluster_heads(filename="SimpleNetwork_data.json", head_key="nuc"):
+    """
+    Assigns each node of the topology to a cluster head, for the hierarchical aggregation of the FL trainers. The same
+    rule as SimpleAndFast.getNuc: the head of a node is the neighbouring "nuc" with the lowest expected rtt, the heads
+    lead their own cluster. Nodes without a head in their neighbourhood are left out.
+
+    :param filename: The name of the file with the topology
+    :param head_key: The name of the nodes that can be cluster heads
+    :return: A dictionary node index -> index of its cluster head, with the indexes used by get_topology_data.
+    """
+    topology = read_ether_topology(filename)
+    node_dict = topology["nodes"]
+    link_dict = topology["links"]
+
+    id_consultation_dict = {}
+    heads = set()
+    for idx, key in enumerate(node_dict.keys()):
+        id_consultation_dict[node_dict[key]["id"]] = idx
+        if head_key in key:
+            heads.add(idx)
+
+    rtts = {}
+    for path in link_dict["path_info"]:
+        rtts[(id_consultation_dict[path["source"]], id_consultation_dict[path["target"]])] = path["expected_rtt"]
+
+    cluster_heads = {head: head for head in heads}
+    for node, neighbourhood in link_dict["neighbours"].items():
+        source = id_consultation_dict[int(node)]
+        if source in heads:
+            continue
+        candidates = [id_consultation_dict[neighbour] for neighbour in neighbourhood
+                      if id_consultation_dict[neighbour] in heads]
+        if candidates:
+            cluster_heads[source] = min(candidates, key=lambda head: rtts.get((source, head), rtts.get((head, source), float("inf"))))
+    return cluster_heads
+
+
+def get_link_info(filename="SimpleNetwork_data.json"):
+    """
+    Reads the paths between neighbouring nodes, as saved by TopologySavingTools.convert_link_list_to_dict, to estimate
+    how long a message takes from one node to the other.
+
+    :param filename: The name of the file with the topology
+    :return: A dictionary (source index, target index) -> (expected rtt in ms, min bandwidth of the path in Mbit/s),
+    with the indexes used by get_topology_data.
+    """
+    topology = read_ether_topology(filename)
+    node_dict = topology["nodes"]
+    link_dict = topology["links"]
+
+    id_consultation_dict = {}
+    for idx, key in enumerate(node_dict.keys()):
+        id_consultation_dict[node_dict[key]["id"]] = idx
+
+    link_info = {}
+    for path in link_dict["path_info"]:
+        link_info[(id_consultation_dict[path["source"]], id_consultation_dict[path["target"]])] = \
+            (path["expected_rtt"], path["min_bandwidth"])
+    return link_info
@@ -3,15 +3,27 @@ import peersim_gym.envs.PeersimEnv as pe
 import matplotlib.pyplot as plt
 import numpy as np
 
+from src.Utils.StepMetricsStore import StepMetricsStore
+from src.Utils.ResultsWriter import ResultsWriter, load_results
+
 
 class MetricHelper:
-    def __init__(self, agents, num_nodes, num_episodes, file_name):
+    def __init__(self, agents, num_nodes, num_episodes, file_name, stream_results=True, flush_every=10):
+        """
+        :param agents:
+        :param num_nodes:
+        :param num_episodes:
+        :param file_name:
+        :param stream_results: append every compiled episode to <file_name>_episodes (see ResultsWriter) instead of
+        keeping the whole history in memory. The history is read back from there for the plots and store_as_cvs.
+        :param flush_every: episodes written together. A killed run keeps the episodes of the chunks written so far,
+        they can be read back with load_results (src.Utils.ResultsWriter).
+        """
 
-        #
-        self.reward_per_agent = {}
-        self.reward_per_agent_history = {agent: [] for agent in agents}  # This is what is used to save the episode info, it's built using reward_per_agent. It saves data for the whole episode.
+        # Rewards and losses of each agent at each step of the current episode, see StepMetricsStore.
+        self.step_metrics = StepMetricsStore(agents, fields=('reward', 'loss'))
+        self.reward_per_agent_history = {agent: [] for agent in agents}  # This is what is used to save the episode info, it's built using step_metrics. It saves data for the whole episode.
 
-        self.loss_per_agent = {}
         self.loss_per_agent_history = {agent: [] for agent in agents}
 
         # This will store the number of times each of the nodes was overloaded in one episode. Meaning that if we have
@@ -62,6 +74,10 @@ class MetricHelper:
         self.agents = agents
         self.file_name = file_name
 
+        self.results_writer = None
+        if stream_results and file_name is not None:
+            self.results_writer = ResultsWriter(f"{file_name}_episodes", flush_every=flush_every)
+
     def update_metrics_after_step(self, rewards, losses, overloaded_nodes, average_response_time, occupancy, dropped_tasks,
                                   finished_tasks, total_tasks, consumed_energy, agents=None):
         """
@@ -73,14 +89,11 @@ class MetricHelper:
         :param occupancy:
         :return:
         """
-        step_reward = 0
         agents = agents if agents is not None else self.agents
-        for agent in agents:
-            self.reward_per_agent[agent] = self.reward_per_agent.get(agent, []) + [rewards[agent]]
-            self.loss_per_agent[agent] = self.loss_per_agent.get(agent, []) + [losses[agent]]
-            step_reward += rewards[agent]
+        step_rewards = [rewards[agent] for agent in agents]
+        self.step_metrics.append(agents, reward=step_rewards, loss=[losses[agent] for agent in agents])
 
-        self._aux_average_reward += step_reward / len(agents)
+        self._aux_average_reward += sum(step_rewards) / len(agents)
 
         self.average_response_time_per_episode = average_response_time
         self.tasks_finished_per_episode = finished_tasks
@@ -100,6 +113,26 @@ class MetricHelper:
         :return:
         """
 
+        self.average_rewards += [self._aux_average_reward / no_steps]
+        if self.results_writer is not None:
+            # Streamed to disk, the history in memory stays empty.
+            self.results_writer.append(
+                columns={
+                    "overloaded": np.array(self.overloaded_nodes_per_episode),
+                    "occupancy": np.array(self.occupancy_per_episode) / no_steps,
+                    "response_time": np.array(self.average_response_time_per_episode),
+                    "energy_consumed": np.array(self.consumed_energy_per_episode),
+                    "tasks_finished": np.array(self.tasks_finished_per_episode),
+                    "tasks_dropped": np.array(self.tasks_dropped_per_episode),
+                    "tasks_total": np.array(self.tasks_total_per_episode),
+                    "average_reward": self.average_rewards[-1],
+                    "steps": no_steps,
+                },
+                series={f"{agent}_{field}": self.step_metrics.series(field, agent)
+                        for agent in self.agents for field in ('reward', 'loss')})
+            self.__reset_step_metrics()
+            return
+
         # Move the buckets for each step to the history
         self.occupancy_history.append(np.array(self.occupancy_per_episode) / no_steps)
         self.average_response_time_history.append(np.array(self.average_response_time_per_episode))
@@ -111,10 +144,10 @@ class MetricHelper:
         self.tasks_total_history.append(np.array(self.tasks_total_per_episode))
 
         for agent in self.agents:
-            self.reward_per_agent_history[agent].append(self.reward_per_agent[agent])
-            self.loss_per_agent_history[agent].append(self.loss_per_agent[agent])
-
-        self.average_rewards += [self._aux_average_reward / no_steps]
+            # Views of the episode's arrays, not copies. With cohort selection an agent may not have acted in the whole
+            # episode, its series is then empty.
+            self.reward_per_agent_history[agent].append(self.step_metrics.series('reward', agent))
+            self.loss_per_agent_history[agent].append(self.step_metrics.series('loss', agent))
 
         self.__reset_step_metrics()
 
@@ -125,8 +158,7 @@ class MetricHelper:
         return self.average_rewards[episode]
 
     def __reset_step_metrics(self):
-        self.reward_per_agent = {}
-        self.loss_per_agent = {}
+        self.step_metrics = self.step_metrics.next_episode()
 
         self.overloaded_nodes_per_episode = np.zeros(self.num_nodes)
         self.average_response_time_per_episode = np.zeros(self.num_nodes)
@@ -136,23 +168,48 @@ class MetricHelper:
         self.tasks_dropped_per_episode = np.zeros(self.num_nodes)
         self.tasks_total_per_episode = np.zeros(self.num_nodes)
 
+    def __load_history(self):
+        """
+        Reads the streamed episodes back into the history lists, for the plots and store_as_cvs.
+        """
+        if self.results_writer is None:
+            return
+        self.results_writer.flush()
+        results = load_results(self.results_writer.directory)
+        if not results:
+            return
+        self.overloaded_nodes_history = list(results["overloaded"])
+        self.occupancy_history = list(results["occupancy"])
+        self.average_response_time_history = list(results["response_time"])
+        self.consumed_energy_history = list(results["energy_consumed"])
+        self.tasks_finished_history = list(results["tasks_finished"])
+        self.tasks_dropped_history = list(results["tasks_dropped"])
+        self.tasks_total_history = list(results["tasks_total"])
+        self.average_rewards = results["average_reward"].tolist()
+        for agent in self.agents:
+            self.reward_per_agent_history[agent] = results.get(f"{agent}_reward", [])
+            self.loss_per_agent_history[agent] = results.get(f"{agent}_loss", [])
+
     def __update_buckets(self, buckets, data):
-        for i in range(len(data)):
-            buckets[i] += data[i]
+        data = np.asarray(data, dtype=float)
+        buckets[:len(data)] += data
         return buckets
 
     def plot_agent_metrics(self, num_episodes, print_instead=False, csv_dump=True, title="default"):
+        self.__load_history()
         # Setup for print
         fig, ax = plt.subplots(ncols=2, nrows=1, sharex=True)  # Create 1x3 plot
-        x = np.arange(num_episodes)
+        # One point per compiled episode, a run stopped early has less than num_episodes.
+        x = np.arange(len(self.average_rewards))
         # Print the metrics:
         ax[0].set_title("Scores")
 
         ax[1].set_title("Average Score in Episode")
 
         for agent in self.agents:
-            agent_mean_reward = np.mean(self.reward_per_agent_history[agent], axis=1)
-            agent_mean_loss = np.mean(self.loss_per_agent_history[agent], axis=1)
+            # The episodes of an agent can have different lengths when it is not in every cohort.
+            agent_mean_reward = [np.mean(episode) if len(episode) > 0 else np.nan for episode in self.reward_per_agent_history[agent]]
+            agent_mean_loss = [np.mean(episode) if len(episode) > 0 else np.nan for episode in self.loss_per_agent_history[agent]]
             ax[0].set_ylabel("Mean Reward")
             ax[0].set_xlabel("Episodes")
             ax[0].plot(x, agent_mean_reward, label=agent)
@@ -169,7 +226,8 @@ class MetricHelper:
             plt.show()
 
     def plot_simulation_data(self, num_episodes, title='default', print_instead=False, csv_dump=True):
-        x = np.arange(num_episodes)
+        self.__load_history()
+        x = np.arange(len(self.overloaded_nodes_history))
         per_episode_total_overloads = np.sum(np.array(self.overloaded_nodes_history), axis=1)
         per_episode_total_occupancy = np.sum(np.array(self.occupancy_history), axis=1)
         per_episode_total_response_time = np.sum(np.array(self.average_response_time_history), axis=1)
@@ -197,15 +255,7 @@ class MetricHelper:
         else:
             print(f"Showing plot {title}")
             plt.show()
-
-        if csv_dump:
-            if title != 'default':
-                print("ERROR: No title for csv file")
-                return
-            with open(f"./Plots/{title}.csv", 'ab') as f:
-                data = np.column_stack(
-                    (x, per_episode_total_overloads, per_episode_total_occupancy, per_episode_total_response_time))
-                np.savetxt(f, data, delimiter=',', header='x,per_episode', comments='')
+        # The per-episode data is already in <file_name>_episodes (and in store_as_cvs), no second CSV is appended.
 
     def clean_plt_resources(self):
         plt.close('all')
@@ -213,6 +263,7 @@ class MetricHelper:
 
     def store_as_cvs(self, file_name):
         print(f"Storing as csv {file_name}")
+        self.__load_history()
         r_headers = []
         headers = []
         r_rows = []
@@ -228,8 +279,8 @@ class MetricHelper:
             row_data = {}
             r_row_data = {}
             for agent in self.reward_per_agent_history.keys():
-                r_row_data[f"{agent}_loss"] = self.loss_per_agent_history[agent][i]
-                r_row_data[f"{agent}_reward"] = self.reward_per_agent_history[agent][i]
+                r_row_data[f"{agent}_loss"] = np.asarray(self.loss_per_agent_history[agent][i]).tolist()
+                r_row_data[f"{agent}_reward"] = np.asarray(self.reward_per_agent_history[agent][i]).tolist()
             row_data["overloaded"] = self.overloaded_nodes_history[i]
             row_data["occupancy"] = self.occupancy_history[i]
             row_data["response_time"] = self.average_response_time_history[i]
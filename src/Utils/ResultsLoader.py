@@ -0,0 +1,168 @@
+import ast
+import csv
+import os
+import re
+
+import numpy as np
+
+SUMMARY_STATS = ('mean', 'std', 'sum', 'count')
+CACHE_DIR = ".summary_cache"
+_memory_cache = {}
+
+
+def parse_array_cell(cell):
+    """
+    Parses a cell written by MetricHelper.store_as_cvs, either a NumPy repr ("[1. 0. 2.]", possibly over several
+    lines) or a list ("[1.0, 0.0, 2.0]").
+    :param cell:
+    :return: 1-D float array.
+    """
+    text = cell.strip().lstrip('[').rstrip(']').replace(',', ' ')
+    try:
+        return np.array(text.split(), dtype=float)
+    except ValueError:
+        # Anything else (e.g. reprs of NumPy scalars), the old regex + literal_eval route.
+        text = re.sub(',+', ',', re.sub(' +', ',', cell.replace('\n', ' ')).replace('[,', '[').replace(',]', ']'))
+        return np.array(ast.literal_eval(text), dtype=float).reshape(-1)
+
+
+def to_matrix(arrays):
+    """
+    :param arrays: list of 1-D arrays, one per episode.
+    :return: (episodes, max length) float matrix, the shorter rows padded with NaN.
+    """
+    width = max((len(array) for array in arrays), default=0)
+    matrix = np.full((len(arrays), width), np.nan)
+    for row, array in enumerate(arrays):
+        matrix[row, :len(array)] = array
+    return matrix
+
+
+class ResultSummary:
+    """
+    Per-episode summary of a results file: for every column the mean, std, sum and count of the values of each
+    episode (row). The files keep one array per cell (e.g. one value per node), and the plots only ever reduce them.
+    Columns can be looked up by name or by position, the way the plots index the CSV rows.
+    """
+
+    def __init__(self, columns, stats):
+        """
+        :param columns: the column names, in the order of the file.
+        :param stats: dict (column, stat) -> array over the episodes.
+        """
+        self.columns = list(columns)
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.stats[(self.columns[0], 'count')]) if self.columns else 0
+
+    def stat(self, column, name):
+        """
+        :param column: name or position of the column.
+        :param name: "mean", "std", "sum" or "count".
+        :return: array with one value per episode.
+        """
+        if isinstance(column, int):
+            column = self.columns[column]
+        return self.stats[(column, name)]
+
+    @classmethod
+    def from_rows(cls, rows, columns=None):
+        """
+        :param rows: rows of the file (without the header), one cell per column.
+        :param columns: the header, defaults to the positions.
+        :return: ResultSummary
+        """
+        n_columns = len(rows[0]) if rows else len(columns or [])
+        columns = list(columns) if columns is not None else [str(idx) for idx in range(n_columns)]
+        stats = {}
+        for idx, column in enumerate(columns):
+            matrix = to_matrix([parse_array_cell(row[idx]) for row in rows])
+            count = np.sum(~np.isnan(matrix), axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                # Empty cells (e.g. agents that never acted) give NaN, as np.mean([]) did.
+                mean = np.nansum(matrix, axis=1) / count
+                std = np.sqrt(np.nansum((matrix - mean[:, None]) ** 2, axis=1) / count)
+            stats[(column, 'mean')] = mean
+            stats[(column, 'std')] = std
+            stats[(column, 'sum')] = np.nansum(matrix, axis=1)
+            stats[(column, 'count')] = count
+        return cls(columns, stats)
+
+    def save(self, path, source_mtime, source_size):
+        arrays = {f"{column}|{name}": self.stats[(column, name)] for column in self.columns for name in SUMMARY_STATS}
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, __columns__=np.array(self.columns), __source__=np.array([source_mtime, source_size]),
+                 **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, source_mtime, source_size):
+        """
+        :return: the cached summary, None if it is missing or was made from another version of the file.
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as cached:
+            if cached['__source__'].tolist() != [source_mtime, source_size]:
+                return None
+            columns = cached['__columns__'].tolist()
+            stats = {(column, name): cached[f"{column}|{name}"] for column in columns for name in SUMMARY_STATS}
+        return cls(columns, stats)
+
+
+def summary_cache_path(path):
+    directory, file_name = os.path.split(os.path.abspath(path))
+    # In a hidden directory, the plots list the result directories looking for files.
+    return os.path.join(directory, CACHE_DIR, file_name + ".npz")
+
+
+def load_summary(path, use_cache=True):
+    """
+    Parses a results file once into a ResultSummary. The summary is kept in memory and in a sidecar file (in
+    .summary_cache next to the results), both keyed by the path and the modification time of the file, so it is only
+    parsed again when it changes.
+    :param path:
+    :param use_cache:
+    :return: ResultSummary
+    """
+    info = os.stat(path)
+    key = (os.path.abspath(path), info.st_mtime_ns, info.st_size)
+    if use_cache and key in _memory_cache:
+        return _memory_cache[key]
+    cache_path = summary_cache_path(path)
+    summary = ResultSummary.load(cache_path, info.st_mtime_ns, info.st_size) if use_cache else None
+    if summary is None:
+        with open(path, 'r') as csv_file:
+            data = list(csv.reader(csv_file))
+        summary = ResultSummary.from_rows(data[1:], columns=data[0] if data else [])
+        if use_cache:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                summary.save(cache_path, info.st_mtime_ns, info.st_size)
+            except OSError:
+                pass  # Read-only results, the summary is only kept in memory.
+    if use_cache:
+        _memory_cache[key] = summary
+    return summary
+
+
+def window_means(values, window=10):
+    """
+    :param values: array over the episodes, first axis.
+    :param window:
+    :return: the mean of every full window of episodes, the incomplete last window is dropped.
+    """
+    values = np.asarray(values, dtype=float)
+    n_windows = len(values) // window
+    return values[:n_windows * window].reshape(n_windows, window, *values.shape[1:]).mean(axis=1)
+
+
+def running_means(values):
+    """
+    :param values: array over the episodes, first axis.
+    :return: the mean of the episodes up to each one.
+    """
+    values = np.asarray(values, dtype=float)
+    counts = np.arange(1, len(values) + 1).reshape(-1, *([1] * (values.ndim - 1)))
+    return np.cumsum(values, axis=0) / counts
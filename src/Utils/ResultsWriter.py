@@ -0,0 +1,122 @@
+import json
+import os
+
+import numpy as np
+
+MANIFEST = "manifest.json"
+LENGTHS_SUFFIX = "__lengths"
+
+
+class ResultsWriter:
+    """
+    Appends the compiled episodes of a run to disk as chunks of typed columns, readable with NumPy alone (load_results).
+    Layout of the directory:
+    - manifest.json: the committed chunks, in order, and the number of episodes in each.
+    - chunk_00000.npz, ...: one array per column, the first axis being the episodes of the chunk. Per-node metrics
+      have shape (episodes, nodes). Series whose length changes per episode (the rewards and losses of an agent) are
+      stored concatenated, next to a <name>__lengths column.
+
+    A chunk is written to a temporary file and renamed, and only then added to the manifest (replaced the same way). A
+    killed run keeps the episodes of the committed chunks, and resume=True continues after them.
+    """
+
+    def __init__(self, directory, flush_every=10, resume=False):
+        """
+        :param directory:
+        :param flush_every: episodes kept in memory before they are written as a chunk.
+        :param resume: continue the run stored in directory, otherwise it is overwritten.
+        """
+        self.directory = directory
+        self.flush_every = max(1, flush_every)
+        os.makedirs(directory, exist_ok=True)
+        self.chunks = []  # list of (file name, number of episodes)
+        if resume:
+            self.chunks = [tuple(chunk) for chunk in read_manifest(directory)]
+        else:
+            self.__write_manifest()
+        self.pending = []
+
+    @property
+    def episodes(self):
+        """
+        :return: number of episodes appended, written or not.
+        """
+        return sum(n for _, n in self.chunks) + len(self.pending)
+
+    def append(self, columns, series=None):
+        """
+        :param columns: dict name -> value of the episode, arrays must keep their shape across episodes.
+        :param series: dict name -> 1-D array of any length.
+        """
+        self.pending.append(({name: np.asarray(value) for name, value in columns.items()},
+                             {name: np.asarray(value, dtype=float).reshape(-1) for name, value in (series or {}).items()}))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        arrays = {}
+        for name in self.pending[0][0]:
+            arrays[name] = np.stack([columns[name] for columns, _ in self.pending])
+        for name in self.pending[0][1]:
+            values = [series.get(name, np.empty(0)) for _, series in self.pending]
+            arrays[name] = np.concatenate(values)
+            arrays[name + LENGTHS_SUFFIX] = np.array([len(value) for value in values], dtype=np.int64)
+        file_name = f"chunk_{len(self.chunks):05d}.npz"
+        self.__atomic_write(file_name, lambda f: np.savez(f, **arrays))
+        self.chunks.append((file_name, len(self.pending)))
+        self.__write_manifest()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+    def __write_manifest(self):
+        manifest = json.dumps({'chunks': [list(chunk) for chunk in self.chunks]}).encode()
+        self.__atomic_write(MANIFEST, lambda f: f.write(manifest))
+
+    def __atomic_write(self, file_name, write):
+        path = os.path.join(self.directory, file_name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+def read_manifest(directory):
+    """
+    :param directory:
+    :return: list of [chunk file name, episodes] committed in directory, empty if there is no run there.
+    """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)['chunks']
+
+
+def load_results(directory):
+    """
+    Reads back the episodes written by a ResultsWriter.
+    :param directory:
+    :return: dict name -> array over the episodes for the columns, and name -> list with the array of each episode for
+    the series.
+    """
+    columns, series = {}, {}
+    for file_name, _ in read_manifest(directory):
+        with np.load(os.path.join(directory, file_name)) as chunk:
+            names = set(chunk.files)
+            for name in chunk.files:
+                if name.endswith(LENGTHS_SUFFIX):
+                    continue
+                if name + LENGTHS_SUFFIX in names:
+                    bounds = np.cumsum(chunk[name + LENGTHS_SUFFIX])[:-1]
+                    series.setdefault(name, []).extend(np.split(chunk[name], bounds))
+                else:
+                    columns.setdefault(name, []).append(chunk[name])
+    results = {name: np.concatenate(parts) for name, parts in columns.items()}
+    results.update(series)
+    return results
@@ -0,0 +1,69 @@
+import torch as T
+
+
+def discounted_cumsum(x, discounts):
+    """
+    Computes the reverse discounted cumulative sum y_t = x_t + discounts_t * y_{t+1} (with y_T = 0) over the first
+    dimension, using tensor ops only.
+
+    Each step is an affine map y_t = b_t + a_t * y_{t+1}. Composing the map of step t with the one of step t+s gives
+    another affine map, so instead of walking the trajectory one step at a time, all the steps are composed in
+    parallel with a doubling offset (Hillis-Steele scan). This takes log2(T) vectorized ops instead of T scalar writes.
+
+    :param x: tensor with shape (T, ...), time in the first dimension.
+    :param discounts: tensor broadcastable to x, the factor connecting step t to step t+1. The done masking goes here,
+    a 0 cuts the sum at that step.
+    :return: the sums (same shape as x) and the accumulated discount a_t from step t to the end of the trajectory. The
+    latter is what multiplies a bootstrap value for y_T.
+    """
+    b = x
+    a = T.broadcast_to(discounts, x.shape).to(x.dtype)
+    n_steps = x.shape[0]
+    offset = 1
+    while offset < n_steps:
+        # Steps past the end have nothing left to add, so only the first T - offset entries are composed.
+        b = T.cat((b[:-offset] + a[:-offset] * b[offset:], b[-offset:]))
+        a = T.cat((a[:-offset] * a[offset:], a[-offset:]))
+        offset *= 2
+    return b, a
+
+
+def discounted_returns(rewards, dones, bootstrap_value, gamma):
+    """
+    Computes the n-step bootstrapped returns of a trajectory. Following the expression:
+    R_t = r_t + gamma * R_{t+1} + ... + gamma^n * V(s_{t+n})
+    where the sum is cut at the steps marked as done.
+
+    :param rewards: tensor with shape (T, ...), time in the first dimension. The trailing dimensions can be used to
+    compute the returns of several agents at once.
+    :param dones: tensor with the same shape as rewards.
+    :param bootstrap_value: V(s_T), the value of the state after the last step. Shape (...) or broadcastable to it.
+    :param gamma:
+    :return: tensor with the returns, same shape as rewards.
+    """
+    not_done = 1.0 - dones.to(rewards.dtype)
+    returns, discount = discounted_cumsum(rewards, gamma * not_done)
+    return returns + discount * bootstrap_value
+
+
+def gae_advantages(rewards, values, next_values, dones, gamma, gae_lambda):
+    """
+    Generalized Advantage Estimation, GAE(lambda):
+    delta_t = r_t + gamma * V(s_{t+1}) * (1 - d_t) - V(s_t)
+    A_t = delta_t + gamma * lambda * (1 - d_t) * A_{t+1}
+
+    Based on:
+    - https://arxiv.org/abs/1506.02438 | High-Dimensional Continuous Control Using Generalized Advantage Estimation
+
+    :param rewards: tensor with shape (T, ...), time in the first dimension.
+    :param values: V(s_t), same shape as rewards.
+    :param next_values: V(s_{t+1}), same shape as rewards.
+    :param dones: same shape as rewards.
+    :param gamma:
+    :param gae_lambda: 0 gives the one step TD error, 1 the Monte Carlo advantage.
+    :return: the advantages, same shape as rewards. The returns used as critic targets are advantages + values.
+    """
+    not_done = 1.0 - dones.to(rewards.dtype)
+    deltas = rewards + gamma * next_values * not_done - values
+    advantages, _ = discounted_cumsum(deltas, gamma * gae_lambda * not_done)
+    return advantages
@@ -0,0 +1,135 @@
+import numpy as np
+import torch as T
+
+
+def as_tensor(data, dtype, device):
+    """
+    Converts rollout data to a tensor. Tensors coming from a RolloutBuffer are returned as they are (no copy when the
+    dtype and device already match), lists of steps are stacked first.
+    """
+    if isinstance(data, T.Tensor):
+        return data.to(device=device, dtype=dtype)
+    return T.tensor(np.array(data), dtype=dtype, device=device)
+
+
+class RolloutBuffer:
+    """
+    Fixed-capacity, tensor-backed storage for on-policy rollouts (A2C, PPO). Every field is one preallocated tensor with
+    shape (n_agents, capacity, ...) living on the device of the networks, written in place at each step. Each agent
+    has its own cursor, as the FL trainers step the agents one at a time.
+
+    get() returns views of the data stored so far, so nothing is copied when the rollout is handed to the networks,
+    and reset() only rewinds the cursors. The capacity should be the number of steps between updates
+    (steps_for_return). If a rollout ever gets longer, the storage doubles instead of dropping steps.
+
+    The tensors are allocated on the first store, when the shape of the observations is known.
+    """
+
+    def __init__(self, agents, capacity, extra_fields=None, device=None):
+        """
+        :param agents: the agents sharing the buffer.
+        :param capacity: number of steps kept per agent.
+        :param extra_fields: dict field name -> torch dtype, scalar fields stored next to the transitions. E.g. the
+        log-probabilities and values of PPO.
+        :param device:
+        """
+        self.agents = list(agents)
+        self.agent_idx = {agent: idx for idx, agent in enumerate(self.agents)}
+        self.n_agents = len(self.agents)
+        self.capacity = max(1, capacity)
+        self.device = device if device is not None else T.device('cuda:0' if T.cuda.is_available() else 'cpu')
+
+        self.field_dtypes = {'action': T.long, 'reward': T.float, 'done': T.float}
+        self.field_dtypes.update(extra_fields or {})
+        self.fields = {}
+        self.state = None
+        self.next_state = None
+        self.counter = np.zeros(self.n_agents, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.counter.max())
+
+    def count(self, agent):
+        return int(self.counter[self.agent_idx[agent]])
+
+    def __allocate(self, state_shape):
+        self.state = T.zeros((self.n_agents, self.capacity, *state_shape), dtype=T.float, device=self.device)
+        self.next_state = T.zeros_like(self.state)
+        self.fields = {name: T.zeros((self.n_agents, self.capacity), dtype=dtype, device=self.device)
+                       for name, dtype in self.field_dtypes.items()}
+
+    def __grow(self):
+        self.capacity *= 2
+        self.state = T.cat((self.state, T.zeros_like(self.state)), dim=1)
+        self.next_state = T.cat((self.next_state, T.zeros_like(self.next_state)), dim=1)
+        self.fields = {name: T.cat((field, T.zeros_like(field)), dim=1) for name, field in self.fields.items()}
+
+    def store(self, agent_list, states, actions, rewards, next_states, dones, **extra):
+        """
+        Writes one step of the given agents in place.
+        :param agent_list: the agents the rows belong to.
+        :param states: array-like with shape (len(agent_list), *input_shape)
+        :param actions: array-like with shape (len(agent_list),)
+        :param rewards: array-like with shape (len(agent_list),)
+        :param next_states: array-like with shape (len(agent_list), *input_shape)
+        :param dones: array-like with shape (len(agent_list),)
+        :param extra: values for the extra fields, same shape as rewards.
+        :return:
+        """
+        states = np.asarray(states, dtype=np.float32)
+        if self.state is None:
+            self.__allocate(states.shape[1:])
+        rows = np.array([self.agent_idx[agent] for agent in agent_list], dtype=np.int64)
+        while self.counter[rows].max() >= self.capacity:
+            self.__grow()
+        rows_t = T.from_numpy(rows).to(self.device)
+        cursor = T.from_numpy(self.counter[rows]).to(self.device)
+
+        self.state[rows_t, cursor] = T.from_numpy(states).to(self.device)
+        self.next_state[rows_t, cursor] = T.from_numpy(np.asarray(next_states, dtype=np.float32)).to(self.device)
+        values = {'action': actions, 'reward': rewards, 'done': dones, **extra}
+        for name, value in values.items():
+            field = self.fields[name]
+            field[rows_t, cursor] = T.as_tensor(np.asarray(value).reshape(-1), dtype=field.dtype).to(self.device)
+        self.counter[rows] += 1
+
+    def get(self, agent):
+        """
+        :param agent:
+        :return: dict with views over the steps stored for the agent, each with the steps in the first dimension.
+        """
+        row = self.agent_idx[agent]
+        n = int(self.counter[row])
+        if self.state is None:
+            return {}
+        data = {name: field[row, :n] for name, field in self.fields.items()}
+        data['state'] = self.state[row, :n]
+        data['next_state'] = self.next_state[row, :n]
+        return data
+
+    def minibatches(self, agent, batch_size, fields):
+        """
+        Shuffles the rollout of an agent once and splits it in minibatches. The shuffled copy is made in a single
+        gather per field, the minibatches are contiguous views of it.
+        :param agent:
+        :param batch_size:
+        :param fields: names of the fields to include.
+        :return: list of dicts, one per minibatch, plus the permutation that was applied.
+        """
+        data = self.get(agent)
+        n = self.count(agent)
+        permutation = T.randperm(n, device=self.device)
+        shuffled = {name: data[name].index_select(0, permutation) for name in fields}
+        batches = [{name: shuffled[name][start:start + batch_size] for name in fields}
+                   for start in range(0, n, batch_size)]
+        return batches, permutation
+
+    def reset(self, agents=None):
+        """
+        Rewinds the cursors of the given agents (all when None). The storage is kept and overwritten. Agents without
+        a rollout in the buffer are ignored.
+        """
+        if agents is None:
+            self.counter[:] = 0
+        else:
+            self.counter[[self.agent_idx[agent] for agent in agents if agent in self.agent_idx]] = 0
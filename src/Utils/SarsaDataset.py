@@ -0,0 +1,174 @@
+import json
+import os
+
+import numpy as np
+
+INDEX = "index.json"
+# name -> dtype of the columns, state, action and next_state are (rows, size) and the rest (rows,).
+COLUMNS = {
+    'agent': np.int32,  # position in the agents of the index
+    'episode': np.int32,
+    'step': np.int32,
+    'state': np.float32,
+    'action': np.float32,
+    'reward': np.float32,
+    'next_state': np.float32,
+    'done': np.bool_,
+}
+VECTOR_COLUMNS = ('state', 'action', 'next_state')
+
+
+class SarsaDatasetWriter:
+    """
+    Streams Sarsa transitions into preallocated chunks of typed columns (float32 states, actions and rewards). When a
+    chunk is full it is written as a shard, one .npy file per column, so SarsaDataset can memory-map them.
+    Layout of the directory:
+    - index.json: the agents, the size of the vector columns and the committed shards with the rows in each.
+    - shard_00000.state.npy, shard_00000.reward.npy, ...
+
+    Shards are written to temporary files and renamed before the index is replaced, so a killed run leaves the shards
+    committed so far readable. With directory=None the full chunks are kept in memory until save().
+    """
+
+    def __init__(self, agents, directory=None, chunk_size=4096):
+        """
+        :param agents: the agents of the transitions.
+        :param directory: where the shards are written, None keeps them in memory.
+        :param chunk_size: rows of each shard.
+        """
+        self.agents = list(agents)
+        self.agent_idx = {agent: idx for idx, agent in enumerate(self.agents)}
+        self.directory = directory
+        self.chunk_size = max(1, chunk_size)
+        self.sizes = None  # column -> length of the vectors, known from the first transition.
+        self.chunk = None
+        self.rows = 0  # rows used in self.chunk
+        self.shards = []  # list of (shard name, rows)
+        self.kept = []  # full chunks, when there is no directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.__write_index()
+
+    def __len__(self):
+        return sum(rows for _, rows in self.shards) + sum(len(chunk['reward']) for chunk in self.kept) + self.rows
+
+    def append(self, agent, episode, step, state, action, reward, next_state, done):
+        if self.chunk is None:
+            if self.sizes is None:
+                self.sizes = {'state': np.size(state), 'action': np.size(action), 'next_state': np.size(next_state)}
+            self.chunk = {name: np.zeros((self.chunk_size, self.sizes[name]) if name in VECTOR_COLUMNS
+                                         else self.chunk_size, dtype=dtype) for name, dtype in COLUMNS.items()}
+        row = self.rows
+        self.chunk['agent'][row] = self.agent_idx[agent]
+        self.chunk['episode'][row] = episode
+        self.chunk['step'][row] = step
+        self.chunk['state'][row] = np.ravel(state)
+        self.chunk['action'][row] = np.ravel(action)
+        self.chunk['reward'][row] = reward
+        self.chunk['next_state'][row] = np.ravel(next_state)
+        self.chunk['done'][row] = done
+        self.rows += 1
+        if self.rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        chunk = {name: column[:self.rows] for name, column in self.chunk.items()}
+        if self.directory is None:
+            self.kept.append(chunk)
+        else:
+            self.__write_shard(chunk)
+        self.chunk, self.rows = None, 0
+
+    def close(self):
+        self.flush()
+
+    def chunks(self):
+        """
+        :return: the chunks kept in memory followed by the one being filled, each a dict column -> array.
+        """
+        pending = [{name: column[:self.rows] for name, column in self.chunk.items()}] if self.rows else []
+        return self.kept + pending
+
+    def save(self, directory):
+        """
+        Writes the transitions kept in memory as a dataset in directory.
+        :param directory:
+        """
+        if directory is None:
+            raise ValueError("save needs the directory to write the dataset to")
+        writer = SarsaDatasetWriter(self.agents, directory, self.chunk_size)
+        writer.sizes = self.sizes
+        for chunk in self.chunks():
+            writer.__write_shard(chunk)
+
+    def __write_shard(self, chunk):
+        name = f"shard_{len(self.shards):05d}"
+        for column, values in chunk.items():
+            self.__atomic_write(f"{name}.{column}.npy", lambda f: np.save(f, values))
+        self.shards.append((name, len(chunk['reward'])))
+        self.__write_index()
+
+    def __write_index(self):
+        index = json.dumps({'agents': self.agents, 'sizes': self.sizes,
+                            'shards': [list(shard) for shard in self.shards]}).encode()
+        self.__atomic_write(INDEX, lambda f: f.write(index))
+
+    def __atomic_write(self, file_name, write):
+        path = os.path.join(self.directory, file_name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+class SarsaDataset:
+    """
+    A dataset written by SarsaDatasetWriter. The shards are memory-mapped, so opening it reads only the index, and the
+    rows are read from disk when a batch is sliced.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, INDEX), 'r') as f:
+            index = json.load(f)
+        self.directory = directory
+        self.agents = index['agents']
+        self.shards = [{column: np.load(os.path.join(directory, f"{name}.{column}.npy"), mmap_mode='r')
+                        for column in COLUMNS} for name, _ in index['shards']]
+        self.bounds = np.cumsum([0] + [rows for _, rows in index['shards']])
+
+    def __len__(self):
+        return int(self.bounds[-1])
+
+    def batch(self, start, stop):
+        """
+        :param start: first row.
+        :param stop: row after the last one.
+        :return: dict column -> array with the rows, only copied when they span more than one shard.
+        """
+        start, stop = max(0, start), min(stop, len(self))
+        first = int(np.searchsorted(self.bounds, start, side='right')) - 1
+        parts = []
+        while first < len(self.shards) and self.bounds[first] < stop:
+            offset = self.bounds[first]
+            parts.append({column: values[max(start - offset, 0):stop - offset]
+                          for column, values in self.shards[first].items()})
+            first += 1
+        if len(parts) == 1:
+            return parts[0]
+        return {column: np.concatenate([part[column] for part in parts]) if parts else np.empty(0, dtype=dtype)
+                for column, dtype in COLUMNS.items()}
+
+    def column(self, name):
+        """
+        :param name:
+        :return: the whole column, a view of the file when there is a single shard.
+        """
+        return self.batch(0, len(self))[name]
+
+
+def is_dataset(path):
+    return os.path.isfile(os.path.join(path, INDEX))
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class StepMetricsStore:
+    """
+    Per-agent, per-step metrics of one episode (e.g. rewards and losses). Every field is one preallocated NumPy array
+    with shape (n_agents, capacity), written in place at each step, and each agent has its own cursor, as with cohort
+    selection not every agent acts in every step. Appending is O(1) per agent, and when an episode gets longer than the
+    capacity the storage doubles.
+
+    series() returns views of the data stored so far. The episode's arrays are never reused, next_episode() starts a
+    new store, so the compiled episodes can keep the views without copying them.
+    """
+
+    def __init__(self, agents, fields=('reward', 'loss'), capacity=1024):
+        """
+        :param agents: the agents tracked.
+        :param fields: names of the metrics kept per agent and step.
+        :param capacity: number of steps preallocated per agent.
+        """
+        self.agents = list(agents)
+        self.agent_idx = {agent: idx for idx, agent in enumerate(self.agents)}
+        self.fields = tuple(fields)
+        self.capacity = max(1, capacity)
+        self.data = {field: np.zeros((len(self.agents), self.capacity)) for field in self.fields}
+        self.counter = np.zeros(len(self.agents), dtype=np.int64)
+
+    def __len__(self):
+        return int(self.counter.max()) if len(self.counter) else 0
+
+    def count(self, agent):
+        return int(self.counter[self.agent_idx[agent]])
+
+    def append(self, agents, **values):
+        """
+        Stores one step of the given agents.
+        :param agents: the agents that acted in the step, each at most once.
+        :param values: field -> one value per agent, in the order of agents.
+        """
+        rows = np.fromiter((self.agent_idx[agent] for agent in agents), dtype=np.int64, count=len(agents))
+        if len(rows) == 0:
+            return
+        cols = self.counter[rows]
+        needed = int(cols.max()) + 1
+        if needed > self.capacity:
+            self.__grow(needed)
+        for field, field_values in values.items():
+            self.data[field][rows, cols] = field_values
+        self.counter[rows] += 1
+
+    def __grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        for field in self.fields:
+            grown = np.zeros((len(self.agents), capacity))
+            grown[:, :self.capacity] = self.data[field]
+            self.data[field] = grown
+        self.capacity = capacity
+
+    def series(self, field, agent):
+        """
+        :param field:
+        :param agent:
+        :return: view with the values of the agent stored so far, empty if it never acted.
+        """
+        idx = self.agent_idx[agent]
+        return self.data[field][idx, :self.counter[idx]]
+
+    def next_episode(self):
+        """
+        :return: an empty store for the next episode, preallocated for as many steps as this one had.
+        """
+        return StepMetricsStore(self.agents, self.fields, capacity=max(self.capacity if len(self) == 0 else len(self), 1))
@@ -0,0 +1,347 @@
+import math
+
+import numpy as np
+from gymnasium.spaces import Box, Dict, Discrete, MultiDiscrete
+
+import peersim_gym.envs.PeersimEnv as pe
+from src.FL.Compression import payload_nbytes
+
+STATE_NO_NEIGHBOURS = "numberOfNeighbours"
+
+
+def parse_array(value, dtype=float, separator=","):
+    return np.array([dtype(float(v)) for v in str(value).split(separator) if v != ""])
+
+
+def parse_topology(topology):
+    """
+    Parses the TOPOLOGY string of the configs, "0,1,2;1,0;2,0" -> [[0, 1, 2], [1, 0], [2, 0]]. The first entry of each
+    row is the node itself, so the neighbour index 0 is always local processing.
+    """
+    return [[int(n) for n in row.split(",")] for row in topology.split(";")]
+
+
+class SurrogatePeersimEnv:
+    """
+    In-process stand-in for PeersimEnv, for profiling and benchmarking the agents without the Java simulator. It takes
+    the same configs (ConfigHelper.generate_config_dict) and implements the part of the PeersimEnv API the agents use:
+    reset, step, observation_space/action_space, neighbourMatrix, whichControllersMatrix, max_neighbours,
+    number_nodes, post_updates/get_updates and the STATE_G_* info keys.
+
+    The dynamics are a coarse queueing model, all the nodes are updated at once with numpy:
+    - Each step is protocol.mng.cycle ticks. The nodes of the layers that get tasks receive Poisson(lambda * ticks) tasks.
+    - Each controller sends its tasks of the step to the neighbour picked by its action, the other nodes keep theirs.
+    - Tasks that do not fit in the target queue (Q_MAX) are dropped, each node then processes
+     cores * freq * ticks / (CPI * I) tasks.
+    - The reward of an agent is utility_reward per task placed, minus delay_weight times the expected delay (queue wait
+     at the target plus the communication time, proportional to the distance) and overload_weight per dropped task.
+
+    It is not a replacement for the simulator, the numbers are not comparable to the ones of PeersimEnv. The cloud,
+    workloads, DAGs and channel types in the configs are ignored. The point is to have something with the same
+    interface and shapes, that runs thousands of steps per second.
+
+    FL updates posted with post_updates are delivered to the neighbour dst of src (dst is a neighbour index, like the
+    actions), 1 + distance/radius + size/update_bandwidth steps later, so smaller (compressed) updates arrive sooner.
+    expected_deliveries and advance let the trainers jump to the arrivals instead of polling every step.
+    """
+
+    metadata = {"render_modes": ["ansi", "ascii", "human"]}
+
+    def __init__(self, configs=None, render_mode=None, simtype="basic", log_dir=None, randomize_seed=False,
+                 phy_rs_term=None, update_bandwidth=1e6):
+        """
+        :param configs: dict from ConfigHelper.generate_config_dict, None uses its defaults with node 0 as the controller.
+        :param render_mode: ignored, kept for compatibility with PeersimEnv.
+        :param simtype: ignored, kept for compatibility with PeersimEnv.
+        :param log_dir: ignored, kept for compatibility with PeersimEnv.
+        :param randomize_seed: when False the configs' random.seed is used, so the runs are reproducible.
+        :param phy_rs_term: optional reward shaping term, phy_rs_term(observation) is added to the agent's reward.
+        :param update_bandwidth: bytes of FL updates a link carries per step.
+        """
+        if configs is None:
+            from src.Utils.ConfigHelper import generate_config_dict
+            # The controllers default of generate_config_dict is the string "[0]", which make_ctr can't parse.
+            configs = generate_config_dict(controllers=[0])
+        self.configs = configs
+        self.render_mode = render_mode
+        self.phy_rs_term = phy_rs_term
+        self.update_bandwidth = update_bandwidth
+        self.seed = None if randomize_seed else int(configs.get("random.seed", 0))
+        self.rng = np.random.default_rng(self.seed)
+
+        self.number_nodes = int(configs["SIZE"])
+        self.ticks_per_step = int(configs.get("protocol.mng.cycle", 1))
+        self.max_steps = max(1, int(configs.get("CYCLES", 1000)) // self.ticks_per_step)
+        self.radius = float(configs.get("init.Net1.r", 50))
+
+        # Per node characteristics, from the layers or the manual config.
+        nodes_per_layer = parse_array(configs.get("NO_NODES_PER_LAYERS", self.number_nodes), int)
+        self.layer = np.repeat(np.arange(len(nodes_per_layer)), nodes_per_layer)[:self.number_nodes]
+        if str(configs.get("MANUAL_CONFIG", False)) == "True":
+            self.q_max = self.__per_node(parse_array(configs["MANUAL_QMAX"], int))
+            self.cores = self.__per_node(parse_array(configs["MANUAL_CORES"], int))
+            self.freqs = self.__per_node(parse_array(configs["MANUAL_FREQS"]))
+        else:
+            self.q_max = parse_array(configs["Q_MAX"], int)[self.layer]
+            self.cores = parse_array(configs["NO_CORES"], int)[self.layer]
+            self.freqs = parse_array(configs["FREQS"])[self.layer]
+
+        # Tasks
+        task_probs = parse_array(configs.get("protocol.clt.weight", "1"))
+        task_cycles = parse_array(configs.get("protocol.clt.I", "4e7")) * parse_array(configs.get("protocol.clt.CPI", "1"))
+        self.cycles_per_task = float(np.sum(task_probs * task_cycles) / np.sum(task_probs))
+        self.arrival_rate = float(configs.get("protocol.clt.taskArrivalRate", 0.5)) * self.ticks_per_step
+        layers_with_tasks = parse_array(configs.get("layersThatGetTasks", "0"), int)
+        self.gets_tasks = np.isin(self.layer, layers_with_tasks)
+        self.capacity = self.cores * self.freqs * self.ticks_per_step / self.cycles_per_task
+
+        # Reward weights, delay_weight can be a number or a dict with the weight of each delay component.
+        self.weight_utility = float(configs.get("utility_reward", 1))
+        weight_delay = configs.get("delay_weight", 1)
+        if isinstance(weight_delay, dict):
+            self.weight_queue = float(weight_delay.get("queue", 1)) + float(weight_delay.get("exec", 0))
+            self.weight_comm = float(weight_delay.get("comm", 1))
+        else:
+            self.weight_queue = self.weight_comm = float(weight_delay)
+        self.weight_overload = float(configs.get("overload_weight", 1))
+        self.energy_comm = float(configs.get("protocol.wrk.energyCostComm", 1))
+        self.energy_comp = float(configs.get("protocol.wrk.energyCostComp", 1))
+
+        # Topology
+        self.positions = None
+        self.neighbourMatrix = None
+        self.__build_topology()
+        self.controllers = [int(c) for c in str(configs.get("CONTROLLERS", "0")).split(";") if c != ""]
+        self.possible_agents = [f"worker_{c}" for c in self.controllers]
+        self.agents = list(self.possible_agents)
+        self.max_neighbours = max(len(row) for row in self.neighbourMatrix)
+        # Index, in the neighbourhood of each node, of the neighbours that are controllers.
+        controller_set = set(self.controllers)
+        self.whichControllersMatrix = [[k for k, n in enumerate(row) if n in controller_set]
+                                       for row in self.neighbourMatrix]
+
+        # Padded (n_nodes, max_neighbours) view of the topology, padded entries point at the node itself.
+        m = self.max_neighbours
+        self.n_neighbours = np.array([len(row) for row in self.neighbourMatrix])
+        self.neighbours = np.array([row + [row[0]] * (m - len(row)) for row in self.neighbourMatrix])
+        self.slot_valid = np.arange(m)[None, :] < self.n_neighbours[:, None]
+        self.distances = np.linalg.norm(self.positions[:, None, :] - self.positions[None, :, :], axis=-1)
+        self.controller_nodes = np.array(self.controllers)
+        self.max_w = float(np.max(self.capacity))
+
+        self.mailboxes = {}
+        self.in_transit = []
+        self.last_reward_components = {}
+        self.t = 0
+        self.__reset_state()
+
+    def __per_node(self, values):
+        return np.resize(values, self.number_nodes)
+
+    def __build_topology(self):
+        configs = self.configs
+        if str(configs.get("RANDOMIZEPOSITIONS", True)) == "True" or not configs.get("init.Net0.POSITIONS"):
+            self.positions = self.rng.uniform(0, 100, (self.number_nodes, 2))
+        else:
+            self.positions = np.array([[float(c) for c in p.split(",")]
+                                       for p in configs["init.Net0.POSITIONS"].split(";")])[:self.number_nodes]
+        if str(configs.get("RANDOMIZETOPOLOGY", True)) == "True" or not configs.get("init.Net1.TOPOLOGY"):
+            # Nodes within the communication radius of each other are neighbours.
+            distances = np.linalg.norm(self.positions[:, None, :] - self.positions[None, :, :], axis=-1)
+            self.neighbourMatrix = [[i] + [int(j) for j in np.flatnonzero(distances[i] <= self.radius) if j != i]
+                                    for i in range(self.number_nodes)]
+        else:
+            rows = {row[0]: row for row in parse_topology(configs["init.Net1.TOPOLOGY"])}
+            self.neighbourMatrix = [rows.get(i, [i]) for i in range(self.number_nodes)]
+
+    def __reset_state(self):
+        n = self.number_nodes
+        self.Q = np.zeros(n, dtype=np.int64)
+        self.finished = np.zeros(n, dtype=np.int64)
+        self.dropped = np.zeros(n, dtype=np.int64)
+        self.total = np.zeros(n, dtype=np.int64)
+        self.energy = np.zeros(n)
+        self.response_time = np.zeros(n)
+        self.t = 0
+        self.mailboxes = {}
+        self.in_transit = []
+
+    def observation_space(self, agent):
+        m = self.max_neighbours
+        q_max = int(self.q_max.max())
+        return Dict({
+            pe.STATE_NODE_ID_FIELD: Discrete(self.number_nodes),
+            pe.STATE_Q_FIELD: MultiDiscrete([q_max + 1] * m),
+            pe.STATE_FREE_SPACES_FIELD: MultiDiscrete([q_max + 1] * m),
+            pe.STATE_PROCESSING_POWER_FIELD: Box(low=0, high=self.max_w, shape=(m,), dtype=np.float64),
+            STATE_NO_NEIGHBOURS: Discrete(m + 1),
+        })
+
+    def action_space(self, agent):
+        node = int(agent.split("_")[1])
+        return Dict({pe.ACTION_NEIGHBOUR_IDX_FIELD: Discrete(len(self.neighbourMatrix[node]))})
+
+    def __observations(self):
+        # All the observations are gathered at once from the padded neighbourhoods of the controllers.
+        neighbours = self.neighbours[self.controller_nodes]
+        valid = self.slot_valid[self.controller_nodes]
+        q = np.where(valid, self.Q[neighbours], 0)
+        free = np.where(valid, self.q_max[neighbours] - self.Q[neighbours], 0)
+        # The processing power is given in tasks per step, so it is on the same scale as the queues.
+        w = np.where(valid, self.capacity[neighbours], 0.0)
+        return {
+            agent: {
+                pe.STATE_NODE_ID_FIELD: node,
+                pe.STATE_Q_FIELD: q[idx],
+                pe.STATE_FREE_SPACES_FIELD: free[idx],
+                pe.STATE_PROCESSING_POWER_FIELD: w[idx],
+                STATE_NO_NEIGHBOURS: int(self.n_neighbours[node]),
+            } for idx, (agent, node) in enumerate(zip(self.possible_agents, self.controller_nodes))
+        }
+
+    def __info(self):
+        return {
+            pe.STATE_G_OVERLOADED_NODES: (self.Q >= self.q_max).astype(np.int64),
+            pe.STATE_G_AVERAGE_COMPLETION_TIMES: self.response_time / np.maximum(self.finished, 1),
+            pe.STATE_G_OCCUPANCY: self.Q / self.q_max,
+            pe.STATE_G_DROPPED_TASKS: self.dropped.copy(),
+            pe.STATE_G_FINISHED_TASKS: self.finished.copy(),
+            pe.STATE_G_TOTAL_TASKS: self.total.copy(),
+            pe.STATE_G_CONSUMED_ENERGY: self.energy.copy(),
+        }
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self.__reset_state()
+        self.agents = list(self.possible_agents)
+        return self.__observations(), {agent: {} for agent in self.agents}
+
+    def step(self, actions):
+        """
+        :param actions: dict agent -> {ACTION_NEIGHBOUR_IDX_FIELD: neighbour index}, as given by utils.make_action.
+        Controllers without an action process their tasks locally.
+        :return: observations, rewards, terminations, truncations, info
+        """
+        n = self.number_nodes
+        self.t += 1
+        arrivals = np.where(self.gets_tasks, self.rng.poisson(self.arrival_rate, n), 0)
+        self.total += arrivals
+
+        # Where the tasks of each node go, only the controllers move theirs.
+        targets = np.arange(n)
+        choices = np.zeros(len(self.controllers), dtype=np.int64)
+        for idx, agent in enumerate(self.possible_agents):
+            if agent in actions:
+                # Some agents send the index as a one element array.
+                choices[idx] = int(np.asarray(actions[agent][pe.ACTION_NEIGHBOUR_IDX_FIELD]).reshape(-1)[0])
+        choices = np.clip(choices, 0, self.n_neighbours[self.controller_nodes] - 1)
+        targets[self.controller_nodes] = self.neighbours[self.controller_nodes, choices]
+
+        incoming = np.bincount(targets, weights=arrivals, minlength=n).astype(np.int64)
+        space = np.maximum(self.q_max - self.Q, 0)
+        accepted = np.minimum(incoming, space)
+        dropped = incoming - accepted
+        # Drops are split among the senders proportionally to what they sent.
+        drop_ratio = np.divide(dropped, incoming, out=np.zeros(n), where=incoming > 0)
+
+        # Expected delay of the tasks sent to each target, waiting in the queue plus the transfer.
+        queue_delay = (self.Q + accepted / 2) / self.capacity
+        comm_delay = self.distances[np.arange(n), targets] / self.radius
+        self.Q += accepted
+        processed = np.minimum(self.Q, np.floor(self.capacity).astype(np.int64))
+        self.Q -= processed
+
+        self.finished += processed
+        self.dropped += dropped
+        self.response_time += processed * (self.Q / self.capacity + 1)
+        self.energy += self.energy_comp * processed + self.energy_comm * arrivals * (targets != np.arange(n))
+
+        # Rewards of the controllers.
+        sent = arrivals[self.controller_nodes]
+        target_nodes = targets[self.controller_nodes]
+        placed = sent * (1 - drop_ratio[target_nodes])
+        utility = self.weight_utility * placed
+        delay = sent * (self.weight_queue * queue_delay[target_nodes] + self.weight_comm * comm_delay[self.controller_nodes])
+        overload = self.weight_overload * sent * drop_ratio[target_nodes]
+        reward_values = utility - delay - overload
+        self.last_reward_components = {agent: {"utility": utility[idx], "delay": delay[idx], "overload": overload[idx]}
+                                       for idx, agent in enumerate(self.possible_agents)}
+
+        observations = self.__observations()
+        rewards = {agent: float(reward_values[idx]) for idx, agent in enumerate(self.possible_agents)}
+        if self.phy_rs_term is not None:
+            for agent in self.possible_agents:
+                rewards[agent] += self.phy_rs_term(observations[agent])
+        done = self.t >= self.max_steps
+        terminations = {agent: done for agent in self.possible_agents}
+        truncations = {agent: False for agent in self.possible_agents}
+        self.__deliver_updates()
+        return observations, rewards, terminations, truncations, self.__info()
+
+    def post_updates(self, agents, updates, srcs, dst):
+        """
+        Sends FL updates through the network.
+        :param agents: the agent sending each update.
+        :param updates: the updates (state dicts).
+        :param srcs: node sending each update.
+        :param dst: neighbour index, in the neighbourhood of src, of the receiver of each update.
+        """
+        deliveries = self.expected_deliveries(srcs, dst, updates)
+        for agent, update, src, (receiver, delay) in zip(agents, updates, srcs, deliveries):
+            self.in_transit.append((self.t + delay, receiver,
+                                    {'agent': agent, 'update': update, 'src': src, 'dst': int(receiver.split('_')[1])}))
+
+    def expected_deliveries(self, srcs, dst, updates):
+        """
+        Where and when the updates would arrive if posted now, lets the FL trainers skip the ticks where nothing can
+        arrive.
+        :param srcs: node sending each update.
+        :param dst: neighbour index, in the neighbourhood of src, of the receiver of each update.
+        :param updates:
+        :return: list with (receiving agent, steps until the arrival) for each update.
+        """
+        deliveries = []
+        for update, src, dst_idx in zip(updates, srcs, dst):
+            receiver = self.neighbourMatrix[src][dst_idx]
+            delay = 1 + int(math.floor(self.distances[src, receiver] / self.radius)) \
+                + int(math.ceil(payload_nbytes(update) / self.update_bandwidth))
+            deliveries.append((f"worker_{receiver}", delay))
+        return deliveries
+
+    def advance(self, ticks):
+        """
+        Runs the simulation for a number of steps without any action, stops early if the episode ends.
+        :param ticks:
+        :return: the output of the last step and the number of steps run.
+        """
+        result = None
+        for tick in range(ticks):
+            result = self.step({})
+            if all(result[2].values()):
+                return result, tick + 1
+        return result, ticks
+
+    def __deliver_updates(self):
+        pending = []
+        for arrival, receiver, message in self.in_transit:
+            if arrival <= self.t:
+                self.mailboxes.setdefault(receiver, []).append(message)
+            else:
+                pending.append((arrival, receiver, message))
+        self.in_transit = pending
+
+    def get_updates(self, agent):
+        """
+        :param agent:
+        :return: list with the updates that arrived to the agent since the last call, as dicts with agent, update, src
+        and dst.
+        """
+        return self.mailboxes.pop(agent, [])
+
+    def render(self):
+        if self.render_mode in ("ansi", "ascii"):
+            return f"t={self.t} Q={self.Q.tolist()}"
+
+    def close(self):
+        pass
@@ -0,0 +1,158 @@
+import functools
+import multiprocessing as mp
+
+import numpy as np
+
+from src.Utils import utils
+
+
+def make_env_fns(make_env, n_envs, base_port=8080):
+    """
+    Builds the factories for a VecPeersimEnv, one per simulator. Each simulator gets its own port, starting at
+    base_port, so the instances don't collide (see Scripts/autokill.sh for cleaning them up).
+    :param make_env: callable make_env(port=...) returning a ready to use PeersimEnv. It is the one responsible for
+    passing the port to the simulator configs. Must be picklable if the start method is not fork (i.e. a module level
+    function, not a lambda).
+    :param n_envs: number of simulators.
+    :param base_port:
+    :return: list of zero argument callables.
+    """
+    return [functools.partial(make_env, port=base_port + k) for k in range(n_envs)]
+
+
+def _worker(remote, parent_remote, env_fn):
+    """
+    Loop of the processes running the simulators. The environment is only ever touched here, the main process talks to
+    it through the pipe. The observations are flattened before they are sent back, so only plain arrays go through the
+    pipe.
+    """
+    parent_remote.close()
+    env = env_fn()
+    agents = None
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                next_states, rewards, dones, truncated, info = env.step(data)
+                next_states = np.array(utils.flatten_state_list(next_states, agents))
+                rewards = np.array([rewards[agent] for agent in agents], dtype=np.float32)
+                dones = np.array([dones[agent] for agent in agents], dtype=bool)
+                info = dict(info)
+                if dones.all():
+                    # Auto-reset, the caller gets the first state of the next episode and the last one goes in info.
+                    info['terminal_observation'] = next_states
+                    states, _ = env.reset()
+                    next_states = np.array(utils.flatten_state_list(states, agents))
+                remote.send((next_states, rewards, dones, info))
+            elif cmd == "reset":
+                states, _ = env.reset()
+                agents = list(env.agents)
+                remote.send(np.array(utils.flatten_state_list(states, agents)))
+            elif cmd == "get_attr":
+                remote.send(getattr(env, data))
+            elif cmd == "close":
+                remote.send(None)
+                break
+            else:
+                raise NotImplementedError(f"Unknown command {cmd}")
+    except KeyboardInterrupt:
+        print("VecPeersimEnv worker: got KeyboardInterrupt")
+    finally:
+        env.close()
+        remote.close()
+
+
+class VecPeersimEnv:
+    """
+    Runs K PeersimEnv instances, each in its own process with its own simulator, and steps them concurrently. The main
+    process sends the actions of every environment, then waits for all the results, so the K simulations advance in
+    parallel instead of one after the other.
+
+    All the environments must have the same agents (same topology and controllers). The data is returned stacked, with
+    the environment in the first dimension and the agents, in the order of env.agents, in the second:
+    - states: (K, n_agents, obs_dim) flattened observations, as utils.flatten_state_list would give.
+    - rewards: (K, n_agents)
+    - dones: (K, n_agents)
+    - infos: list with the info dict of each environment.
+
+    An environment whose episode ended (all its agents done) is reset in its worker. The state returned for it is the
+    first state of the new episode, and the last state of the finished one is in infos[k]['terminal_observation'], which
+    is what should be stored as the next state of that transition.
+
+    Based on the SubprocVecEnv of stable-baselines3:
+    - https://github.com/DLR-RM/stable-baselines3/blob/master/stable_baselines3/common/vec_env/subproc_vec_env.py
+    """
+
+    def __init__(self, env_fns, start_method=None):
+        """
+        :param env_fns: one callable per environment, returning the PeersimEnv. See make_env_fns.
+        :param start_method: multiprocessing start method, defaults to the platform's.
+        """
+        self.n_envs = len(env_fns)
+        ctx = mp.get_context(start_method)
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(self.n_envs)])
+        self.processes = []
+        for work_remote, remote, env_fn in zip(self.work_remotes, self.remotes, env_fns):
+            # The simulators are killed with the main process.
+            process = ctx.Process(target=_worker, args=(work_remote, remote, env_fn), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+        self.closed = False
+
+        # Static data of the topology, taken from the first environment.
+        self.possible_agents = self.get_attr("possible_agents")
+        self.number_nodes = self.get_attr("number_nodes")
+        self.max_neighbours = self.get_attr("max_neighbours")
+        self.neighbourMatrix = self.get_attr("neighbourMatrix")
+        self.agents = list(self.possible_agents)
+
+    def get_attr(self, name, env_idx=0):
+        self.remotes[env_idx].send(("get_attr", name))
+        return self.remotes[env_idx].recv()
+
+    def reset(self):
+        """
+        Resets every environment.
+        :return: states with shape (K, n_agents, obs_dim)
+        """
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        states = np.stack([remote.recv() for remote in self.remotes])
+        self.agents = self.get_attr("agents")
+        return states
+
+    def step_async(self, actions):
+        """
+        :param actions: list with the actions of each environment, as given by utils.make_action.
+        """
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", action))
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        states, rewards, dones, infos = zip(*results)
+        return np.stack(states), np.stack(rewards), np.stack(dones), list(infos)
+
+    def step(self, actions):
+        """
+        Steps all the environments at once.
+        :param actions: list with the actions of each environment, as given by utils.make_action.
+        :return: states, rewards, dones, infos. See the class description for the shapes.
+        """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for remote in self.remotes:
+            remote.recv()
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+    def __len__(self):
+        return self.n_envs
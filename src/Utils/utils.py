@@ -96,3 +96,15 @@ def make_action(targets, agents):
             pe.ACTION_NEIGHBOUR_IDX_FIELD: targets[agent]
         } for agent in agents
     }
+
+
+def action_masks(output_shape, agents):
+    """
+    Builds the action masks used when agents with different neighbourhood sizes share one network. The network outputs
+    max(output_shape) actions, row i is True for the actions that exist for agents[i].
+    :param output_shape: dict with the number of actions of each agent.
+    :param agents:
+    :return: bool array with shape (len(agents), max_actions)
+    """
+    n_actions = np.array([output_shape[agent] for agent in agents])
+    return np.arange(n_actions.max())[None, :] < n_actions[:, None]
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("peersim_gym")
+import torch as T
+
+from src.MARL.A2CAgentMARL import A2CAgentMARL
+
+AGENTS = ["worker_0"]
+INPUT_SHAPE = (13,)
+
+
+def make_agent(shared):
+    T.manual_seed(0)
+    return A2CAgentMARL(input_shape=INPUT_SHAPE, action_space=None, output_shape={"worker_0": 4}, agents=AGENTS,
+                        learning_rate=1e-3, steps_for_return=10, save_interval=100, shared=shared)
+
+
+def store_rollout(agent, steps=10):
+    rng = np.random.default_rng(0)
+    for step in range(steps):
+        agent.agent_states.store(AGENTS, rng.random((1,) + INPUT_SHAPE), rng.integers(0, 4, 1), rng.random(1),
+                                 rng.random((1,) + INPUT_SHAPE), np.array([step == steps - 1]))
+
+
+def test_shared_loss_matches_per_agent_loss():
+    # With a single agent, the fused update of the shared mode trains on the same loss as the per-agent network.
+    per_agent, shared = make_agent(shared=False), make_agent(shared=True)
+    shared.A2Cs["worker_0"].load_state_dict(per_agent.A2Cs["worker_0"].state_dict())
+    store_rollout(per_agent)
+    store_rollout(shared)
+
+    rollout = per_agent.agent_states.get("worker_0")
+    network = per_agent.A2Cs["worker_0"]
+    network.remember_batch(rollout['state'], rollout['action'], rollout['reward'], rollout['next_state'],
+                           rollout['done'])
+    per_agent_loss = network.calculate_loss(rollout['done']).item()
+    network.clear_memory()
+
+    shared_loss = shared.learn_shared(AGENTS)["worker_0"]
+    assert shared_loss == pytest.approx(per_agent_loss, rel=1e-5)
@@ -0,0 +1,29 @@
+import torch as T
+
+from src.MARL.Networks.DQN import DQNEnsemble
+
+
+def train_step(ensemble, active=None):
+    states = T.rand(ensemble.n_members, 8, *ensemble.input_dims)
+    q_value = ensemble.forward(states).max(dim=2)[0]
+    loss, _ = ensemble.ensemble_loss(q_value, T.ones_like(q_value), active=active)
+    ensemble.optimizer.zero_grad()
+    loss.backward()
+    ensemble.step(active)
+
+
+def test_inactive_members_are_not_stepped():
+    T.manual_seed(0)
+    ensemble = DQNEnsemble(lr=1e-2, input_dims=(5,), fc1_dims=16, fc2_dims=16, fc3_dims=16, n_actions=[3, 4, 2])
+    # A few full steps first, so AdamW has momentum for every member.
+    for _ in range(3):
+        train_step(ensemble)
+    before = {name: param.detach().clone() for name, param in ensemble.named_parameters()}
+    state_before = {name: ensemble.optimizer.state[param]['exp_avg'].clone()
+                    for name, param in ensemble.named_parameters()}
+
+    train_step(ensemble, active=T.tensor([True, False, True]))
+    for name, param in ensemble.named_parameters():
+        assert T.equal(param[1], before[name][1])
+        assert T.equal(ensemble.optimizer.state[param]['exp_avg'][1], state_before[name][1])
+        assert not T.equal(param[0], before[name][0])
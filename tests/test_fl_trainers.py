@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip("peersim_gym")
+import matplotlib
+
+matplotlib.use('Agg')
+
+from src.FL.FedAvgTrainerAsync import FedAvgTrainerAsync
+from src.FL.FedAvgTrainerSync import FedAvgTrainerSync
+from src.FL.FedProxTrainerAsync import FedProxTrainerAsync
+from src.FL.FedProxTrainerSync import FedProxTrainerSync
+from src.Utils.ConfigHelper import generate_config_dict
+from src.Utils.SurrogateEnv import SurrogatePeersimEnv
+
+
+def make_env(simulation_time=60):
+    configs = generate_config_dict(controllers=[0, 1, 2, 3], RANDOMIZETOPOLOGY=False, RANDOMIZEPOSITIONS=False,
+                                   simulation_time=simulation_time)
+    return SurrogatePeersimEnv(configs=configs)
+
+
+def make_args(env, **extra):
+    args = dict(input_shape=(3 * env.max_neighbours + 1,),
+                output_shape={agent: len(env.neighbourMatrix[int(agent.split('_')[1])]) for agent in env.possible_agents},
+                agents=env.possible_agents, learning_rate=1e-3, round_size=20, steps_for_return=10, save_interval=100)
+    args.update(extra)
+    return args
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The trainers save their plots and models relative to the working directory.
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Plots").mkdir()
+    (tmp_path / "models").mkdir()
+    return tmp_path
+
+
+def test_gnn_sync_round(workdir):
+    # Every agent downloads the global model, which rebuilds its optimizer with the learning rate of the network.
+    env = make_env()
+    trainer = FedAvgTrainerSync(make_args(env, control_type="GNN"))
+    trainer.train_loop(env, 1, controllers=env.possible_agents, results_file=str(workdir / "gnn"))
+    assert len(trainer.mh.average_rewards) == 1
+
+
+@pytest.mark.parametrize("trainer, mu", [(FedAvgTrainerSync, 0.01), (FedAvgTrainerAsync, 0.5),
+                                         (FedProxTrainerSync, 0.75), (FedProxTrainerAsync, 0.5)])
+def test_default_mu(trainer, mu):
+    env = make_env()
+    assert trainer(make_args(env)).mu == mu
+    assert trainer(make_args(env, mu=0.2)).mu == 0.2
+
+
+def test_async_staleness_without_buffer(workdir):
+    # Without the buffer the updates are averaged by fed_avg_into, which weighs them with get_staleness.
+    env = make_env(simulation_time=200)
+    trainer = FedAvgTrainerAsync(make_args(env, buffer_size=0, aggregation_weights="staleness"))
+    trainer.train_loop(env, 1, controllers=env.possible_agents, results_file=str(workdir / "async"))
+    staleness = trainer.get_staleness()
+    assert staleness and set(staleness) <= set(env.possible_agents) - {trainer.global_id}
+    assert all(behind >= 0 for behind in staleness.values())
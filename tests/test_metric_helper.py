@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("peersim_gym")
+import matplotlib
+
+matplotlib.use('Agg')
+
+from src.Utils.MetricHelper import MetricHelper
+from src.Utils.ResultsWriter import load_results
+
+AGENTS = ["worker_0", "worker_1"]
+
+
+def run_episodes(mh, episodes, steps=3):
+    for episode in range(episodes):
+        for step in range(steps):
+            mh.update_metrics_after_step(rewards={agent: step for agent in AGENTS},
+                                         losses={agent: 0.5 for agent in AGENTS},
+                                         overloaded_nodes=[0, 1, 0], average_response_time=[1., 2., 3.],
+                                         occupancy=[0.1, 0.2, 0.3], dropped_tasks=[0, 0, 1], finished_tasks=[1, 1, 1],
+                                         total_tasks=[1, 1, 2], consumed_energy=[1., 1., 1.])
+        mh.compile_aggregate_metrics(episode, steps)
+
+
+def test_plots_use_the_compiled_episodes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Plots").mkdir()
+    mh = MetricHelper(AGENTS, num_nodes=3, num_episodes=5, file_name=str(tmp_path / "run"), flush_every=2)
+    # The run stops after 3 of the 5 episodes.
+    run_episodes(mh, 3)
+    mh.plot_agent_metrics(num_episodes=5, print_instead=True, title="test")
+    mh.plot_simulation_data(num_episodes=5, print_instead=True)
+    mh.clean_plt_resources()
+
+    assert mh.episode_average_reward(0) == pytest.approx(1.0)
+    assert not (tmp_path / "Plots" / "default.csv").exists()
+    results = load_results(str(tmp_path / "run_episodes"))
+    assert len(results["average_reward"]) == 3
+    np.testing.assert_allclose(results["occupancy"][0], np.array([0.1, 0.2, 0.3]))
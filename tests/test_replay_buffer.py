@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from src.MARL.ReplayBuffer import MultiAgentReplayBuffer, PrioritizedMultiAgentReplayBuffer
+
+AGENTS = ["worker_0", "worker_1"]
+
+
+def store_step(buffer, step, agent_list):
+    n = len(agent_list)
+    buffer.store_transitions(states=np.full((n, 3), step), actions=np.zeros(n), rewards=np.full(n, step),
+                             next_states=np.full((n, 3), step + 1), dones=np.zeros(n), agent_list=agent_list)
+
+
+@pytest.mark.parametrize("buffer_class", [MultiAgentReplayBuffer, PrioritizedMultiAgentReplayBuffer])
+def test_missing_agents_are_not_sampled(buffer_class):
+    buffer = buffer_class(AGENTS, capacity=16, input_shape=(3,), seed=0)
+    # worker_1 misses the odd steps, and the buffer wraps around so its old rows are overwritten only for worker_0.
+    for step in range(24):
+        store_step(buffer, step, AGENTS if step % 2 == 0 else ["worker_0"])
+    assert buffer.valid_counts.tolist() == [16, 8]
+    assert buffer.ready(16, ["worker_0"]) and not buffer.ready(16)
+
+    rewards = buffer.sample(256)[2]
+    assert (rewards[1] % 2 == 0).all()
+    assert (rewards[1] >= 8).all()
+    assert len(np.unique(rewards[0])) > 8
+
+
+def test_agent_never_stored():
+    buffer = PrioritizedMultiAgentReplayBuffer(AGENTS, capacity=8, input_shape=(3,), seed=0)
+    for step in range(8):
+        store_step(buffer, step, ["worker_0"])
+    *_, weights = buffer.sample(4)
+    assert np.isfinite(weights).all()
+    assert not buffer.ready(1)
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("peersim_gym")
+
+from src.Utils.SurrogateEnv import SurrogatePeersimEnv
+
+
+def test_default_configs():
+    env = SurrogatePeersimEnv()
+    observations, _ = env.reset()
+    assert env.possible_agents == ["worker_0"]
+    assert env.number_nodes == 10
+
+    actions = {agent: env.action_space(agent).sample() for agent in env.agents}
+    observations, rewards, terminations, truncations, info = env.step(actions)
+    assert set(rewards) == {"worker_0"}
+    assert np.isfinite(rewards["worker_0"])